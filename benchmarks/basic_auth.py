@@ -0,0 +1,32 @@
+"""
+Requests per second for authenticated GET requests, with and without the
+Basic auth credential cache.
+"""
+import os
+from benchmarks.common import (timeit, report_rate, TempDir, setup_database,
+                               create_mount, basic_auth)
+from django.conf import settings
+from django.test.client import Client
+from webdav.util import basic_auth_cache
+
+
+def main():
+    setup_database()
+    with TempDir() as tmpdir:
+        create_mount(tmpdir)
+        file(os.path.join(tmpdir, "file.txt"), "w").write("hello\n")
+        client = Client()
+        auth = basic_auth()
+        get = lambda: client.get("/webdav/dav/file.txt", HTTP_AUTHORIZATION = auth)
+        assert get().status_code == 200
+        for label, ttl, stateless in (("no cache", 0, False),
+                                      ("cache", 60, False),
+                                      ("cache, stateless", 60, True)):
+            settings.WEBDAV_BASIC_AUTH_CACHE_TTL = ttl
+            settings.WEBDAV_BASIC_AUTH_STATELESS = stateless
+            basic_auth_cache.clear()
+            report_rate(label, timeit(get, 50))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+"""
+Shared setup for the django-webdav benchmark scripts.
+
+Run any benchmark from the repository root, e.g.
+    python -m benchmarks.mount_index
+"""
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "testserver.settings")
+from django.conf import settings
+settings.DATABASES["default"] = {"ENGINE": "django.db.backends.sqlite3",
+                                 "NAME": ":memory:"}
+settings.LOGGING["loggers"]["webdav"]["level"] = "WARNING"
+from django.utils.log import dictConfig
+dictConfig(settings.LOGGING)
+
+
+def timeit(funct, repeat = 1000):
+    start = time.time()
+    for i in xrange(repeat):
+        funct()
+    return (time.time() - start) / repeat
+
+
+def report(label, seconds):
+    sys.stdout.write("%-40s %12.2f us\n"%(label, seconds * 1000000.0))
+
+
+def report_rate(label, seconds, unit = "req/s"):
+    sys.stdout.write("%-40s %12.1f %s\n"%(label, 1.0 / seconds, unit))
+
+
+class TempDir(object):
+
+    def __enter__(self):
+        self.path = tempfile.mkdtemp()
+        return self.path
+
+    def __exit__(self, *args):
+        shutil.rmtree(self.path)
+
+
+def setup_database():
+    from django.core.management import call_command
+    call_command("syncdb", interactive = False, verbosity = 0)
+
+
+def create_mount(local_path, url_path = "/dav/", username = "bench",
+                 password = "bench", **kwargs):
+    from django.contrib.auth.models import User
+    from webdav.models import WebdavPath
+    user = User.objects.create_user(username, "", password)
+    kwargs.setdefault("quota", 0)
+    kwargs.setdefault("max_num_files", 0)
+    return WebdavPath.objects.create(url_path = url_path, local_path = local_path,
+                                     owner = user, **kwargs)
+
+
+def basic_auth(username = "bench", password = "bench"):
+    return "Basic %s"%("%s:%s"%(username, password)).encode("base64").strip()
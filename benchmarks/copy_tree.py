@@ -0,0 +1,60 @@
+"""
+COPY of a directory tree of small files with each copy method, serially
+and with a thread pool, plus one large file.
+"""
+import os
+import sys
+import time
+import shutil
+from benchmarks.common import TempDir
+from django.conf import settings
+from webdav.fileops import copy_tree, copy_file, COPY_METHODS
+
+
+def make_tree(path, dirs, files, size):
+    data = "x" * size
+    for i in xrange(dirs):
+        dirpath = os.path.join(path, "d%d"%i)
+        os.mkdir(dirpath)
+        for j in xrange(files):
+            f = file(os.path.join(dirpath, "f%d"%j), "w")
+            f.write(data)
+            f.close()
+
+
+def main(dirs = 20, files = 100, megabytes = 256):
+    with TempDir() as tmpdir:
+        src = os.path.join(tmpdir, "src")
+        os.mkdir(src)
+        make_tree(src, dirs, files, 4096)
+        dst = os.path.join(tmpdir, "dst")
+        start = time.time()
+        shutil.copytree(src, dst)
+        sys.stdout.write("%-40s %10.3f s\n"%("shutil.copytree", time.time() - start))
+        for method in COPY_METHODS:
+            for workers in (1, 4, 8):
+                shutil.rmtree(dst)
+                settings.WEBDAV_COPY_WORKERS = workers
+                start = time.time()
+                assert not copy_tree(src, dst, methods = [method])
+                sys.stdout.write("%-40s %10.3f s\n"%(
+                        "%s, %d workers"%(method, workers), time.time() - start))
+        big = os.path.join(tmpdir, "big")
+        f = file(big, "w")
+        for i in xrange(megabytes):
+            f.write("x" * (1024 * 1024))
+        f.close()
+        start = time.time()
+        shutil.copy(big, big + ".shutil")
+        sys.stdout.write("%-40s %10.1f MB/s\n"%(
+                "shutil.copy %d MB"%megabytes, megabytes / (time.time() - start)))
+        for method in COPY_METHODS:
+            start = time.time()
+            used = copy_file(big, big + ".copy", [method])
+            sys.stdout.write("%-40s %10.1f MB/s\n"%(
+                    "%s %d MB (%s)"%(method, megabytes, used),
+                    megabytes / (time.time() - start)))
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,46 @@
+"""
+Parse throughput of PROPFIND request bodies with the old minidom based
+Elem.from_xml compared to the expat based parser.
+"""
+from xml.dom import minidom as dom
+from benchmarks.common import timeit, report, report_rate
+from webdav.util import Elem
+
+
+def old_from_node(node):
+    if node.nodeType == node.ELEMENT_NODE:
+        elem = Elem(node.tagName)
+        for cnode in node.childNodes:
+            if cnode.nodeType == node.ELEMENT_NODE:
+                elem.children.append(old_from_node(cnode))
+            elif cnode.nodeType in (node.TEXT_NODE, node.CDATA_SECTION_NODE):
+                if cnode.data.strip():
+                    elem.children.append(cnode.data.strip())
+        return elem
+    return None
+
+
+def old_from_xml(xml):
+    return old_from_node(dom.parseString(xml).documentElement)
+
+
+def body(count):
+    props = "".join("<x:prop%d xmlns:x=\"urn:example\"/>"%i for i in xrange(count))
+    return ("<?xml version=\"1.0\" encoding=\"utf-8\"?><D:propfind xmlns:D=\"DAV:\">"
+            "<D:prop><D:getcontentlength/><D:getlastmodified/>%s</D:prop>"
+            "</D:propfind>"%props)
+
+
+def main():
+    for count in (0, 100, 1000):
+        xml = body(count)
+        repeat = max(10, 20000 / (count + 1))
+        old = timeit(lambda: old_from_xml(xml), repeat)
+        new = timeit(lambda: Elem.from_xml(xml), repeat)
+        report("minidom, %d bytes"%len(xml), old)
+        report("expat, %d bytes"%len(xml), new)
+        report_rate("expat throughput", new * 1000000.0 / len(xml), "MB/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,48 @@
+"""
+Serializing a large multistatus Elem tree with the old recursive string
+concatenation compared to Elem.get_xml.
+"""
+from benchmarks.common import timeit, report
+from webdav.util import Elem
+
+
+def old_get_xml(self):
+    s = u"<%s"%self.name
+    for k, v in self.attributes.items():
+        s += u" %s=\"%s\""%(k, v)
+    s += u">"
+    for child in self.children:
+        if hasattr(child, "get_xml"):
+            s += old_get_xml(child)
+        else:
+            s += unicode(child)
+    s += u"</%s>"%self.name
+    return unicode(s)
+
+
+def build(count):
+    multistatus = Elem("multistatus", xmlns = "DAV:")
+    for i in xrange(count):
+        response = multistatus.add_child(Elem("response"))
+        response.add_child(Elem("href")).add_child(u"/dav/file%06d.txt"%i)
+        propstat = response.add_child(Elem("propstat"))
+        prop = propstat.add_child(Elem("prop"))
+        prop.add_child(Elem("getcontentlength")).add_child(u"%d"%i)
+        prop.add_child(Elem("getlastmodified")).add_child(u"Mon, 01 Oct 2012 12:00:00")
+        prop.add_child(Elem("resourcetype"))
+        propstat.add_child(Elem("status")).add_child(u"HTTP/1.1 200 OK")
+    return multistatus
+
+
+def main():
+    for count in (100, 1000, 10000):
+        tree = build(count)
+        repeat = max(1, 10000 / count)
+        report("old get_xml, %d responses"%count,
+               timeit(lambda: old_get_xml(tree), repeat))
+        report("get_xml, %d responses"%count,
+               timeit(lambda: tree.get_xml(), repeat))
+
+
+if __name__ == "__main__":
+    main()
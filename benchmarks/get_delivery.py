@@ -0,0 +1,60 @@
+"""
+GET throughput for a large file: the old line-by-line iteration of the file
+object, streaming with different buffer sizes and proxy offload.
+"""
+import os
+import sys
+import time
+from benchmarks.common import TempDir, setup_database, create_mount, basic_auth
+from django.conf import settings
+from django.test.client import Client
+
+
+def consume(iterable):
+    size = 0
+    for chunk in iterable:
+        size += len(chunk)
+    return size
+
+
+def report_throughput(label, size, seconds):
+    sys.stdout.write("%-40s %10.1f MB/s\n"%(label, size / seconds / 1000000.0))
+
+
+def main(megabytes = 256):
+    setup_database()
+    with TempDir() as tmpdir:
+        wdp = create_mount(tmpdir)
+        path = os.path.join(tmpdir, "big.bin")
+        f = file(path, "wb")
+        block = os.urandom(1024 * 1024)
+        for i in xrange(megabytes):
+            f.write(block)
+        f.close()
+        size = megabytes * 1024 * 1024
+        client = Client()
+        auth = basic_auth()
+
+        start = time.time()
+        assert consume(file(path, "rb")) == size
+        report_throughput("old: iterate file object", size, time.time() - start)
+
+        for bufsize in (8 * 1024, 64 * 1024, 1024 * 1024):
+            settings.WEBDAV_DELIVERY_BUFFER_SIZE = bufsize
+            start = time.time()
+            response = client.get("/webdav/dav/big.bin", HTTP_AUTHORIZATION = auth)
+            assert consume(response) == size
+            report_throughput("stream, %d kB buffer"%(bufsize / 1024),
+                              size, time.time() - start)
+
+        wdp.delivery = "x-accel-redirect"
+        wdp.save()
+        start = time.time()
+        response = client.get("/webdav/dav/big.bin", HTTP_AUTHORIZATION = auth)
+        consume(response)
+        sys.stdout.write("%-40s %10.3f ms in Django\n"%(
+                "x-accel-redirect", (time.time() - start) * 1000))
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
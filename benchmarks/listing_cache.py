@@ -0,0 +1,50 @@
+"""
+Repeated PROPFIND Depth:1 on one directory, as Finder and Explorer send
+while a window is open, with and without the listing cache.
+"""
+import os
+import sys
+from benchmarks.common import TempDir, setup_database, create_mount, basic_auth
+from benchmarks.common import timeit, report
+from django.conf import settings
+from django.test.client import Client, FakePayload
+from webdav.util import listing_cache
+
+BODY = ("<?xml version=\"1.0\" encoding=\"utf-8\"?><propfind xmlns=\"DAV:\">"
+        "<prop><getcontentlength/><getlastmodified/><getetag/><resourcetype/>"
+        "</prop></propfind>")
+
+
+def propfind(client, path):
+    response = client.request(**{"REQUEST_METHOD": "PROPFIND",
+                                 "PATH_INFO": path,
+                                 "CONTENT_LENGTH": len(BODY),
+                                 "CONTENT_TYPE": "text/xml",
+                                 "HTTP_DEPTH": "1",
+                                 "HTTP_AUTHORIZATION": basic_auth(),
+                                 "wsgi.input": FakePayload(BODY)})
+    return "".join(response)
+
+
+def main(count = 1000, repeat = 200):
+    setup_database()
+    client = Client()
+    with TempDir() as tmpdir:
+        create_mount(tmpdir)
+        dirpath = os.path.join(tmpdir, "folder")
+        os.mkdir(dirpath)
+        for i in xrange(count):
+            file(os.path.join(dirpath, "file%05d.txt"%i), "w").close()
+        for size in (0, 100000):
+            settings.WEBDAV_LISTING_CACHE_SIZE = size
+            listing_cache.invalidate()
+            report("propfind %d entries, cache %s"%(count, size and "on" or "off"),
+                   timeit(lambda: propfind(client, "/webdav/dav/folder/"), repeat))
+        stats = listing_cache.stats()
+        sys.stdout.write("%-40s %12.1f %%\n"%("hit rate", stats["hit_rate"] * 100))
+        report("listing on a hit", stats["hit_latency"])
+        report("listing on a miss", stats["miss_latency"])
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
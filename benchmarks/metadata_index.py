@@ -0,0 +1,70 @@
+"""
+PROPFIND Depth:1 on one directory and a quota scan of the whole mount,
+from disk and from the metadata index, on a mount of a million files
+spread over directories of 1000.
+"""
+import os
+import sys
+import time
+from benchmarks.common import TempDir, setup_database, create_mount, basic_auth
+from benchmarks.common import timeit, report
+from django.test.client import Client, FakePayload
+from webdav.models import WebdavPath, MetadataEntry, mount_index
+from webdav.util import get_used_quota
+from webdav import metadata
+
+BODY = ("<?xml version=\"1.0\" encoding=\"utf-8\"?><propfind xmlns=\"DAV:\">"
+        "<prop><getcontentlength/><getlastmodified/><getetag/><resourcetype/>"
+        "</prop></propfind>")
+
+
+def propfind(client, path):
+    response = client.request(**{"REQUEST_METHOD": "PROPFIND",
+                                 "PATH_INFO": path,
+                                 "CONTENT_LENGTH": len(BODY),
+                                 "CONTENT_TYPE": "text/xml",
+                                 "HTTP_DEPTH": "1",
+                                 "HTTP_AUTHORIZATION": basic_auth(),
+                                 "wsgi.input": FakePayload(BODY)})
+    return "".join(response)
+
+
+def set_indexed(wdp, indexed):
+    # update() skips the post_save signal that would mark the index cold
+    WebdavPath.objects.filter(pk = wdp.pk).update(indexed = indexed)
+    wdp.indexed = indexed
+    mount_index.invalidate()
+
+
+def main(count = 1000000, per_dir = 1000):
+    setup_database()
+    client = Client()
+    with TempDir() as tmpdir:
+        wdp = create_mount(tmpdir)
+        start = time.time()
+        for i in xrange(count / per_dir):
+            dirpath = os.path.join(tmpdir, "d%d"%i)
+            os.mkdir(dirpath)
+            for j in xrange(per_dir):
+                file(os.path.join(dirpath, "f%d"%j), "w").close()
+        sys.stdout.write("%-40s %10.1f s\n"%("created %d files"%count, time.time() - start))
+        start = time.time()
+        set_indexed(wdp, True)
+        metadata.reconcile(wdp)
+        sys.stdout.write("%-40s %10.1f s\n"%("reconcile", time.time() - start))
+        repeat = 20
+        for indexed in (False, True):
+            set_indexed(wdp, indexed)
+            label = indexed and "index" or "disk"
+            # the page cache is warm for both, as it would be on a busy server
+            report("propfind depth 1, %s"%label,
+                   timeit(lambda: propfind(client, "/webdav/dav/d0/"), repeat))
+            if indexed:
+                scan = lambda: MetadataEntry.get_usage(wdp, wdp.local_path)
+            else:
+                scan = lambda: get_used_quota(wdp.local_path)
+            report("quota scan, %s"%label, timeit(scan, 3))
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
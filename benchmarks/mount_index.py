@@ -0,0 +1,40 @@
+"""
+Lookup time of WebdavPath.get_match_path_to_dir against the number of mounts,
+comparing the old full table scan with the prefix index.
+"""
+import os
+from benchmarks.common import timeit, report, TempDir
+from webdav.models import WebdavPath, MountIndex
+
+
+def table_scan(webdav_paths, path):
+    found = []
+    for wdp in webdav_paths:
+        if (path.startswith(os.path.normpath(wdp.url_path))
+            and os.path.isdir(wdp.local_path)):
+            found.append(wdp)
+    if found:
+        found.sort(lambda a, b: cmp(len(a.url_path), len(b.url_path)))
+        return found[-1]
+    return None
+
+
+def main():
+    with TempDir() as tmpdir:
+        for count in (10, 100, 1000, 5000):
+            webdav_paths = [WebdavPath(url_path = "/mount%d/"%i,
+                                       local_path = tmpdir)
+                            for i in xrange(count)]
+            index = MountIndex()
+            index.load(webdav_paths)
+            path = "/mount%d/some/dir"%(count - 1)
+            assert table_scan(webdav_paths, path) is index.lookup(path)
+            repeat = max(10, 10000 / count)
+            report("table scan, %d mounts"%count,
+                   timeit(lambda: table_scan(webdav_paths, path), repeat))
+            report("prefix index, %d mounts"%count,
+                   timeit(lambda: index.lookup(path), 10000))
+
+
+if __name__ == "__main__":
+    main()
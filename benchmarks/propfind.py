@@ -0,0 +1,65 @@
+"""
+PROPFIND on a directory with 100k entries: time to first byte, total time
+and peak memory when streaming the response compared to buffering all of it
+as the handler used to.
+"""
+import os
+import sys
+import time
+import resource
+from benchmarks.common import TempDir, setup_database, create_mount, basic_auth
+from django.test.client import Client, FakePayload
+
+BODY = ("<?xml version=\"1.0\" encoding=\"utf-8\"?><propfind xmlns=\"DAV:\">"
+        "<prop><getcontentlength/><getlastmodified/><resourcetype/></prop>"
+        "</propfind>")
+
+
+def propfind(client, path):
+    return client.request(**{"REQUEST_METHOD": "PROPFIND",
+                             "PATH_INFO": path,
+                             "CONTENT_LENGTH": len(BODY),
+                             "CONTENT_TYPE": "text/xml",
+                             "HTTP_AUTHORIZATION": basic_auth(),
+                             "wsgi.input": FakePayload(BODY)})
+
+
+def run(label, path, buffered):
+    pid = os.fork()
+    if pid:
+        os.waitpid(pid, 0)
+        return
+    client = Client()
+    base_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.time()
+    response = propfind(client, path)
+    chunks = iter(response)
+    size = len(chunks.next())
+    first = time.time() - start
+    if buffered:
+        size += len("".join(chunks))
+    else:
+        for chunk in chunks:
+            size += len(chunk)
+    total = time.time() - start
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - base_rss
+    sys.stdout.write("%-12s first byte %8.3f s, total %8.3f s, %d bytes, "
+                     "peak rss +%d kB\n"%(label, first, total, size, rss))
+    sys.stdout.flush()
+    os._exit(0)
+
+
+def main(count = 100000):
+    setup_database()
+    with TempDir() as tmpdir:
+        create_mount(tmpdir)
+        bigdir = os.path.join(tmpdir, "big")
+        os.mkdir(bigdir)
+        for i in xrange(count):
+            file(os.path.join(bigdir, "file%06d.txt"%i), "w").close()
+        run("streamed", "/webdav/dav/big/", False)
+        run("buffered", "/webdav/dav/big/", True)
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,41 @@
+"""
+PUT upload throughput with the old 1 kB read size compared to larger
+buffers, with and without fsync.
+"""
+import sys
+import time
+from benchmarks.common import TempDir, setup_database, create_mount, basic_auth
+from django.conf import settings
+from django.test.client import Client, FakePayload
+
+
+def put(client, path, data):
+    return client.request(**{"REQUEST_METHOD": "PUT",
+                             "PATH_INFO": path,
+                             "CONTENT_LENGTH": len(data),
+                             "CONTENT_TYPE": "application/octet-stream",
+                             "HTTP_AUTHORIZATION": basic_auth(),
+                             "wsgi.input": FakePayload(data)})
+
+
+def main(megabytes = 64):
+    setup_database()
+    data = "x" * (megabytes * 1024 * 1024)
+    with TempDir() as tmpdir:
+        create_mount(tmpdir)
+        client = Client()
+        for bufsize, fsync in ((1024, False), (64 * 1024, False),
+                               (256 * 1024, False), (1024 * 1024, False),
+                               (1024 * 1024, True)):
+            settings.WEBDAV_UPLOAD_BUFFER_SIZE = bufsize
+            settings.WEBDAV_UPLOAD_FSYNC = fsync
+            start = time.time()
+            assert put(client, "/webdav/dav/upload.bin", data).status_code == 201
+            seconds = time.time() - start
+            sys.stdout.write("%-40s %10.1f MB/s\n"%(
+                    "%d kB buffer%s"%(bufsize / 1024, fsync and ", fsync" or ""),
+                    len(data) / seconds / 1000000.0))
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,249 @@
+"""
+Copyright 2012 Peter Gebauer
+Licensed under GNU GPLv3
+
+Ways of sending file contents for GET requests. Besides streaming from
+Python the file can be handed to the front end server (X-Accel-Redirect,
+X-Sendfile) or to the WSGI server's wsgi.file_wrapper, which may send it
+with sendfile(2); the latter needs webdav.wsgi.FileWrapperMiddleware
+around the application since Django 1.4 can't pass the file through.
+Part of the django-webdav project.
+"""
+import os
+import logging
+import mimetypes
+import urllib
+from django.conf import settings
+from django.http import HttpResponse
+from django.utils.http import http_date
+from webdav.util import get_etag
+
+logger = logging.getLogger("webdav")
+
+
+def get_content_type(path):
+    content_type, encoding = mimetypes.guess_type(path)
+    return content_type or "application/octet-stream"
+
+
+def iter_file(fsock, bufsize, length = None):
+    """
+    Yields the contents of fsock in bufsize chunks, at most length bytes if
+    given, and closes it at the end.
+    """
+    try:
+        while length is None or length > 0:
+            if length is None:
+                buf = fsock.read(bufsize)
+            else:
+                buf = fsock.read(min(bufsize, length))
+                length -= len(buf)
+            if not buf:
+                break
+            yield buf
+    finally:
+        fsock.close()
+
+
+def parse_range(header, size):
+    """
+    Parses a Range header into a list of inclusive (first, last) byte
+    positions within size. Returns None if the header is malformed or asks
+    for too many ranges, in which case it must be ignored, and an empty
+    list if none of the ranges can be satisfied.
+    """
+    units, sep, specs = header.partition("=")
+    if units.strip().lower() != "bytes" or not sep:
+        return None
+    specs = [spec.strip() for spec in specs.split(",") if spec.strip()]
+    if not specs or len(specs) > getattr(settings, "WEBDAV_MAX_RANGES", 16):
+        return None
+    ranges = []
+    for spec in specs:
+        first, sep, last = spec.partition("-")
+        try:
+            if not sep:
+                return None
+            elif not first:
+                length = int(last)
+                if length <= 0:
+                    continue
+                ranges.append((max(0, size - length), size - 1))
+            else:
+                first = int(first)
+                if last:
+                    last = int(last)
+                    if last < first:
+                        return None
+                else:
+                    last = size - 1
+                if first < size:
+                    ranges.append((first, min(last, size - 1)))
+        except ValueError:
+            return None
+    return ranges
+
+
+class Delivery(object):
+    """
+    Base class, response() returns the HttpResponse carrying the file.
+    """
+
+    def response(self, request, lcpath, st):
+        raise NotImplementedError()
+
+
+class StreamDelivery(Delivery):
+    """
+    Reads the file in Python, WEBDAV_DELIVERY_BUFFER_SIZE bytes at a time.
+    Range requests are answered with 206 Partial Content, several ranges
+    as multipart/byteranges.
+    """
+
+    def get_bufsize(self):
+        return getattr(settings, "WEBDAV_DELIVERY_BUFFER_SIZE", 64 * 1024)
+
+    def get_ranges(self, request, st):
+        header = request.META.get("HTTP_RANGE")
+        if not header:
+            return None
+        if_range = request.META.get("HTTP_IF_RANGE")
+        if if_range:
+            if_range = if_range.strip()
+            if if_range != get_etag(st) and if_range != http_date(st.st_mtime):
+                return None
+        return parse_range(header, st.st_size)
+
+    def response(self, request, lcpath, st):
+        content_type = get_content_type(lcpath)
+        ranges = self.get_ranges(request, st)
+        if ranges is not None and not ranges:
+            response = HttpResponse("416 Requested Range Not Satisfiable",
+                                    status = 416, content_type = "text/plain")
+            response["Content-Range"] = "bytes */%d"%st.st_size
+            return response
+        fsock = file(lcpath, "rb")
+        if not ranges:
+            response = self.get_full_response(fsock, content_type)
+            response["Content-Length"] = str(st.st_size)
+        elif len(ranges) == 1:
+            first, last = ranges[0]
+            fsock.seek(first)
+            response = HttpResponse(iter_file(fsock, self.get_bufsize(), last - first + 1),
+                                    status = 206, content_type = content_type)
+            response["Content-Range"] = "bytes %d-%d/%d"%(first, last, st.st_size)
+            response["Content-Length"] = str(last - first + 1)
+        else:
+            boundary = os.urandom(16).encode("hex")
+            headers = ["\r\n--%s\r\nContent-Type: %s\r\nContent-Range: bytes %d-%d/%d\r\n\r\n"%(
+                    boundary, content_type, first, last, st.st_size)
+                       for first, last in ranges]
+            trailer = "\r\n--%s--\r\n"%boundary
+            length = (sum(len(h) for h in headers) + len(trailer)
+                      + sum(last - first + 1 for first, last in ranges))
+            response = HttpResponse(self.iter_multipart(fsock, ranges, headers, trailer),
+                                    status = 206, content_type =
+                                    "multipart/byteranges; boundary=%s"%boundary)
+            response["Content-Length"] = str(length)
+        response["Accept-Ranges"] = "bytes"
+        return response
+
+    def get_full_response(self, fsock, content_type):
+        return HttpResponse(iter_file(fsock, self.get_bufsize()),
+                            content_type = content_type)
+
+    def iter_multipart(self, fsock, ranges, headers, trailer):
+        try:
+            for (first, last), header in zip(ranges, headers):
+                yield header
+                fsock.seek(first)
+                length = last - first + 1
+                while length > 0:
+                    buf = fsock.read(min(self.get_bufsize(), length))
+                    if not buf:
+                        break
+                    length -= len(buf)
+                    yield buf
+            yield trailer
+        finally:
+            fsock.close()
+
+
+class FileWrapperDelivery(StreamDelivery):
+    """
+    Streams like StreamDelivery, but whole files are also attached to the
+    response as file_to_stream, which FileWrapperMiddleware passes to the
+    WSGI server's wsgi.file_wrapper. Servers without one, or without the
+    middleware, get the Python iterator.
+    """
+
+    def get_full_response(self, fsock, content_type):
+        response = super(FileWrapperDelivery, self).get_full_response(fsock, content_type)
+        response.file_to_stream = fsock
+        return response
+
+
+class XAccelRedirectDelivery(Delivery):
+    """
+    Leaves sending the file to nginx. The file is redirected to
+    WEBDAV_X_ACCEL_REDIRECT_PREFIX followed by its local path, e.g. with
+    the default prefix:
+
+        location /webdav-internal/ { internal; alias /; }
+    """
+    HEADER = "X-Accel-Redirect"
+
+    def get_location(self, lcpath):
+        prefix = getattr(settings, "WEBDAV_X_ACCEL_REDIRECT_PREFIX",
+                         "/webdav-internal")
+        return urllib.quote(("%s%s"%(prefix.rstrip("/"), lcpath)).encode("utf-8"))
+
+    def response(self, request, lcpath, st):
+        response = HttpResponse("", content_type = get_content_type(lcpath))
+        response[self.HEADER] = self.get_location(lcpath)
+        return response
+
+
+class XSendfileDelivery(XAccelRedirectDelivery):
+    """
+    Leaves sending the file to Apache mod_xsendfile or lighttpd, which take
+    the absolute local path.
+    """
+    HEADER = "X-Sendfile"
+
+    def get_location(self, lcpath):
+        return lcpath.encode("utf-8")
+
+
+DELIVERY_STREAM = "stream"
+DELIVERY_FILE_WRAPPER = "file-wrapper"
+DELIVERY_X_ACCEL_REDIRECT = "x-accel-redirect"
+DELIVERY_X_SENDFILE = "x-sendfile"
+
+DELIVERY_CHOICES = (
+    (DELIVERY_STREAM, "Stream from Python"),
+    (DELIVERY_FILE_WRAPPER, "wsgi.file_wrapper (needs FileWrapperMiddleware)"),
+    (DELIVERY_X_ACCEL_REDIRECT, "X-Accel-Redirect (nginx)"),
+    (DELIVERY_X_SENDFILE, "X-Sendfile (Apache, lighttpd)"),
+    )
+
+DELIVERY_BACKENDS = {
+    DELIVERY_STREAM: StreamDelivery(),
+    DELIVERY_FILE_WRAPPER: FileWrapperDelivery(),
+    DELIVERY_X_ACCEL_REDIRECT: XAccelRedirectDelivery(),
+    DELIVERY_X_SENDFILE: XSendfileDelivery(),
+    }
+
+
+def get_delivery(webdavpath):
+    """
+    Returns the backend configured for webdavpath, falling back to the
+    WEBDAV_DELIVERY setting and then to streaming.
+    """
+    name = (getattr(webdavpath, "delivery", None)
+            or getattr(settings, "WEBDAV_DELIVERY", DELIVERY_STREAM))
+    backend = DELIVERY_BACKENDS.get(name)
+    if not backend:
+        logger.warning("unknown delivery '%s', streaming instead"%name)
+        backend = DELIVERY_BACKENDS[DELIVERY_STREAM]
+    return backend
@@ -0,0 +1,376 @@
+"""
+Copyright 2012 Peter Gebauer
+Licensed under GNU GPLv3
+
+Copying files and directory trees for the COPY and MOVE methods.
+Part of the django-webdav project.
+"""
+import os
+import sys
+import stat
+import time
+import errno
+import shutil
+import threading
+import ctypes
+import ctypes.util
+import logging
+import tempfile
+from multiprocessing.pool import ThreadPool
+from django.conf import settings
+from webdav.util import scandir, is_hidden, UPLOAD_TEMP_PREFIX, TRASH_DIRNAME
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+logger = logging.getLogger("webdav")
+
+# _IOW(0x94, 9, int) from linux/fs.h
+FICLONE = 0x40049409
+
+COPY_METHODS = ("reflink", "copy_file_range", "sendfile", "buffered")
+
+# errors meaning "not here, try the next method" rather than a failed copy
+FALLBACK_ERRNOS = set([errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.ENOTTY,
+                       errno.EOPNOTSUPP, errno.EBADF, errno.EPERM])
+
+# from linux/fcntl.h and linux/fs.h
+AT_FDCWD = -100
+RENAME_NOREPLACE = 1
+
+_copy_file_range = None
+_sendfile = None
+_renameat2 = None
+if sys.platform.startswith("linux"):
+    try:
+        _libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno = True)
+    except OSError:
+        _libc = None
+    if _libc is not None:
+        _copy_file_range = getattr(_libc, "copy_file_range", None)
+        if _copy_file_range is not None:
+            _copy_file_range.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_int,
+                                         ctypes.c_void_p, ctypes.c_size_t, ctypes.c_uint]
+            _copy_file_range.restype = ctypes.c_ssize_t
+        _sendfile = getattr(_libc, "sendfile", None)
+        if _sendfile is not None:
+            _sendfile.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_void_p,
+                                  ctypes.c_size_t]
+            _sendfile.restype = ctypes.c_ssize_t
+        _renameat2 = getattr(_libc, "renameat2", None)
+        if _renameat2 is not None:
+            _renameat2.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_int,
+                                   ctypes.c_char_p, ctypes.c_uint]
+            _renameat2.restype = ctypes.c_int
+
+
+def get_copy_methods():
+    return getattr(settings, "WEBDAV_COPY_METHODS", COPY_METHODS)
+
+
+def clone_fd(fdin, fdout):
+    if fcntl is None or not sys.platform.startswith("linux"):
+        raise OSError(errno.ENOTTY, "reflinks not supported")
+    try:
+        fcntl.ioctl(fdout, FICLONE, fdin)
+    except IOError, ioe:
+        raise OSError(ioe.errno, ioe.strerror)
+
+
+def rename_noreplace(src, dst):
+    """
+    Renames src to dst, raising OSError with EEXIST instead of replacing
+    dst if it exists. Atomic where renameat2(2) is available, otherwise
+    dst is checked just before an ordinary rename.
+    """
+    if _renameat2 is not None:
+        encoding = sys.getfilesystemencoding()
+        if isinstance(src, unicode):
+            src = src.encode(encoding)
+        if isinstance(dst, unicode):
+            dst = dst.encode(encoding)
+        if _renameat2(AT_FDCWD, src, AT_FDCWD, dst, RENAME_NOREPLACE) == 0:
+            return
+        err = ctypes.get_errno()
+        if err not in (errno.ENOSYS, errno.EINVAL):
+            raise OSError(err, os.strerror(err), dst)
+    if os.path.lexists(dst):
+        raise OSError(errno.EEXIST, os.strerror(errno.EEXIST), dst)
+    os.rename(src, dst)
+
+
+def kernel_copy(call, fdin, fdout, size):
+    """
+    Calls call(fdin, fdout, count) until size bytes were copied or it
+    returns 0. Both descriptors' offsets advance, so another method can
+    pick up where this one stopped.
+    """
+    copied = 0
+    while copied < size:
+        count = call(fdin, fdout, min(size - copied, 1 << 30))
+        if count < 0:
+            err = ctypes.get_errno()
+            if err == errno.EINTR:
+                continue
+            raise OSError(err, os.strerror(err))
+        if count == 0:
+            break
+        copied += count
+    return copied
+
+
+def buffered_copy(fdin, fdout, bufsize):
+    while True:
+        buf = os.read(fdin, bufsize)
+        if not buf:
+            break
+        while buf:
+            buf = buf[os.write(fdout, buf):]
+
+
+def copy_fd(fdin, fdout, size, methods = None):
+    """
+    Copies the contents of fdin to the empty fdout with the first of
+    methods that works here, falling back to the next one when the kernel
+    or filesystem doesn't support it. Returns the name of the method that
+    finished the copy.
+    """
+    if methods is None:
+        methods = get_copy_methods()
+    copied = 0
+    for method in methods:
+        try:
+            if method == "reflink":
+                if size and not copied:
+                    clone_fd(fdin, fdout)
+                    return method
+            elif method == "copy_file_range" and _copy_file_range is not None:
+                copied += kernel_copy(lambda i, o, n: _copy_file_range(i, None, o, None, n, 0),
+                                      fdin, fdout, size - copied)
+                if copied >= size:
+                    return method
+            elif method == "sendfile" and _sendfile is not None:
+                copied += kernel_copy(lambda i, o, n: _sendfile(o, i, None, n),
+                                      fdin, fdout, size - copied)
+                if copied >= size:
+                    return method
+        except OSError, ose:
+            if ose.errno not in FALLBACK_ERRNOS:
+                raise
+            logger.debug("%s not available; %s"%(method, ose))
+    buffered_copy(fdin, fdout, getattr(settings, "WEBDAV_UPLOAD_BUFFER_SIZE", 256 * 1024))
+    return "buffered"
+
+
+def copy_file(src, dst, methods = None, replace = True):
+    """
+    Copies the file src with its permission bits to dst and returns the
+    name of the copy method used. With replace set dst is written to a
+    temporary file first and atomically replaces an existing file,
+    otherwise dst must not exist yet.
+    """
+    fdin = os.open(src, os.O_RDONLY)
+    try:
+        st = os.fstat(fdin)
+        if replace:
+            fdout, tmppath = tempfile.mkstemp(prefix = UPLOAD_TEMP_PREFIX,
+                                              dir = os.path.dirname(dst))
+        else:
+            fdout = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0600)
+            tmppath = dst
+        try:
+            try:
+                method = copy_fd(fdin, fdout, st.st_size, methods)
+                os.fchmod(fdout, stat.S_IMODE(st.st_mode))
+            finally:
+                os.close(fdout)
+            if replace:
+                os.rename(tmppath, dst)
+        except:
+            try:
+                os.remove(tmppath)
+            except OSError:
+                pass
+            raise
+    finally:
+        os.close(fdin)
+    return method
+
+
+def copy_tree(src, dst, recursive = True, skip = (), methods = None):
+    """
+    Copies the directory src to dst, which must not exist. Directories are
+    created first, then WEBDAV_COPY_WORKERS threads (default 4) copy the
+    files. Symbolic links, hidden names and names in skip are left out.
+    Only the directory itself is created unless recursive is set.
+
+    Returns a list of (destination path, error) for everything that could
+    not be copied, the rest of the tree is copied regardless.
+    """
+    errors = []
+    files = []
+    os.mkdir(dst)
+    os.chmod(dst, stat.S_IMODE(os.stat(src).st_mode))
+    stack = recursive and [(src, dst)] or []
+    while stack:
+        srcdir, dstdir = stack.pop()
+        try:
+            entries = list(scandir(srcdir))
+        except OSError, ose:
+            errors.append((dstdir, ose))
+            continue
+        for entry in entries:
+            if is_hidden(entry.name) or entry.name in skip or entry.is_symlink():
+                continue
+            dstpath = os.path.join(dstdir, entry.name)
+            if entry.is_dir(follow_symlinks = False):
+                try:
+                    os.mkdir(dstpath)
+                    st = entry.stat(follow_symlinks = False)
+                    os.chmod(dstpath, stat.S_IMODE(st.st_mode))
+                except OSError, ose:
+                    errors.append((dstpath, ose))
+                    continue
+                stack.append((entry.path, dstpath))
+            elif entry.is_file(follow_symlinks = False):
+                files.append((entry.path, dstpath))
+
+    def copy_one(item):
+        try:
+            copy_file(item[0], item[1], methods, False)
+        except (IOError, OSError), ioe:
+            return item[1], ioe
+        return None
+
+    workers = getattr(settings, "WEBDAV_COPY_WORKERS", 4)
+    if workers > 1 and len(files) > 1:
+        pool = ThreadPool(min(workers, len(files)))
+        try:
+            results = pool.imap_unordered(copy_one, files, 16)
+            errors.extend(error for error in results if error)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        errors.extend(error for error in map(copy_one, files) if error)
+    return errors
+
+
+def get_trash_dir(mount_path):
+    return os.path.join(mount_path, TRASH_DIRNAME)
+
+
+def move_to_trash(mount_path, path):
+    """
+    Renames path into the trash directory of the WebdavPath at mount_path
+    and returns its new name.
+    """
+    trash = get_trash_dir(mount_path)
+    try:
+        os.mkdir(trash, 0700)
+    except OSError, ose:
+        if ose.errno != errno.EEXIST:
+            raise
+    dst = os.path.join(trash, "%d-%s"%(time.time(), os.urandom(8).encode("hex")))
+    os.rename(path, dst)
+    return dst
+
+
+def empty_trash(mount_path):
+    """
+    Removes everything in the trash of mount_path and returns the number
+    of trashed resources removed.
+    """
+    trash = get_trash_dir(mount_path)
+    try:
+        names = os.listdir(trash)
+    except OSError:
+        return 0
+    for name in names:
+        path = os.path.join(trash, name)
+        if os.path.isdir(path) and not os.path.islink(path):
+            # another process may be emptying the same trash
+            shutil.rmtree(path, ignore_errors = True)
+        else:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        logger.debug("removed '%s' from trash"%path)
+    return len(names)
+
+
+class TrashReaper(object):
+    """
+    Empties trash directories in a background thread, started on first
+    use. With WEBDAV_TRASH_REAPER set to "command" no thread is started and
+    the webdav_empty_trash management command has to be run instead.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.event = threading.Event()
+        self.pending = set()
+        self.thread = None
+
+    def is_enabled(self):
+        return getattr(settings, "WEBDAV_TRASH_REAPER", "thread") == "thread"
+
+    def schedule(self, mount_path):
+        if not self.is_enabled():
+            return
+        self.lock.acquire()
+        try:
+            self.pending.add(mount_path)
+            if not self.thread or not self.thread.is_alive():
+                self.thread = threading.Thread(target = self.run,
+                                               name = "webdav-trash-reaper")
+                self.thread.daemon = True
+                self.thread.start()
+        finally:
+            self.lock.release()
+        self.event.set()
+
+    def recover(self, mount_paths):
+        """
+        Schedules trash left behind by an earlier process.
+        """
+        for mount_path in mount_paths:
+            if os.path.isdir(get_trash_dir(mount_path)):
+                self.schedule(mount_path)
+
+    def run(self):
+        while True:
+            self.event.wait()
+            self.lock.acquire()
+            try:
+                self.event.clear()
+                pending = self.pending
+                self.pending = set()
+            finally:
+                self.lock.release()
+            for mount_path in pending:
+                try:
+                    empty_trash(mount_path)
+                except Exception, e:
+                    logger.warning("could not empty trash of '%s'; %s"%(mount_path, e))
+
+
+reaper = TrashReaper()
+
+
+def remove_tree(mount_path, path):
+    """
+    Removes the directory path below the WebdavPath at mount_path. It is
+    renamed into the trash and left to the reaper, falling back to removing
+    it right away if it can't be renamed, e.g. across filesystems.
+    """
+    try:
+        move_to_trash(mount_path, path)
+    except OSError, ose:
+        logger.debug("could not trash '%s', removing it now; %s"%(path, ose))
+        shutil.rmtree(path)
+        return
+    reaper.schedule(mount_path)
@@ -0,0 +1,570 @@
+"""
+Copyright 2012 Peter Gebauer
+Licensed under GNU GPLv3
+
+Write locks for the LOCK and UNLOCK methods and the If header.
+Part of the django-webdav project.
+"""
+import os
+import re
+import time
+import uuid
+import urllib
+import urlparse
+import logging
+import threading
+from django.conf import settings
+from django.core.urlresolvers import resolve
+from django.http import Http404, HttpResponse, HttpResponseBadRequest
+from webdav.util import Elem, get_etag, HttpResponsePreconditionFailed
+from webdav.models import WebdavPath, WebdavLock
+
+logger = logging.getLogger("webdav")
+
+SCOPE_EXCLUSIVE = "exclusive"
+SCOPE_SHARED = "shared"
+DEPTH_INFINITY = "infinity"
+TOKEN_PREFIX = "opaquelocktoken:"
+
+
+class LockConflict(Exception):
+
+    def __init__(self, lock):
+        Exception.__init__(self, "conflicting lock '%s'"%lock.path)
+        self.lock = lock
+
+
+class Lock(object):
+    """
+    A write lock on path, a normalized URL path. A lock with depth
+    infinity also covers everything below path.
+    """
+
+    def __init__(self, token, path, scope, depth, owner, user_id, timeout,
+                 expires = None):
+        self.token = token
+        self.path = path
+        self.scope = scope
+        self.depth = depth
+        self.owner = owner
+        self.user_id = user_id
+        self.timeout = timeout
+        if expires is None:
+            expires = time.time() + timeout
+        self.expires = expires
+
+    def __repr__(self):
+        return "<Lock %s %s>"%(self.path, self.token)
+
+    def __eq__(self, other):
+        return isinstance(other, Lock) and other.token == self.token
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.token)
+
+    def is_expired(self, now = None):
+        return (now or time.time()) >= self.expires
+
+    def refresh(self, timeout):
+        self.timeout = timeout
+        self.expires = time.time() + timeout
+
+    def get_activelock(self):
+        activelock = Elem("activelock")
+        activelock.add_child(Elem("locktype", [Elem("write")]))
+        activelock.add_child(Elem("lockscope", [Elem(self.scope)]))
+        activelock.add_child(Elem("depth", [self.depth]))
+        if self.owner:
+            owner = Elem.from_xml(self.owner.encode("utf-8"))
+            if owner:
+                activelock.add_child(owner)
+        remaining = max(0, int(round(self.expires - time.time())))
+        activelock.add_child(Elem("timeout", ["Second-%d"%remaining]))
+        activelock.add_child(Elem("locktoken", [Elem("href", [self.token])]))
+        href = urllib.quote(self.path.encode("utf-8"))
+        activelock.add_child(Elem("lockroot", [Elem("href", [href])]))
+        return activelock
+
+
+def get_lock_path(path):
+    """
+    Normalizes a URL path, quoted or not, into the key locks are stored by.
+    """
+    if isinstance(path, str):
+        path = urllib.unquote(path).decode("utf-8")
+    return os.path.normpath("/" + path.lstrip("/"))
+
+
+def get_ancestors(path):
+    """
+    Yields path and then each of its parents up to "/".
+    """
+    yield path
+    while path != "/":
+        path = os.path.dirname(path)
+        yield path
+
+
+class LockIndex(object):
+    """
+    Locks indexed by path, so that the locks covering a path are found in
+    O(depth of the path). For every path the number of locks below it is
+    counted, finding those is only a scan when there are any.
+    """
+
+    def __init__(self, locks = ()):
+        self.by_path = {}
+        self.by_token = {}
+        self.below = {}
+        for lock in locks:
+            self.add(lock)
+
+    def __len__(self):
+        return len(self.by_token)
+
+    def add(self, lock):
+        self.by_path.setdefault(lock.path, {})[lock.token] = lock
+        self.by_token[lock.token] = lock
+        ancestors = get_ancestors(lock.path)
+        ancestors.next()
+        for ancestor in ancestors:
+            self.below[ancestor] = self.below.get(ancestor, 0) + 1
+
+    def remove(self, token):
+        lock = self.by_token.pop(token, None)
+        if not lock:
+            return None
+        locks = self.by_path[lock.path]
+        del locks[token]
+        if not locks:
+            del self.by_path[lock.path]
+        ancestors = get_ancestors(lock.path)
+        ancestors.next()
+        for ancestor in ancestors:
+            self.below[ancestor] -= 1
+            if not self.below[ancestor]:
+                del self.below[ancestor]
+        return lock
+
+    def get(self, token):
+        return self.by_token.get(token)
+
+    def get_covering(self, path, parent = False):
+        """
+        Returns the locks on path and the depth infinity locks on its
+        parents. With parent set also the depth 0 locks on its parent
+        collection, which protect the list of its members.
+        """
+        locks = []
+        for i, ancestor in enumerate(get_ancestors(path)):
+            for lock in self.by_path.get(ancestor, {}).values():
+                if i == 0 or lock.depth == DEPTH_INFINITY or (parent and i == 1):
+                    locks.append(lock)
+        return locks
+
+    def get_below(self, path):
+        if not self.below.get(path):
+            return []
+        prefix = path.rstrip("/") + "/"
+        return [lock for lock in self.by_token.values()
+                if lock.path.startswith(prefix)]
+
+
+class LocalLockBackend(object):
+    """
+    Keeps locks in memory. Only suitable when a single process serves all
+    WebDAV requests.
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.index = LockIndex()
+
+    def acquire(self):
+        self.lock.acquire()
+
+    def release(self):
+        self.lock.release()
+
+    def live(self, locks):
+        now = time.time()
+        live = []
+        for lock in locks:
+            if lock.is_expired(now):
+                self.remove(lock.token)
+            else:
+                live.append(lock)
+        return live
+
+    def get_covering(self, path, parent = False):
+        self.lock.acquire()
+        try:
+            return self.live(self.index.get_covering(path, parent))
+        finally:
+            self.lock.release()
+
+    def get_below(self, path):
+        self.lock.acquire()
+        try:
+            return self.live(self.index.get_below(path))
+        finally:
+            self.lock.release()
+
+    def get(self, token):
+        self.lock.acquire()
+        try:
+            locks = self.live(filter(None, [self.index.get(token)]))
+            return locks and locks[0] or None
+        finally:
+            self.lock.release()
+
+    def add(self, lock):
+        self.lock.acquire()
+        try:
+            self.index.add(lock)
+        finally:
+            self.lock.release()
+
+    def update(self, lock):
+        pass
+
+    def remove(self, token):
+        self.lock.acquire()
+        try:
+            return self.index.remove(token) is not None
+        finally:
+            self.lock.release()
+
+    def remove_tree(self, path):
+        self.lock.acquire()
+        try:
+            for lock in self.index.get_covering(path) + self.index.get_below(path):
+                if lock.path == path or lock.path.startswith(path.rstrip("/") + "/"):
+                    self.index.remove(lock.token)
+        finally:
+            self.lock.release()
+
+
+class DatabaseLockBackend(object):
+    """
+    Keeps locks in the WebdavLock table, shared by all processes. The
+    covering locks of a path are fetched with one indexed query.
+    """
+
+    def acquire(self):
+        pass
+
+    def release(self):
+        pass
+
+    def to_lock(self, row):
+        return Lock(row.token, row.path, row.scope, row.depth, row.owner,
+                    row.user_id, row.timeout, row.expires)
+
+    def live(self, rows):
+        now = time.time()
+        expired = [row.pk for row in rows if row.expires <= now]
+        if expired:
+            WebdavLock.objects.filter(pk__in = expired).delete()
+        return [self.to_lock(row) for row in rows if row.expires > now]
+
+    def get_covering(self, path, parent = False):
+        ancestors = list(get_ancestors(path))
+        parent_path = parent and len(ancestors) > 1 and ancestors[1] or None
+        locks = self.live(list(WebdavLock.objects.filter(path__in = ancestors)))
+        return [lock for lock in locks if lock.path in (path, parent_path)
+                or lock.depth == DEPTH_INFINITY]
+
+    def get_below(self, path):
+        prefix = path.rstrip("/") + "/"
+        return self.live(list(WebdavLock.objects.filter(path__startswith = prefix)))
+
+    def get(self, token):
+        locks = self.live(list(WebdavLock.objects.filter(token = token)))
+        return locks and locks[0] or None
+
+    def add(self, lock):
+        WebdavLock.objects.create(token = lock.token, path = lock.path,
+                                  scope = lock.scope, depth = lock.depth,
+                                  owner = lock.owner or "", user_id = lock.user_id,
+                                  timeout = lock.timeout, expires = lock.expires)
+
+    def update(self, lock):
+        WebdavLock.objects.filter(token = lock.token).update(
+            timeout = lock.timeout, expires = lock.expires)
+
+    def remove(self, token):
+        rows = WebdavLock.objects.filter(token = token)
+        if not rows.exists():
+            return False
+        rows.delete()
+        return True
+
+    def remove_tree(self, path):
+        prefix = path.rstrip("/") + "/"
+        WebdavLock.objects.filter(path = path).delete()
+        WebdavLock.objects.filter(path__startswith = prefix).delete()
+
+
+LOCK_BACKEND_LOCAL = "local"
+LOCK_BACKEND_DATABASE = "database"
+
+LOCK_BACKENDS = {
+    LOCK_BACKEND_LOCAL: LocalLockBackend(),
+    LOCK_BACKEND_DATABASE: DatabaseLockBackend(),
+    }
+
+
+def get_lock_backend():
+    """
+    Returns the backend named by WEBDAV_LOCK_BACKEND, "local" (default)
+    or "database".
+    """
+    name = getattr(settings, "WEBDAV_LOCK_BACKEND", LOCK_BACKEND_LOCAL)
+    backend = LOCK_BACKENDS.get(name)
+    if not backend:
+        logger.warning("unknown lock backend '%s', using local"%name)
+        backend = LOCK_BACKENDS[LOCK_BACKEND_LOCAL]
+    return backend
+
+
+def get_timeout(header):
+    """
+    Returns the lock timeout in seconds asked for by a Timeout header,
+    capped at WEBDAV_LOCK_MAX_TIMEOUT and WEBDAV_LOCK_TIMEOUT if missing.
+    """
+    timeout = getattr(settings, "WEBDAV_LOCK_TIMEOUT", 3600)
+    max_timeout = getattr(settings, "WEBDAV_LOCK_MAX_TIMEOUT", 7 * 24 * 3600)
+    for value in (header or "").split(","):
+        value = value.strip().lower()
+        if value == "infinite":
+            timeout = max_timeout
+            break
+        if value.startswith("second-") and value[7:].isdigit():
+            timeout = int(value[7:])
+            break
+    return max(1, min(timeout, max_timeout))
+
+
+def create_lock(path, scope, depth, owner, user_id, timeout):
+    """
+    Locks path and returns the new Lock, raises LockConflict if an
+    existing lock is in the way.
+    """
+    backend = get_lock_backend()
+    backend.acquire()
+    try:
+        existing = backend.get_covering(path)
+        if depth == DEPTH_INFINITY:
+            existing += backend.get_below(path)
+        for lock in existing:
+            if scope == SCOPE_EXCLUSIVE or lock.scope == SCOPE_EXCLUSIVE:
+                raise LockConflict(lock)
+        lock = Lock("%s%s"%(TOKEN_PREFIX, uuid.uuid4()), path, scope, depth,
+                    owner, user_id, timeout)
+        backend.add(lock)
+    finally:
+        backend.release()
+    logger.info("locked '%s' %s depth %s"%(path, scope, depth))
+    return lock
+
+
+def refresh_lock(lock, timeout):
+    lock.refresh(timeout)
+    get_lock_backend().update(lock)
+    return lock
+
+
+def remove_lock(token):
+    return get_lock_backend().remove(token)
+
+
+def remove_locks(path):
+    """
+    Drops the locks on path and below, after it was deleted or moved away.
+    """
+    get_lock_backend().remove_tree(get_lock_path(path))
+
+
+def get_lock_tree(path):
+    """
+    Returns a LockIndex of the locks covering path or below it, for
+    reporting the locks of many resources at once.
+    """
+    backend = get_lock_backend()
+    return LockIndex(backend.get_covering(path) + backend.get_below(path))
+
+
+_if_tokens = re.compile(r'\s*(<[^>]*>|\(|\)|\[(?:[^\]"]|"[^"]*")*\]|not\b)', re.I)
+
+
+def parse_if_header(header):
+    """
+    Parses an If header into a list of (URL path or None, conditions),
+    each condition being (negate, state token or None, entity tag or None).
+    Returns None if the header is malformed.
+    """
+    lists = []
+    tag = None
+    conditions = None
+    negate = False
+    pos = 0
+    header = header.strip()
+    while pos < len(header):
+        match = _if_tokens.match(header, pos)
+        if not match:
+            return None
+        token = match.group(1)
+        pos = match.end()
+        while pos < len(header) and header[pos].isspace():
+            pos += 1
+        if token == "(":
+            if conditions is not None:
+                return None
+            conditions = []
+        elif token == ")":
+            if not conditions or negate:
+                return None
+            lists.append((tag, conditions))
+            conditions = None
+        elif token.lower() == "not":
+            if conditions is None or negate:
+                return None
+            negate = True
+        elif token.startswith("<"):
+            if conditions is None:
+                tag = get_lock_path(urlparse.urlparse(token[1:-1]).path)
+            else:
+                conditions.append((negate, token[1:-1], None))
+                negate = False
+        else:
+            if conditions is None:
+                return None
+            conditions.append((negate, None, token[1:-1]))
+            negate = False
+    if conditions is not None or not lists:
+        return None
+    return lists
+
+
+def get_local_path(path):
+    """
+    Returns the local path of a URL path served by this app, or None.
+    """
+    try:
+        match = resolve(path)
+    except Http404:
+        return None
+    localpath = match.kwargs.get("localpath")
+    if localpath is None:
+        return None
+    found_path = WebdavPath.get_match_path_to_dir(localpath)
+    return found_path and found_path.get_local_path(localpath) or None
+
+
+def evaluate_if(lists, path, lcpath):
+    """
+    True if any of the lists holds. A list holds when each of its state
+    tokens is a current lock covering its resource and each entity tag
+    matches, or doesn't for conditions with Not.
+    """
+    backend = get_lock_backend()
+    for tag, conditions in lists:
+        resource = tag or path
+        resource_lcpath = resource == path and lcpath or get_local_path(resource)
+        tokens = None
+        etag = None
+        result = True
+        for negate, token, entity_tag in conditions:
+            if token is not None:
+                if tokens is None:
+                    tokens = set(lock.token for lock in backend.get_covering(resource))
+                holds = token in tokens
+            else:
+                if etag is None:
+                    try:
+                        etag = resource_lcpath and get_etag(os.stat(resource_lcpath)) or ""
+                    except OSError:
+                        etag = ""
+                holds = entity_tag == etag
+            if holds == negate:
+                result = False
+                break
+        if result:
+            return True
+    return False
+
+
+def get_submitted_tokens(lists):
+    return set(token for tag, conditions in lists
+               for negate, token, entity_tag in conditions
+               if token is not None and not negate)
+
+
+class HttpResponseLocked(HttpResponse):
+
+    def __init__(self, lock):
+        error = Elem("error", xmlns = "DAV:")
+        error.add_child(Elem("lock-token-submitted")).add_child(
+            Elem("href", [urllib.quote(lock.path.encode("utf-8"))]))
+        HttpResponse.__init__(self, error.get_xml(), status = 423,
+                              content_type = "text/xml")
+
+
+def check_if_header(request, lcpath):
+    """
+    Evaluates the If header, untagged lists against the request path and
+    its local path lcpath. Returns a 400 or 412 response and None, or None
+    and the set of submitted lock tokens.
+    """
+    header = request.META.get("HTTP_IF")
+    if not header:
+        return None, set()
+    lists = parse_if_header(header)
+    if lists is None:
+        return HttpResponseBadRequest("400 Bad If"), None
+    if not evaluate_if(lists, get_lock_path(request.path), lcpath):
+        return HttpResponsePreconditionFailed(), None
+    return None, get_submitted_tokens(lists)
+
+
+def check_locks(request, path, lcpath, recursive = False, parent = False,
+                submitted = None):
+    """
+    Checks that the request submitted the token of every lock on the URL
+    path (and below it with recursive set, and on its parent collection
+    with parent set) that keeps it from being written. Unless the tokens
+    submitted are given, from check_if_header for the request's own path,
+    the If header is evaluated first with lcpath the local path of path.
+    Returns a 400, 412 or 423 response, or None.
+    """
+    if submitted is None:
+        response, submitted = check_if_header(request, lcpath)
+        if response:
+            return response
+    path = get_lock_path(path)
+    backend = get_lock_backend()
+    locks = backend.get_covering(path, parent)
+    if recursive:
+        locks += backend.get_below(path)
+    if not locks:
+        return None
+    user_id = getattr(request.user, "id", None)
+    # each exclusive lock must be held, of the shared locks on a path one
+    shared = {}
+    for lock in locks:
+        held = lock.token in submitted and lock.user_id == user_id
+        if lock.scope == SCOPE_EXCLUSIVE:
+            if not held:
+                return HttpResponseLocked(lock)
+        elif held:
+            shared[lock.path] = None
+        elif lock.path not in shared:
+            shared[lock.path] = lock
+    for lock in shared.values():
+        if lock:
+            return HttpResponseLocked(lock)
+    return None
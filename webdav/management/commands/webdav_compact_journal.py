@@ -0,0 +1,19 @@
+"""
+Copyright 2012 Peter Gebauer
+Licensed under GNU GPLv3
+
+Compacts the change journal behind the sync-collection REPORT.
+Part of the django-webdav project.
+"""
+from django.core.management.base import NoArgsCommand
+from webdav.sync import compact
+
+
+class Command(NoArgsCommand):
+    help = ("Merges repeated changes to a path and removes journal entries "
+            "older than WEBDAV_SYNC_JOURNAL_MAX_AGE seconds.")
+
+    def handle_noargs(self, **options):
+        count = compact()
+        if int(options.get("verbosity", 1)) > 0:
+            self.stdout.write("removed %d journal entries\n"%count)
@@ -0,0 +1,24 @@
+"""
+Copyright 2012 Peter Gebauer
+Licensed under GNU GPLv3
+
+Removes collections deleted through WebDAV from the trash.
+Part of the django-webdav project.
+"""
+from django.core.management.base import BaseCommand
+from webdav.models import WebdavPath
+from webdav.fileops import empty_trash
+
+
+class Command(BaseCommand):
+    args = "[url_path ...]"
+    help = "Removes collections deleted through WebDAV from the trash."
+
+    def handle(self, *args, **options):
+        webdav_paths = WebdavPath.objects.all()
+        if args:
+            webdav_paths = webdav_paths.filter(url_path__in = args)
+        for local_path in set(wdp.local_path for wdp in webdav_paths):
+            count = empty_trash(local_path)
+            if int(options.get("verbosity", 1)) > 0:
+                self.stdout.write("%s: removed %d\n"%(local_path, count))
@@ -0,0 +1,18 @@
+"""
+Copyright 2012 Peter Gebauer
+Licensed under GNU GPLv3
+
+Discards resumable uploads that have not been touched for too long.
+Part of the django-webdav project.
+"""
+from django.core.management.base import NoArgsCommand
+from webdav.models import UploadSession
+
+
+class Command(NoArgsCommand):
+    help = "Discards resumable uploads older than WEBDAV_UPLOAD_EXPIRY seconds."
+
+    def handle_noargs(self, **options):
+        count = UploadSession.expire()
+        if int(options.get("verbosity", 1)) > 0:
+            self.stdout.write("discarded %d uploads\n"%count)
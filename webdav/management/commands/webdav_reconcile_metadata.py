@@ -0,0 +1,38 @@
+"""
+Copyright 2012 Peter Gebauer
+Licensed under GNU GPLv3
+
+Rebuilds the metadata index of indexed WebdavPaths from disk.
+Part of the django-webdav project.
+"""
+import time
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from webdav.models import WebdavPath
+from webdav import metadata
+
+
+class Command(BaseCommand):
+    args = "[url_path ...]"
+    help = "Rebuilds the metadata index of WebdavPaths that have indexed set."
+    option_list = BaseCommand.option_list + (
+        make_option("--interval", type = "int", default = 0,
+                    help = "Keep running and rebuild every INTERVAL seconds."),
+        )
+
+    def handle(self, *args, **options):
+        interval = options.get("interval")
+        while True:
+            self.reconcile(args, int(options.get("verbosity", 1)))
+            if interval <= 0:
+                break
+            time.sleep(interval)
+
+    def reconcile(self, url_paths, verbosity):
+        webdav_paths = WebdavPath.objects.filter(indexed = True)
+        if url_paths:
+            webdav_paths = webdav_paths.filter(url_path__in = url_paths)
+        for wdp in webdav_paths:
+            count = metadata.reconcile(wdp)
+            if verbosity > 0:
+                self.stdout.write("%s: %d entries\n"%(wdp.url_path, count))
@@ -0,0 +1,40 @@
+"""
+Copyright 2012 Peter Gebauer
+Licensed under GNU GPLv3
+
+Rescans the disk usage of WebdavPaths with a quota and corrects the ledger.
+Part of the django-webdav project.
+"""
+import time
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from webdav.models import WebdavPath, QuotaLedger
+
+
+class Command(BaseCommand):
+    args = "[url_path ...]"
+    help = "Rescans the disk usage of WebdavPaths that have a quota set."
+    option_list = BaseCommand.option_list + (
+        make_option("--interval", type = "int", default = 0,
+                    help = "Keep running and rescan every INTERVAL seconds."),
+        )
+
+    def handle(self, *args, **options):
+        interval = options.get("interval")
+        while True:
+            self.reconcile(args, int(options.get("verbosity", 1)))
+            if interval <= 0:
+                break
+            time.sleep(interval)
+
+    def reconcile(self, url_paths, verbosity):
+        webdav_paths = WebdavPath.objects.all()
+        if url_paths:
+            webdav_paths = webdav_paths.filter(url_path__in = url_paths)
+        for wdp in webdav_paths:
+            if wdp.quota <= 0 and wdp.max_num_files <= 0:
+                continue
+            ledger = QuotaLedger.reconcile(wdp)
+            if verbosity > 0:
+                self.stdout.write("%s: %d bytes, %d files\n"%(
+                        wdp.url_path, ledger.used_size, ledger.num_files))
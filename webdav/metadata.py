@@ -0,0 +1,228 @@
+"""
+Copyright 2012 Peter Gebauer
+Licensed under GNU GPLv3
+
+Metadata index of WebdavPaths with indexed set, so that listings and
+quota scans of large mounts don't have to walk the disk.
+Part of the django-webdav project.
+"""
+import os
+import stat
+import errno
+import logging
+from django.conf import settings
+from django.db import transaction
+from webdav.util import scandir, is_hidden, get_etag
+from webdav.models import MetadataEntry, MetadataScan
+
+logger = logging.getLogger("webdav")
+
+ENTRY_FIELDS = ("path", "is_dir", "size", "mtime", "ctime", "ino", "etag")
+
+
+class IndexedStat(object):
+    """
+    The parts of a stat result kept in the index, and the entity tag
+    computed from the real one, since mtime may lose precision in the
+    database.
+    """
+    st_dev = 0
+    st_nlink = 1
+
+    def __init__(self, is_dir, size, mtime, ctime, ino, etag):
+        self.st_mode = is_dir and stat.S_IFDIR or stat.S_IFREG
+        self.st_size = size
+        self.st_mtime = mtime
+        self.st_ctime = ctime
+        self.st_ino = ino
+        self.etag = etag
+
+
+class IndexedDirEntry(object):
+    """
+    DirEntry look-alike for a row of the index.
+    """
+
+    def __init__(self, path, is_dir, size, mtime, ctime, ino, etag):
+        self.name = os.path.basename(path)
+        self.path = path
+        self._lstat = IndexedStat(is_dir, size, mtime, ctime, ino, etag)
+
+    def stat(self, follow_symlinks = True):
+        return self._lstat
+
+    def is_symlink(self):
+        return False
+
+    def is_dir(self, follow_symlinks = True):
+        return stat.S_ISDIR(self._lstat.st_mode)
+
+    def is_file(self, follow_symlinks = True):
+        return stat.S_ISREG(self._lstat.st_mode)
+
+
+class DiskView(object):
+    """
+    lstat and scandir straight from the filesystem.
+    """
+
+    def lstat(self, path):
+        return os.lstat(path)
+
+    def scandir(self, path):
+        return scandir(path)
+
+
+class IndexView(object):
+    """
+    lstat and scandir answered from the index of a warm WebdavPath. Paths
+    the index doesn't know are looked up on disk instead.
+    """
+
+    def __init__(self, webdavpath):
+        self.webdavpath = webdavpath
+
+    def get_rows(self, **kwargs):
+        return MetadataEntry.objects.filter(webdavpath = self.webdavpath.pk,
+                                            **kwargs).values_list(*ENTRY_FIELDS)
+
+    def lstat(self, path):
+        rows = list(self.get_rows(path = path))
+        if not rows:
+            return os.lstat(path)
+        return IndexedStat(*rows[0][1:])
+
+    def scandir(self, path):
+        entries = [IndexedDirEntry(*row) for row in self.get_rows(parent = path)]
+        if not entries and not self.get_rows(path = path, is_dir = True).exists():
+            return scandir(path)
+        return entries
+
+
+disk_view = DiskView()
+
+
+def get_view(webdavpath):
+    if MetadataScan.is_warm(webdavpath):
+        return IndexView(webdavpath)
+    return disk_view
+
+
+def get_usage(webdavpath, path):
+    """
+    Bytes and number of files at or below path, from the index if the
+    WebdavPath is warm.
+    """
+    if MetadataScan.is_warm(webdavpath):
+        return MetadataEntry.get_usage(webdavpath, path)
+    return None
+
+
+def make_entry(webdavpath, path, st):
+    return MetadataEntry(webdavpath_id = webdavpath.pk, path = path,
+                         parent = os.path.dirname(path),
+                         is_dir = stat.S_ISDIR(st.st_mode),
+                         size = st.st_size, mtime = st.st_mtime,
+                         ctime = st.st_ctime, ino = st.st_ino, etag = get_etag(st))
+
+
+def add_tree(webdavpath, path):
+    """
+    Indexes path and, if it is a directory, everything below it, in bulk
+    inserts of WEBDAV_METADATA_BATCH_SIZE rows. Symbolic links, special
+    files and hidden names are left out as PROPFIND leaves them out.
+    Returns the number of rows added.
+    """
+    batch_size = getattr(settings, "WEBDAV_METADATA_BATCH_SIZE", 1000)
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return 0
+    if not stat.S_ISDIR(st.st_mode) and not stat.S_ISREG(st.st_mode):
+        return 0
+    batch = [make_entry(webdavpath, path, st)]
+    count = 0
+    stack = stat.S_ISDIR(st.st_mode) and [path] or []
+    while stack:
+        dirpath = stack.pop()
+        try:
+            entries = list(scandir(dirpath))
+        except OSError, ose:
+            logger.warning("could not index directory '%s'; %s"%(dirpath, ose))
+            continue
+        for entry in entries:
+            if is_hidden(entry.name):
+                continue
+            try:
+                st = entry.stat(follow_symlinks = False)
+            except OSError:
+                continue
+            if stat.S_ISDIR(st.st_mode):
+                stack.append(entry.path)
+            elif not stat.S_ISREG(st.st_mode):
+                continue
+            batch.append(make_entry(webdavpath, entry.path, st))
+            if len(batch) >= batch_size:
+                MetadataEntry.objects.bulk_create(batch)
+                count += len(batch)
+                batch = []
+    MetadataEntry.objects.bulk_create(batch)
+    return count + len(batch)
+
+
+def refresh(webdavpath, path):
+    """
+    Updates the row of path, which must not have been replaced, after its
+    modification time changed.
+    """
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return
+    MetadataEntry.objects.filter(webdavpath = webdavpath.pk, path = path).update(
+        size = st.st_size, mtime = st.st_mtime, ctime = st.st_ctime,
+        etag = get_etag(st))
+
+
+@transaction.commit_on_success
+def update(webdavpath, path, recursive = False):
+    """
+    Called by the method handlers after they changed path on disk. Its
+    row is read again, and with recursive set everything below it too. A
+    missing path is dropped from the index. Does nothing for cold mounts.
+    """
+    if not MetadataScan.is_warm(webdavpath):
+        return
+    rows = MetadataEntry.objects.filter(webdavpath = webdavpath.pk)
+    rows.filter(path = path).delete()
+    if recursive:
+        rows.filter(path__startswith = path.rstrip("/") + "/").delete()
+        add_tree(webdavpath, path)
+    else:
+        try:
+            st = os.lstat(path)
+        except OSError, ose:
+            if ose.errno != errno.ENOENT:
+                raise
+        else:
+            if stat.S_ISDIR(st.st_mode) or stat.S_ISREG(st.st_mode):
+                make_entry(webdavpath, path, st).save()
+    # adding or removing a member changed the directory as well
+    refresh(webdavpath, os.path.dirname(path))
+    if recursive and not os.path.lexists(path):
+        # and so did creating the trash, if it went there
+        refresh(webdavpath, os.path.abspath(webdavpath.local_path))
+
+
+@transaction.commit_on_success
+def reconcile(webdavpath):
+    """
+    Rebuilds the index of webdavpath from disk and marks it warm. Returns
+    the number of entries.
+    """
+    MetadataScan.objects.filter(webdavpath = webdavpath.pk).delete()
+    MetadataEntry.objects.filter(webdavpath = webdavpath.pk).delete()
+    count = add_tree(webdavpath, os.path.abspath(webdavpath.local_path))
+    MetadataScan.objects.create(webdavpath_id = webdavpath.pk, num_entries = count)
+    logger.debug("indexed %d entries of '%s'"%(count, webdavpath.url_path))
+    return count
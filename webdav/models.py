@@ -1,10 +1,26 @@
 import os
+import copy
 import logging
+import datetime
+import tempfile
+import threading
 from django.db import models
+from django.db.models import F, Sum
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import Signal
 from django.contrib.auth.models import User
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+from webdav.util import get_used_quota, is_hidden, UPLOAD_TEMP_PREFIX
+from webdav.delivery import DELIVERY_CHOICES
+from webdav.fileops import reaper
 
 logger = logging.getLogger("webdav")
 
+# sent with the WebdavPaths whenever the mount index is loaded
+mounts_loaded = Signal(providing_args = ["webdav_paths"])
+
 class WebdavPath(models.Model):
     QUOTA_SIZE_MULT = 1024 * 1024 # megs
 
@@ -13,6 +29,9 @@ class WebdavPath(models.Model):
     quota = models.IntegerField()
     max_num_files = models.IntegerField()
     owner = models.ForeignKey(User)
+    delivery = models.CharField(max_length=32, choices=DELIVERY_CHOICES,
+                                blank=True, default="")
+    indexed = models.BooleanField(default=False)
 
     _matched_path = None
 
@@ -21,26 +40,373 @@ class WebdavPath(models.Model):
             path = self._matched_path
         ret = os.path.abspath(os.path.normpath("%s/%s"%(self.local_path, path[len(self.url_path)-1:])))
         if ret.startswith(self.local_path):
+            # the trash and unfinished uploads are not reachable
+            if [name for name in ret[len(self.local_path):].split("/") if is_hidden(name)]:
+                return None
             return ret
         return None
 
     @classmethod
     def get_match_path_to_dir(cls, path):
-        webdav_paths = cls.objects.all()
         if not path.startswith("/"):
             path = "/%s"%path
         path = os.path.dirname(path)
+        wdp = mount_index.lookup(path)
+        if wdp:
+            # the indexed instance is shared between requests, hand out a copy
+            wdp = copy.copy(wdp)
+            wdp._matched_path = path
+            return wdp
+        logger.debug("didn't find any defined paths for '%s'"%path)
+        return None
+
+
+class QuotaLedger(models.Model):
+    """
+    Bytes and number of files used below a WebdavPath. The row is created
+    by a full scan the first time a quota is checked and kept up to date by
+    the method handlers, it is dropped when its WebdavPath is saved.
+    """
+    webdavpath = models.OneToOneField(WebdavPath, related_name = "ledger")
+    used_size = models.BigIntegerField(default = 0)
+    num_files = models.IntegerField(default = 0)
+    updated = models.DateTimeField(auto_now = True)
+
+    @classmethod
+    def get_usage(cls, webdavpath):
+        try:
+            ledger = cls.objects.get(webdavpath = webdavpath.pk)
+        except cls.DoesNotExist:
+            ledger = cls.reconcile(webdavpath)
+        return ledger.used_size, ledger.num_files
+
+    @classmethod
+    def add_usage(cls, webdavpath, size, num_files):
+        if not size and not num_files:
+            return
+        cls.objects.filter(webdavpath = webdavpath.pk).update(
+            used_size = F("used_size") + size,
+            num_files = F("num_files") + num_files)
+
+    @classmethod
+    def reconcile(cls, webdavpath):
+        if MetadataScan.is_warm(webdavpath):
+            used_size, num_files = MetadataEntry.get_usage(webdavpath,
+                                                           webdavpath.local_path)
+        else:
+            used_size, num_files = get_used_quota(webdavpath.local_path)
+        ledger, created = cls.objects.get_or_create(
+            webdavpath_id = webdavpath.pk,
+            defaults = {"used_size": used_size, "num_files": num_files})
+        if not created:
+            ledger.used_size = used_size
+            ledger.num_files = num_files
+            ledger.save()
+        logger.debug("reconciled quota for '%s' %d bytes, %d files"%(
+            webdavpath.url_path, used_size, num_files))
+        return ledger
+
+
+class UploadSession(models.Model):
+    """
+    A resumable upload of local_path, received into staging_path with
+    Content-Range PUTs. Sessions untouched for WEBDAV_UPLOAD_EXPIRY seconds
+    are discarded.
+    """
+    webdavpath = models.ForeignKey(WebdavPath, related_name = "uploads")
+    local_path = models.CharField(max_length = 1024)
+    staging_path = models.CharField(max_length = 1024)
+    total = models.BigIntegerField()
+    updated = models.DateTimeField(auto_now = True)
+
+    @classmethod
+    def get_expiry(cls):
+        return datetime.timedelta(
+            seconds = getattr(settings, "WEBDAV_UPLOAD_EXPIRY", 24 * 60 * 60))
+
+    @classmethod
+    def get_session(cls, webdavpath, local_path, total):
+        """
+        Returns the session uploading total bytes to local_path, starting
+        a new one if there is none or it is expired or of another size.
+        """
+        expired = timezone.now() - cls.get_expiry()
+        for session in cls.objects.filter(webdavpath = webdavpath.pk,
+                                          local_path = local_path):
+            if session.total == total and session.updated > expired:
+                return session
+            session.discard()
+        fd, staging_path = tempfile.mkstemp(prefix = UPLOAD_TEMP_PREFIX,
+                                            dir = os.path.dirname(local_path))
+        os.close(fd)
+        return cls.objects.create(webdavpath_id = webdavpath.pk, total = total,
+                                  local_path = local_path,
+                                  staging_path = staging_path)
+
+    @classmethod
+    def get_reserved(cls, webdavpath, exclude = None):
+        """
+        Bytes reserved by the unexpired sessions of webdavpath, other than
+        the one for the local path exclude, so that uploads which are never
+        committed still count towards the quota.
+        """
+        expired = timezone.now() - cls.get_expiry()
+        rows = cls.objects.filter(webdavpath = webdavpath.pk, updated__gt = expired)
+        if exclude:
+            rows = rows.exclude(local_path = exclude)
+        return rows.aggregate(Sum("total"))["total__sum"] or 0
+
+    @classmethod
+    def expire(cls):
+        expired = timezone.now() - cls.get_expiry()
+        count = 0
+        for session in cls.objects.filter(updated__lte = expired):
+            session.discard()
+            count += 1
+        return count
+
+    def get_offset(self):
+        try:
+            return os.path.getsize(self.staging_path)
+        except OSError:
+            return 0
+
+    def discard(self):
+        try:
+            os.remove(self.staging_path)
+        except OSError:
+            pass
+        logger.debug("discarded upload of '%s'"%self.local_path)
+        self.delete()
+
+
+class WebdavLock(models.Model):
+    """
+    A LOCK held on a URL path, used with WEBDAV_LOCK_BACKEND = "database"
+    so that all worker processes see the same locks.
+    """
+    token = models.CharField(max_length = 64, unique = True)
+    path = models.CharField(max_length = 1024, db_index = True)
+    scope = models.CharField(max_length = 16)
+    depth = models.CharField(max_length = 16)
+    owner = models.TextField(blank = True)
+    user = models.ForeignKey(User, null = True, blank = True)
+    timeout = models.IntegerField()
+    # seconds since the epoch, compared with time.time()
+    expires = models.FloatField(db_index = True)
+
+
+class DeadProperty(models.Model):
+    """
+    A property set with PROPPATCH, value being the XML content of the
+    property element. Used with WEBDAV_PROPERTY_STORE = "database".
+    """
+    path = models.CharField(max_length = 1024, db_index = True)
+    namespace = models.CharField(max_length = 255, blank = True)
+    name = models.CharField(max_length = 255)
+    value = models.TextField(blank = True)
+
+    class Meta:
+        unique_together = (("path", "namespace", "name"),)
+
+
+class MetadataEntry(models.Model):
+    """
+    A file or directory below an indexed WebdavPath as last seen on disk,
+    keyed by its local path.
+    """
+    webdavpath = models.ForeignKey(WebdavPath, related_name = "metadata")
+    path = models.CharField(max_length = 1024)
+    parent = models.CharField(max_length = 1024, db_index = True)
+    is_dir = models.BooleanField(default = False)
+    size = models.BigIntegerField(default = 0)
+    mtime = models.FloatField()
+    ctime = models.FloatField()
+    ino = models.BigIntegerField()
+    etag = models.CharField(max_length = 64)
+
+    class Meta:
+        unique_together = (("webdavpath", "path"),)
+
+    @classmethod
+    def get_usage(cls, webdavpath, path):
+        """
+        Bytes and number of files at or below path, as get_used_quota
+        would count them on disk.
+        """
+        prefix = path.rstrip("/") + "/"
+        rows = (cls.objects.filter(webdavpath = webdavpath.pk, path = path)
+                | cls.objects.filter(webdavpath = webdavpath.pk,
+                                     path__startswith = prefix))
+        usage = rows.filter(is_dir = False).aggregate(models.Sum("size"),
+                                                      models.Count("id"))
+        return usage["size__sum"] or 0, usage["id__count"]
+
+
+class MetadataScan(models.Model):
+    """
+    Marks the metadata index of a WebdavPath as complete. Without it the
+    mount is cold and everything is read from disk.
+    """
+    webdavpath = models.OneToOneField(WebdavPath, related_name = "metadata_scan")
+    num_entries = models.IntegerField(default = 0)
+    finished = models.DateTimeField(auto_now = True)
+
+    @classmethod
+    def is_warm(cls, webdavpath):
+        return (webdavpath.indexed
+                and cls.objects.filter(webdavpath = webdavpath.pk).exists())
+
+
+class JournalEntry(models.Model):
+    """
+    A change to a local path below a WebdavPath, recursive if a whole tree
+    was added, replaced or removed. Ids only ever grow and are handed out
+    as sync-tokens.
+    """
+    webdavpath = models.ForeignKey(WebdavPath, related_name = "journal")
+    path = models.CharField(max_length = 1024, db_index = True)
+    recursive = models.BooleanField(default = False)
+    created = models.DateTimeField(auto_now_add = True, db_index = True)
+
+
+class JournalHorizon(models.Model):
+    """
+    The newest journal entry removed by compaction, sync-tokens older than
+    it can't be answered any more.
+    """
+    webdavpath = models.OneToOneField(WebdavPath, related_name = "journal_horizon")
+    last_removed = models.IntegerField(default = 0)
+
+    @classmethod
+    def get_horizon(cls, webdavpath):
+        for last_removed in cls.objects.filter(webdavpath = webdavpath.pk).values_list(
+            "last_removed", flat = True):
+            return last_removed
+        return 0
+
+
+class MountIndex(object):
+    """
+    Process local longest-prefix map over WebdavPath.url_path.
+
+    The table is loaded on first use and dropped whenever a WebdavPath is
+    saved or deleted. With WEBDAV_MOUNT_CACHE_SHARED enabled a version
+    stamp is kept in the Django cache so that other worker processes notice
+    the change and reload as well.
+    """
+    VERSION_KEY = "webdav:mount-index:version"
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.prefixes = None
+        self.version = None
+        self.generation = 0
+        self.recovered = False
+
+    def is_shared(self):
+        return getattr(settings, "WEBDAV_MOUNT_CACHE_SHARED", False)
+
+    def get_shared_version(self):
+        version = cache.get(self.VERSION_KEY)
+        if version is None:
+            version = 1
+            cache.add(self.VERSION_KEY, version, None)
+        return version
+
+    def build(self, webdav_paths):
+        prefixes = {}
+        for order, wdp in enumerate(webdav_paths):
+            key = os.path.normpath(wdp.url_path)
+            prefixes.setdefault(key, []).append((order, wdp))
+        return prefixes
+
+    def load(self, webdav_paths = None):
+        """
+        Builds the table and installs it, unless it was invalidated while
+        the WebdavPaths were read; the caller gets the table either way.
+        """
+        self.lock.acquire()
+        try:
+            generation = self.generation
+        finally:
+            self.lock.release()
+        version = self.is_shared() and self.get_shared_version() or None
+        if webdav_paths is None:
+            webdav_paths = WebdavPath.objects.all()
+        webdav_paths = list(webdav_paths)
+        prefixes = self.build(webdav_paths)
+        if not self.recovered:
+            # first load in this process, pick up trash left behind
+            self.recovered = True
+            reaper.recover(set(wdp.local_path for wdp in webdav_paths))
+        self.lock.acquire()
+        try:
+            installed = generation == self.generation
+            if installed:
+                self.prefixes = prefixes
+                self.version = version
+        finally:
+            self.lock.release()
+        if installed:
+            mounts_loaded.send(sender = self.__class__, webdav_paths = webdav_paths)
+            logger.debug("loaded %d mount paths"%len(prefixes))
+        return prefixes
+
+    def invalidate(self):
+        self.lock.acquire()
+        try:
+            self.prefixes = None
+            self.version = None
+            self.generation += 1
+        finally:
+            self.lock.release()
+        if self.is_shared():
+            try:
+                cache.incr(self.VERSION_KEY)
+            except ValueError:
+                cache.set(self.VERSION_KEY, 1, None)
+
+    def get_prefixes(self):
+        prefixes = self.prefixes
+        if prefixes is not None and self.is_shared():
+            if self.version != self.get_shared_version():
+                prefixes = None
+        if prefixes is None:
+            prefixes = self.load()
+        return prefixes
+
+    def lookup(self, path):
+        prefixes = self.get_prefixes()
         found = []
-        for wdp in webdav_paths:
-            if (path.startswith(os.path.normpath(wdp.url_path))
-                and os.path.isdir(wdp.local_path)):
-                found.append(wdp)
-        if found:
-            # return the longest matching wdp
-            found.sort(lambda a, b: cmp(len(a.url_path), len(b.url_path)))
-            found[-1]._matched_path = path
-            return found[-1]
-        logger.debug("didn't find any defined paths for '%s'"%path)        
+        for i in xrange(len(path), -1, -1):
+            found.extend(prefixes.get(path[:i], ()))
+        if not found:
+            return None
+        # same ordering as the plain table scan; the longest url_path wins
+        found.sort(key = lambda item: (len(item[1].url_path), item[0]))
+        for order, wdp in reversed(found):
+            if os.path.isdir(wdp.local_path):
+                return wdp
         return None
-        
 
+
+mount_index = MountIndex()
+
+
+def invalidate_mount_index(sender, **kwargs):
+    mount_index.invalidate()
+
+def drop_quota_ledger(sender, instance, **kwargs):
+    # the local path or limits may have changed, rescan on next use
+    QuotaLedger.objects.filter(webdavpath = instance.pk).delete()
+
+def drop_metadata_scan(sender, instance, **kwargs):
+    # the index may describe another local path now, it is cold until the
+    # next reconcile
+    MetadataScan.objects.filter(webdavpath = instance.pk).delete()
+
+post_save.connect(invalidate_mount_index, sender = WebdavPath)
+post_save.connect(drop_quota_ledger, sender = WebdavPath)
+post_save.connect(drop_metadata_scan, sender = WebdavPath)
+post_delete.connect(invalidate_mount_index, sender = WebdavPath)
@@ -0,0 +1,253 @@
+"""
+Copyright 2012 Peter Gebauer
+Licensed under GNU GPLv3
+
+Dead properties set with PROPPATCH.
+Part of the django-webdav project.
+"""
+import os
+import urllib
+import logging
+from xml.sax.saxutils import escape, quoteattr
+from django.conf import settings
+from django.db import connection, transaction
+from webdav.util import Elem, scandir, is_hidden
+from webdav.models import DeadProperty
+
+try:
+    import xattr
+except ImportError:
+    xattr = None
+
+logger = logging.getLogger("webdav")
+
+
+def get_value_xml(prop):
+    """
+    Serializes the children of the property element prop, declaring
+    namespaces where they differ from their parent's.
+    """
+    parts = []
+
+    def write(elem, namespace):
+        attributes = dict(elem.attributes)
+        if elem.namespace != namespace:
+            attributes["xmlns"] = elem.namespace or ""
+        parts.append(u"<%s"%elem.name)
+        for k, v in attributes.items():
+            parts.append(u" %s=%s"%(k, quoteattr(v)))
+        parts.append(u">")
+        for child in elem.children:
+            if isinstance(child, Elem):
+                write(child, elem.namespace)
+            else:
+                parts.append(escape(child))
+        parts.append(u"</%s>"%elem.name)
+
+    for child in prop.children:
+        if isinstance(child, Elem):
+            write(child, prop.namespace)
+        else:
+            parts.append(escape(child))
+    return u"".join(parts)
+
+
+class DatabasePropertyStore(object):
+    """
+    Keeps dead properties in the DeadProperty table, indexed by local path.
+    """
+
+    def get_many(self, paths):
+        """
+        Returns {path: {(namespace, name): value}} for paths, in one query
+        per WEBDAV_PROPERTY_BATCH_SIZE paths.
+        """
+        result = {}
+        batch_size = getattr(settings, "WEBDAV_PROPERTY_BATCH_SIZE", 500)
+        for i in xrange(0, len(paths), batch_size):
+            rows = DeadProperty.objects.filter(path__in = paths[i:i + batch_size])
+            for path, namespace, name, value in rows.values_list(
+                "path", "namespace", "name", "value"):
+                result.setdefault(path, {})[(namespace, name)] = value
+        return result
+
+    def get(self, path):
+        return self.get_many([path]).get(path, {})
+
+    @transaction.commit_on_success
+    def patch(self, path, updates):
+        """
+        Applies updates, a list of ((namespace, name), value) with None
+        values removing the property, all or nothing.
+        """
+        for (namespace, name), value in updates:
+            rows = DeadProperty.objects.filter(path = path, namespace = namespace,
+                                               name = name)
+            if value is None:
+                rows.delete()
+            elif not rows.update(value = value):
+                DeadProperty.objects.create(path = path, namespace = namespace,
+                                            name = name, value = value)
+
+    def get_tree(self, path):
+        prefix = path.rstrip("/") + "/"
+        return (DeadProperty.objects.filter(path = path)
+                | DeadProperty.objects.filter(path__startswith = prefix))
+
+    def delete(self, path):
+        self.get_tree(path).delete()
+
+    @transaction.commit_on_success
+    def copy(self, src, dst, recursive = True, renamed = False):
+        if recursive:
+            rows = self.get_tree(src)
+        else:
+            rows = DeadProperty.objects.filter(path = src)
+        batch_size = getattr(settings, "WEBDAV_PROPERTY_BATCH_SIZE", 500)
+        batch = []
+        for path, namespace, name, value in rows.values_list(
+            "path", "namespace", "name", "value").iterator():
+            batch.append(DeadProperty(path = dst + path[len(src):], namespace = namespace,
+                                      name = name, value = value))
+            if len(batch) >= batch_size:
+                DeadProperty.objects.bulk_create(batch)
+                batch = []
+        if batch:
+            DeadProperty.objects.bulk_create(batch)
+
+    def preserve(self, src, tmp):
+        pass
+
+    @transaction.commit_on_success
+    def move(self, src, dst, renamed = True):
+        # one statement for the whole tree; the ORM can't concatenate
+        prefix = src.rstrip("/") + "/"
+        cursor = connection.cursor()
+        cursor.execute("UPDATE %s SET path = %%s || substr(path, %%s) "
+                       "WHERE path = %%s OR substr(path, 1, %%s) = %%s"%(
+                connection.ops.quote_name(DeadProperty._meta.db_table)),
+                       [dst, len(src) + 1, src, len(prefix), prefix])
+        transaction.set_dirty()
+
+
+class XattrPropertyStore(object):
+    """
+    Keeps dead properties in extended attributes of the files themselves,
+    so they follow renames for free. Needs the xattr module and a
+    filesystem with user xattrs.
+    """
+    PREFIX = "user.webdav."
+
+    def get_key(self, namespace, name):
+        return self.PREFIX + urllib.quote(("{%s}%s"%(namespace, name)).encode("utf-8"), "{}")
+
+    def parse_key(self, key):
+        key = urllib.unquote(key[len(self.PREFIX):]).decode("utf-8")
+        namespace, name = key[1:].split("}", 1)
+        return namespace, name
+
+    def get(self, path):
+        props = {}
+        try:
+            keys = xattr.listxattr(path)
+        except (IOError, OSError):
+            return props
+        for key in keys:
+            if key.startswith(self.PREFIX):
+                try:
+                    props[self.parse_key(key)] = xattr.getxattr(path, key).decode("utf-8")
+                except (IOError, OSError, ValueError):
+                    pass
+        return props
+
+    def get_many(self, paths):
+        result = {}
+        for path in paths:
+            props = self.get(path)
+            if props:
+                result[path] = props
+        return result
+
+    def patch(self, path, updates):
+        done = []
+        try:
+            for (namespace, name), value in updates:
+                key = self.get_key(namespace, name)
+                try:
+                    old = xattr.getxattr(path, key)
+                except (IOError, OSError):
+                    old = None
+                if value is None:
+                    if old is not None:
+                        xattr.removexattr(path, key)
+                else:
+                    xattr.setxattr(path, key, value.encode("utf-8"))
+                done.append((key, old))
+        except (IOError, OSError):
+            # undo what was applied, PROPPATCH is all or nothing
+            for key, old in reversed(done):
+                try:
+                    if old is None:
+                        xattr.removexattr(path, key)
+                    else:
+                        xattr.setxattr(path, key, old)
+                except (IOError, OSError):
+                    pass
+            raise
+
+    def delete(self, path):
+        pass
+
+    def copy(self, src, dst, recursive = True, renamed = False):
+        stack = [(src, dst)]
+        while stack:
+            srcpath, dstpath = stack.pop()
+            props = self.get(srcpath)
+            if props:
+                self.patch(dstpath, props.items())
+            if recursive and os.path.isdir(srcpath) and not os.path.islink(srcpath):
+                for entry in scandir(srcpath):
+                    if not is_hidden(entry.name):
+                        stack.append((entry.path, os.path.join(dstpath, entry.name)))
+
+    def move(self, src, dst, renamed = True):
+        if not renamed:
+            self.copy(src, dst)
+
+    def preserve(self, src, tmp):
+        """
+        Copies the properties of src onto tmp, which is about to be renamed
+        over it, so that PUT replacing the content keeps them.
+        """
+        try:
+            keys = xattr.listxattr(src)
+        except (IOError, OSError):
+            return
+        for key in keys:
+            if key.startswith(self.PREFIX):
+                xattr.setxattr(tmp, key, xattr.getxattr(src, key))
+
+
+PROPERTY_STORE_DATABASE = "database"
+PROPERTY_STORE_XATTR = "xattr"
+
+PROPERTY_STORES = {
+    PROPERTY_STORE_DATABASE: DatabasePropertyStore(),
+    PROPERTY_STORE_XATTR: XattrPropertyStore(),
+    }
+
+
+def get_property_store():
+    """
+    Returns the store named by WEBDAV_PROPERTY_STORE, "database" (default)
+    or "xattr".
+    """
+    name = getattr(settings, "WEBDAV_PROPERTY_STORE", PROPERTY_STORE_DATABASE)
+    if name == PROPERTY_STORE_XATTR and xattr is None:
+        logger.warning("xattr module not installed, using the database")
+        name = PROPERTY_STORE_DATABASE
+    store = PROPERTY_STORES.get(name)
+    if not store:
+        logger.warning("unknown property store '%s', using the database"%name)
+        store = PROPERTY_STORES[PROPERTY_STORE_DATABASE]
+    return store
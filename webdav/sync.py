@@ -0,0 +1,158 @@
+"""
+Copyright 2012 Peter Gebauer
+Licensed under GNU GPLv3
+
+Change journal behind the sync-collection REPORT of RFC 6578.
+Part of the django-webdav project.
+"""
+import os
+import urllib
+import datetime
+import logging
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, Max
+from django.utils import timezone
+from webdav.models import JournalEntry, JournalHorizon
+
+logger = logging.getLogger("webdav")
+
+TOKEN_PREFIX = "urn:x-webdav-sync:"
+
+LEVEL_ONE = "1"
+LEVEL_INFINITE = "infinite"
+
+
+def record(webdavpath, path, recursive = False):
+    JournalEntry.objects.create(webdavpath_id = webdavpath.pk, path = path,
+                                recursive = recursive)
+
+
+def get_current():
+    """
+    Id of the newest journal entry, the sync-token for the journal as it
+    is now.
+    """
+    return JournalEntry.objects.aggregate(Max("id"))["id__max"] or 0
+
+
+def format_token(entry_id, since = None, cursor = None):
+    """
+    The sync-token for the journal up to entry_id. A report cut off after
+    the member at cursor, a tuple of names below the collection, gets a
+    paged token instead, which picks up the listing of the changes after
+    since, or of all members, behind cursor.
+    """
+    if cursor is None:
+        return "%s%d"%(TOKEN_PREFIX, entry_id)
+    cursor = urllib.quote("/".join(cursor).encode("utf-8"))
+    if since is None:
+        return "%s%d;;%s"%(TOKEN_PREFIX, entry_id, cursor)
+    return "%s%d;%d;%s"%(TOKEN_PREFIX, entry_id, since, cursor)
+
+
+def parse_token(token, webdavpath, current):
+    """
+    Returns (since, until, cursor) for token, since being None for a
+    paged listing of all members and cursor the tuple of names to continue
+    after. None if it is malformed, was not handed out yet or is older
+    than what compaction kept of the journal.
+    """
+    if not token.startswith(TOKEN_PREFIX):
+        return None
+    parts = token[len(TOKEN_PREFIX):].split(";")
+    if len(parts) not in (1, 3):
+        return None
+    try:
+        until = int(parts[0])
+        since = until
+        cursor = ()
+        if len(parts) == 3:
+            since = None
+            if parts[1]:
+                since = int(parts[1])
+            cursor = tuple(urllib.unquote(parts[2]).decode("utf-8").split("/"))
+    except (ValueError, UnicodeDecodeError):
+        return None
+    horizon = JournalHorizon.get_horizon(webdavpath)
+    if until < horizon or until > current:
+        return None
+    if since is None:
+        return None, until, cursor
+    if since < horizon or since > until:
+        return None
+    if len(parts) == 1:
+        until = current
+    return since, until, cursor
+
+
+def get_changes(webdavpath, lcpath, since, until, level):
+    """
+    Returns {local path: recursive} for the members of the collection
+    lcpath changed after journal id since up to until, or None if
+    lcpath itself was replaced and the client has to start over.
+
+    With level "1" a change below a member is reported as a change of
+    the member, with level "infinite" the directory holding a changed
+    path is reported as well since its modification time changed too.
+    """
+    rows = JournalEntry.objects.filter(webdavpath = webdavpath.pk, id__gt = since,
+                                       id__lte = until)
+    root = os.path.abspath(webdavpath.local_path)
+    ancestors = [lcpath]
+    while ancestors[-1] != root and ancestors[-1].startswith(root + "/"):
+        ancestors.append(os.path.dirname(ancestors[-1]))
+    if rows.filter(path__in = ancestors, recursive = True).exists():
+        return None
+    prefix = lcpath.rstrip("/") + "/"
+    changes = {}
+    for path, recursive in rows.filter(path__startswith = prefix).values_list(
+        "path", "recursive"):
+        if level == LEVEL_ONE:
+            name = path[len(prefix):].split("/", 1)[0]
+            changes[prefix + name] = False
+        else:
+            changes[path] = changes.get(path) or recursive
+            parent = os.path.dirname(path)
+            if parent != lcpath:
+                changes.setdefault(parent, False)
+    return changes
+
+
+@transaction.commit_on_success
+def compact(max_age = None):
+    """
+    Merges the entries of each path into its newest one, then removes
+    entries older than max_age seconds (WEBDAV_SYNC_JOURNAL_MAX_AGE,
+    default 30 days). Tokens older than a removed entry are answered with
+    a full resync from then on. The newest entry is always kept so that
+    ids keep growing on databases that reuse them. Returns the number of
+    entries removed.
+    """
+    if max_age is None:
+        max_age = getattr(settings, "WEBDAV_SYNC_JOURNAL_MAX_AGE", 30 * 24 * 60 * 60)
+    newest = get_current()
+    removed = 0
+    groups = JournalEntry.objects.values("webdavpath", "path").annotate(
+        count = Count("id"), last = Max("id")).filter(count__gt = 1)
+    for group in list(groups):
+        rows = JournalEntry.objects.filter(webdavpath = group["webdavpath"],
+                                           path = group["path"], id__lt = group["last"])
+        if rows.filter(recursive = True).exists():
+            JournalEntry.objects.filter(id = group["last"]).update(recursive = True)
+        removed += rows.count()
+        rows.delete()
+    expired = timezone.now() - datetime.timedelta(seconds = max_age)
+    old = JournalEntry.objects.filter(created__lt = expired).exclude(id = newest)
+    for webdavpath_id, last in list(old.values("webdavpath").annotate(
+            last = Max("id")).values_list("webdavpath", "last")):
+        rows = JournalEntry.objects.filter(webdavpath = webdavpath_id,
+                                           id__lte = last).exclude(id = newest)
+        removed += rows.count()
+        rows.delete()
+        horizon, created = JournalHorizon.objects.get_or_create(
+            webdavpath_id = webdavpath_id)
+        horizon.last_removed = max(horizon.last_removed, last)
+        horizon.save()
+    logger.debug("removed %d journal entries"%removed)
+    return removed
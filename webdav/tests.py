@@ -5,7 +5,32 @@ when you run "manage.py test".
 Replace this with more appropriate tests for your application.
 """
 
+import os
+import time
+import shutil
+import tempfile
+import unittest
+from StringIO import StringIO
+from wsgiref.util import FileWrapper
 from django.test import TestCase
+from django.test.client import RequestFactory, FakePayload
+from django.test.utils import override_settings
+from django.core.cache import cache
+from django.core.management import call_command
+from django.contrib.auth.models import User, AnonymousUser
+from webdav.models import WebdavPath, MountIndex, QuotaLedger, UploadSession
+from webdav.models import MetadataEntry, MetadataScan, JournalEntry, DeadProperty
+from webdav.models import mounts_loaded
+from webdav.delivery import parse_range
+from webdav.wsgi import FileWrapperMiddleware
+from webdav.webdav_handlers import PutHandler, QuotaExceeded
+from webdav import webdav_handlers
+from webdav import fileops, locks, metadata, sync, watcher
+from webdav.props import get_property_store, DatabasePropertyStore
+from webdav import props
+from webdav.util import ACLCache, ACLRuleSet, DirectoryACL, Elem, acl_cache
+from webdav.util import ListingCache, listing_cache
+from webdav.util import basic_auth_cache, check_http_authorization
 
 
 class SimpleTest(TestCase):
@@ -14,3 +39,1426 @@ class SimpleTest(TestCase):
         Tests that 1 + 1 always equals 2.
         """
         self.assertEqual(1 + 1, 2)
+
+
+class TempDirTestCase(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def mkdir(self, *names):
+        path = os.path.join(self.tmpdir, *names)
+        os.makedirs(path)
+        return path
+
+
+class MountIndexTest(TempDirTestCase):
+
+    def test_longest_prefix(self):
+        index = MountIndex()
+        index.load([WebdavPath(url_path = "/dav/", local_path = self.mkdir("a")),
+                    WebdavPath(url_path = "/dav/sub/", local_path = self.mkdir("b"))])
+        self.assertEqual(index.lookup("/dav/sub/x").local_path,
+                         os.path.join(self.tmpdir, "b"))
+        self.assertEqual(index.lookup("/dav/other").local_path,
+                         os.path.join(self.tmpdir, "a"))
+        self.assertEqual(index.lookup("/nodav"), None)
+
+    def test_missing_local_path_is_skipped(self):
+        index = MountIndex()
+        index.load([WebdavPath(url_path = "/dav/", local_path = self.mkdir("a")),
+                    WebdavPath(url_path = "/dav/sub/",
+                               local_path = os.path.join(self.tmpdir, "gone"))])
+        self.assertEqual(index.lookup("/dav/sub/x").local_path,
+                         os.path.join(self.tmpdir, "a"))
+
+    def test_invalidated_while_loading(self):
+        index = MountIndex()
+        loaded = []
+        mounts_loaded.connect(lambda sender, webdav_paths, **kwargs: loaded.append(1),
+                              weak = False, dispatch_uid = "test_invalidated_while_loading")
+        def read():
+            yield WebdavPath(url_path = "/dav/", local_path = self.mkdir("a"))
+            # a WebdavPath was saved meanwhile
+            index.invalidate()
+        try:
+            self.assertNotEqual(index.load(read()), None)
+            self.assertEqual(index.prefixes, None)
+            self.assertEqual(loaded, [])
+            index.load([WebdavPath(url_path = "/dav/", local_path = self.mkdir("b"))])
+            self.assertNotEqual(index.prefixes, None)
+            self.assertEqual(loaded, [1])
+        finally:
+            mounts_loaded.disconnect(dispatch_uid = "test_invalidated_while_loading")
+
+    def test_invalidated_on_save_and_delete(self):
+        owner = User.objects.create(username = "owner")
+        self.assertEqual(WebdavPath.get_match_path_to_dir("dav/file"), None)
+        wdp = WebdavPath.objects.create(url_path = "/dav/", owner = owner,
+                                        local_path = self.mkdir("a"),
+                                        quota = 0, max_num_files = 0)
+        found = WebdavPath.get_match_path_to_dir("dav/file")
+        self.assertEqual(found.pk, wdp.pk)
+        self.assertEqual(found._matched_path, "/dav")
+        wdp.delete()
+        self.assertEqual(WebdavPath.get_match_path_to_dir("dav/file"), None)
+
+    @override_settings(WEBDAV_MOUNT_CACHE_SHARED = True)
+    def test_shared_version_forces_reload(self):
+        index = MountIndex()
+        index.load([WebdavPath(url_path = "/dav/", local_path = self.mkdir("a"))])
+        self.assertNotEqual(index.lookup("/dav/x"), None)
+        # another process saved a WebdavPath
+        cache.incr(MountIndex.VERSION_KEY)
+        self.assertEqual(index.lookup("/dav/x"), None)
+
+
+class ACLCacheTest(TempDirTestCase):
+
+    def setUp(self):
+        super(ACLCacheTest, self).setUp()
+        self.cache = ACLCache()
+
+    def write_acl(self, path, data):
+        f = file(os.path.join(path, DirectoryACL.ACL_FILENAME), "w")
+        f.write(data)
+        f.close()
+
+    def test_resolves_closest_acl_file(self):
+        top = self.mkdir("top")
+        deep = self.mkdir("top", "a", "b")
+        self.write_acl(top, "read=alice bob\n")
+        entry = self.cache.resolve(deep)
+        self.assertEqual(entry.filename,
+                         os.path.join(top, DirectoryACL.ACL_FILENAME))
+        self.assertEqual(entry.access_lists, {"read": ["alice", "bob"]})
+
+    def test_hits_and_negative_entries(self):
+        deep = self.mkdir("a", "b")
+        self.assertEqual(self.cache.resolve(deep), None)
+        misses = self.cache.misses
+        self.assertEqual(self.cache.resolve(deep), None)
+        self.assertEqual(self.cache.misses, misses)
+        self.assertTrue(self.cache.hits >= misses)
+
+    @override_settings(WEBDAV_ACL_CACHE_TTL = 0)
+    def test_revalidated_on_change(self):
+        top = self.mkdir("top")
+        self.write_acl(top, "read=alice\n")
+        self.assertEqual(self.cache.resolve(top).access_lists["read"], ["alice"])
+        self.write_acl(top, "read=alice carol\n")
+        # make sure the stamp differs on filesystems with coarse mtimes
+        os.utime(os.path.join(top, DirectoryACL.ACL_FILENAME), (0, 0))
+        self.assertEqual(self.cache.resolve(top).access_lists["read"],
+                         ["alice", "carol"])
+
+    @override_settings(WEBDAV_ACL_CACHE_SIZE = 2)
+    def test_lru_eviction(self):
+        for name in ("a", "b", "c"):
+            self.cache.get_entry(self.mkdir(name))
+        self.assertEqual(self.cache.entries.keys(),
+                         [os.path.join(self.tmpdir, "b"),
+                          os.path.join(self.tmpdir, "c")])
+
+    @override_settings(WEBDAV_ACL_CACHE_TTL = 60)
+    def test_invalidate(self):
+        top = self.mkdir("top")
+        self.assertEqual(self.cache.resolve(top), None)
+        self.write_acl(top, "read=alice\n")
+        self.assertEqual(self.cache.resolve(top), None)
+        self.cache.invalidate(top)
+        self.assertEqual(self.cache.resolve(top).access_lists["read"], ["alice"])
+
+
+class ACLRuleSetTest(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username = "alice")
+        self.user.groups.create(name = "staff")
+
+    def test_compile(self):
+        rules = ACLRuleSet(["user:bob", "group:staff", "carol", "bogus:x", ""])
+        self.assertEqual(rules.usernames, set(["bob", "carol"]))
+        self.assertEqual(rules.groupnames, set(["staff", "carol"]))
+        self.assertFalse(rules.wildcard)
+        self.assertTrue(ACLRuleSet(["*"]).wildcard)
+
+    def test_match(self):
+        self.assertTrue(ACLRuleSet(["alice"]).match(self.user))
+        self.assertTrue(ACLRuleSet(["group:staff"]).match(self.user))
+        self.assertFalse(ACLRuleSet(["group:alice"]).match(self.user))
+        self.assertFalse(ACLRuleSet(["user:bob", "group:other"]).match(self.user))
+        self.assertFalse(ACLRuleSet(["alice"]).match(AnonymousUser()))
+
+    def test_groups_fetched_once(self):
+        user = User.objects.get(pk = self.user.pk)
+        rule_sets = [ACLRuleSet(["group:g%d"%i]) for i in range(5)]
+        with self.assertNumQueries(1):
+            for rules in rule_sets:
+                self.assertFalse(rules.match(user))
+
+
+@override_settings(WEBDAV_BASIC_AUTH_CACHE_TTL = 60,
+                   WEBDAV_BASIC_AUTH_STATELESS = True)
+class BasicAuthCacheTest(TestCase):
+
+    def setUp(self):
+        basic_auth_cache.clear()
+        self.user = User.objects.create_user("alice", "", "secret")
+        self.factory = RequestFactory()
+
+    def request(self, password = "secret"):
+        auth = "Basic %s"%("alice:%s"%password).encode("base64").strip()
+        request = self.factory.get("/", HTTP_AUTHORIZATION = auth)
+        request.user = AnonymousUser()
+        acl = DirectoryACL(None, "/")
+        return request, check_http_authorization(acl, request, None, "read")
+
+    def test_cached_after_success(self):
+        request, response = self.request()
+        self.assertEqual(response, None)
+        self.assertEqual(request.user.pk, self.user.pk)
+        self.assertEqual(len(basic_auth_cache.entries), 1)
+        # only the user lookup, no session
+        with self.assertNumQueries(1):
+            request, response = self.request()
+        self.assertEqual(request.user.pk, self.user.pk)
+
+    def test_failure_not_cached(self):
+        request, response = self.request("wrong")
+        self.assertEqual(len(basic_auth_cache.entries), 0)
+
+    def test_evicted_on_password_change(self):
+        auth = "Basic %s"%"alice:secret".encode("base64").strip()
+        self.request()
+        self.assertNotEqual(basic_auth_cache.get(auth), None)
+        self.user.set_password("other")
+        self.user.save()
+        self.assertEqual(len(basic_auth_cache.entries), 0)
+        self.request()
+        User.objects.filter(pk = self.user.pk).update(is_active = False)
+        self.assertEqual(basic_auth_cache.get(auth), None)
+
+    def test_kept_on_unrelated_save(self):
+        self.request()
+        self.user.last_name = "Smith"
+        self.user.save()
+        self.assertEqual(len(basic_auth_cache.entries), 1)
+
+
+class HandlerTestCase(TempDirTestCase):
+    quota = 0
+    max_num_files = 0
+
+    def setUp(self):
+        super(HandlerTestCase, self).setUp()
+        self.root = self.mkdir("root")
+        self.owner = User.objects.create_user("owner", "", "secret")
+        self.webdavpath = WebdavPath.objects.create(
+            url_path = "/dav/", local_path = self.root, owner = self.owner,
+            quota = self.quota, max_num_files = self.max_num_files)
+        self.auth = "Basic %s"%"owner:secret".encode("base64").strip()
+
+    def dav(self, method, path, data = "", **extra):
+        environ = {
+            "HTTP_AUTHORIZATION": self.auth,
+            "CONTENT_LENGTH": len(data),
+            "CONTENT_TYPE": "application/octet-stream",
+            "PATH_INFO": "/webdav/dav/%s"%path,
+            "REQUEST_METHOD": method,
+            "wsgi.input": FakePayload(data),
+            }
+        environ.update(extra)
+        return self.client.request(**environ)
+
+    def write(self, name, data):
+        f = file(os.path.join(self.root, name), "w")
+        f.write(data)
+        f.close()
+
+    def read(self, name):
+        f = file(os.path.join(self.root, name), "r")
+        data = f.read()
+        f.close()
+        return data
+
+
+class QuotaLedgerTest(HandlerTestCase):
+    quota = 1
+    max_num_files = 100
+
+    def usage(self):
+        ledger = QuotaLedger.objects.get(webdavpath = self.webdavpath)
+        return ledger.used_size, ledger.num_files
+
+    def test_ledger_follows_writes(self):
+        self.write("existing", "x" * 10)
+        self.assertEqual(self.dav("PUT", "a", "y" * 100).status_code, 201)
+        self.assertEqual(self.usage(), (110, 2))
+        self.dav("PUT", "a", "y" * 50)
+        self.assertEqual(self.usage(), (60, 2))
+        self.dav("COPY", "a", HTTP_DESTINATION = "/webdav/dav/b")
+        self.assertEqual(self.usage(), (110, 3))
+        self.dav("MOVE", "b", HTTP_DESTINATION = "/webdav/dav/existing")
+        self.assertEqual(self.usage(), (100, 2))
+        self.dav("DELETE", "a")
+        self.assertEqual(self.usage(), (50, 1))
+        self.assertEqual(QuotaLedger.reconcile(self.webdavpath).used_size, 50)
+
+    def test_quota_exceeded(self):
+        response = self.dav("PUT", "big", "x" * WebdavPath.QUOTA_SIZE_MULT)
+        self.assertEqual(response.status_code, 403)
+
+    def test_reconcile_command(self):
+        self.dav("PUT", "a", "y" * 100)
+        self.write("external", "x" * 10)
+        call_command("webdav_reconcile_quota", verbosity = 0)
+        self.assertEqual(self.usage(), (110, 2))
+
+
+PROPFIND_BODY = ("<?xml version=\"1.0\" encoding=\"utf-8\"?><propfind xmlns=\"DAV:\">"
+                 "<prop><getcontentlength/><resourcetype/></prop></propfind>")
+
+
+class PropfindTest(HandlerTestCase):
+
+    def propfind(self, path = "", body = PROPFIND_BODY, **extra):
+        response = self.dav("PROPFIND", path, body, **extra)
+        return response, "".join(response)
+
+    def test_listing(self):
+        self.write("a.txt", "hello")
+        os.mkdir(os.path.join(self.root, "sub"))
+        response, xml = self.propfind()
+        self.assertEqual(response.status_code, 207)
+        self.assertTrue(xml.startswith("<?xml"))
+        self.assertTrue("<href>/webdav/dav/a.txt</href>" in xml)
+        self.assertTrue("<getcontentlength>5</getcontentlength>" in xml)
+        self.assertTrue("<href>/webdav/dav/sub</href>" in xml)
+        self.assertTrue(xml.endswith("</multistatus>"))
+
+    def test_depth(self):
+        os.makedirs(os.path.join(self.root, "a", "b"))
+        self.write("a/b/deep.txt", "x")
+        self.write("top.txt", "x")
+        response, xml = self.propfind(HTTP_DEPTH = "0")
+        self.assertEqual(xml.count("<response>"), 1)
+        response, xml = self.propfind(HTTP_DEPTH = "1")
+        self.assertEqual(xml.count("<response>"), 3)
+        self.assertFalse("deep.txt" in xml)
+        response, xml = self.propfind(HTTP_DEPTH = "infinity")
+        self.assertEqual(xml.count("<response>"), 5)
+        self.assertTrue("<href>/webdav/dav/a/b/deep.txt</href>" in xml)
+        response, xml = self.propfind("top.txt", HTTP_DEPTH = "1")
+        self.assertEqual(xml.count("<response>"), 1)
+        response, xml = self.propfind(HTTP_DEPTH = "2")
+        self.assertEqual(response.status_code, 400)
+
+    def test_depth_infinity_limits(self):
+        for i in range(5):
+            self.write("f%d"%i, "")
+        with self.settings(WEBDAV_PROPFIND_MAX_ENTRIES = 3):
+            response, xml = self.propfind(HTTP_DEPTH = "infinity")
+        self.assertEqual(xml.count("<response>"), 4)
+        self.assertTrue("507 Insufficient Storage" in xml)
+        with self.settings(WEBDAV_PROPFIND_MAX_ENTRIES = 0):
+            response, xml = self.propfind(HTTP_DEPTH = "infinity")
+        self.assertEqual(response.status_code, 403)
+        self.assertTrue("propfind-finite-depth" in xml)
+
+    def test_one_stat_per_entry(self):
+        for i in range(20):
+            self.write("f%d"%i, "x")
+            os.mkdir(os.path.join(self.root, "d%d"%i))
+        calls = []
+        def counting(funct):
+            def wrapper(*args, **kwargs):
+                calls.append(args[0])
+                return funct(*args, **kwargs)
+            return wrapper
+        def propfind():
+            del calls[:]
+            saved = os.stat, os.lstat
+            os.stat, os.lstat = counting(os.stat), counting(os.lstat)
+            try:
+                return "".join(self.dav("PROPFIND", "", PROPFIND_BODY))
+            finally:
+                os.stat, os.lstat = saved
+        listing_cache.invalidate()
+        # a warm ACL cache, which would revalidate with stats of its own
+        with self.settings(WEBDAV_ACL_CACHE_TTL = 60):
+            acl_cache.resolve(self.root)
+            xml = propfind()
+            self.assertEqual(xml.count("<response>"), 41)
+            expected = sorted(os.path.join(self.root, name) for name in os.listdir(self.root))
+            self.assertEqual(sorted(path for path in calls if path != self.root), expected)
+            # a listing cache hit stats the directory only
+            self.assertEqual(propfind(), xml)
+            self.assertEqual([path for path in calls if path != self.root], [])
+
+    def test_streamed(self):
+        for i in range(10):
+            self.write("f%d"%i, "")
+        response = self.dav("PROPFIND", "", PROPFIND_BODY)
+        chunks = list(response)
+        self.assertEqual(len(chunks), 13)
+
+
+class ElemTest(TestCase):
+
+    def test_get_xml(self):
+        elem = Elem("multistatus", xmlns = "DAV:")
+        response = elem.add_child(Elem("response"))
+        response.add_child(Elem("href")).add_child(u"/a&b<c>")
+        response.add_child(Elem("prop", title = u"say \"hi\""))
+        self.assertEqual(elem.get_xml(),
+                         u"<multistatus xmlns=\"DAV:\"><response>"
+                         u"<href>/a&amp;b&lt;c&gt;</href>"
+                         u"<prop title='say \"hi\"'></prop>"
+                         u"</response></multistatus>")
+
+    def test_write_xml_to_file(self):
+        elem = Elem("a", [Elem("b", [u"\xe5"]), "c"])
+        out = StringIO()
+        elem.write_xml(lambda s: out.write(s.encode("utf-8")))
+        self.assertEqual(out.getvalue(), "<a><b>\xc3\xa5</b>c</a>")
+
+    def test_deep_nesting(self):
+        root = elem = Elem("e")
+        for i in range(5000):
+            elem = elem.add_child(Elem("e"))
+        self.assertEqual(len(root.get_xml()), 5001 * len("<e></e>"))
+
+
+class ElemParserTest(TestCase):
+
+    def test_namespaces(self):
+        elem = Elem.from_xml("<?xml version=\"1.0\"?><D:propfind xmlns:D=\"DAV:\">"
+                             "<D:prop><D:getetag/><x:color xmlns:x=\"urn:x\"/>"
+                             "</D:prop></D:propfind>")
+        self.assertEqual(elem.name, "propfind")
+        self.assertEqual(elem.namespace, "DAV:")
+        prop = elem.find_children("prop")[0]
+        self.assertEqual([(c.namespace, c.name) for c in prop.children],
+                         [("DAV:", "getetag"), ("urn:x", "color")])
+
+    def test_text(self):
+        elem = Elem.from_xml("<a> one <!-- comment --> <b>two</b><![CDATA[three]]></a>")
+        self.assertEqual(elem.children[0], u"one")
+        self.assertEqual(elem.children[1].children, [u"two"])
+        self.assertEqual(elem.children[2], u"three")
+
+    def test_invalid(self):
+        self.assertEqual(Elem.from_xml(""), None)
+        self.assertEqual(Elem.from_xml("<a><b></a>"), None)
+        self.assertEqual(Elem.from_xml("<!DOCTYPE a [<!ENTITY e \"x\">]><a>&e;</a>"),
+                         None)
+
+    @override_settings(WEBDAV_MAX_XML_DEPTH = 10, WEBDAV_MAX_XML_SIZE = 100)
+    def test_limits(self):
+        self.assertNotEqual(Elem.from_xml("<a>" * 10 + "</a>" * 10), None)
+        self.assertEqual(Elem.from_xml("<a>" * 11 + "</a>" * 11), None)
+        self.assertEqual(Elem.from_xml("<a>%s</a>"%("x" * 100)), None)
+
+
+class GetTest(HandlerTestCase):
+
+    def test_stream(self):
+        data = "".join(chr(i % 256) for i in range(200000))
+        self.write("data.bin", data)
+        with self.settings(WEBDAV_DELIVERY_BUFFER_SIZE = 4096):
+            response = self.dav("GET", "data.bin")
+        self.assertEqual(response["Content-Length"], "200000")
+        self.assertEqual(response["Content-Type"], "application/octet-stream")
+        self.assertEqual("".join(response), data)
+
+    def test_offload(self):
+        self.write("a.txt", "hello")
+        lcpath = os.path.join(self.root, "a.txt")
+        self.webdavpath.delivery = "x-sendfile"
+        self.webdavpath.save()
+        response = self.dav("GET", "a.txt")
+        self.assertEqual(response["X-Sendfile"], lcpath)
+        self.assertEqual(response["Content-Type"], "text/plain")
+        self.assertEqual(response.content, "")
+        self.webdavpath.delivery = "x-accel-redirect"
+        self.webdavpath.save()
+        response = self.dav("GET", "a.txt")
+        self.assertEqual(response["X-Accel-Redirect"], "/webdav-internal%s"%lcpath)
+
+    def test_file_wrapper(self):
+        self.write("a.txt", "hello")
+        self.webdavpath.delivery = "file-wrapper"
+        self.webdavpath.save()
+        response = self.dav("GET", "a.txt")
+        self.assertEqual(response["Content-Length"], "5")
+        app = FileWrapperMiddleware(lambda environ, start_response: response)
+        result = app({"wsgi.file_wrapper": FileWrapper}, None)
+        self.assertTrue(isinstance(result, FileWrapper))
+        self.assertEqual("".join(result), "hello")
+        result.close()
+        self.assertTrue(response.file_to_stream.closed)
+        # without a file_wrapper the iterator is used
+        response = self.dav("GET", "a.txt")
+        self.assertTrue(app({}, None) is response)
+        self.assertEqual("".join(response), "hello")
+        response = self.dav("GET", "a.txt", HTTP_RANGE = "bytes=0-1")
+        self.assertFalse(hasattr(response, "file_to_stream"))
+        self.assertEqual("".join(response), "he")
+
+
+class RangeTest(HandlerTestCase):
+
+    def setUp(self):
+        super(RangeTest, self).setUp()
+        self.data = "".join(chr(ord("a") + i % 26) for i in range(1000))
+        self.write("data.txt", self.data)
+
+    def test_parse_range(self):
+        self.assertEqual(parse_range("bytes=0-99", 1000), [(0, 99)])
+        self.assertEqual(parse_range("bytes=-100, 900-", 1000),
+                         [(900, 999), (900, 999)])
+        self.assertEqual(parse_range("bytes=990-2000", 1000), [(990, 999)])
+        self.assertEqual(parse_range("bytes=1000-", 1000), [])
+        self.assertEqual(parse_range("bytes=5-1", 1000), None)
+        self.assertEqual(parse_range("lines=1-2", 1000), None)
+
+    def test_single_range(self):
+        response = self.dav("GET", "data.txt", HTTP_RANGE = "bytes=10-19")
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response["Content-Range"], "bytes 10-19/1000")
+        self.assertEqual(response["Content-Length"], "10")
+        self.assertEqual("".join(response), self.data[10:20])
+
+    def test_multiple_ranges(self):
+        response = self.dav("GET", "data.txt", HTTP_RANGE = "bytes=0-4,-5")
+        self.assertEqual(response.status_code, 206)
+        self.assertTrue(response["Content-Type"].startswith("multipart/byteranges"))
+        body = "".join(response)
+        self.assertEqual(len(body), int(response["Content-Length"]))
+        self.assertTrue("Content-Range: bytes 0-4/1000\r\n\r\n%s\r\n"%self.data[:5] in body)
+        self.assertTrue("Content-Range: bytes 995-999/1000\r\n\r\n%s\r\n"%self.data[-5:] in body)
+
+    def test_unsatisfiable_and_if_range(self):
+        response = self.dav("GET", "data.txt", HTTP_RANGE = "bytes=5000-")
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response["Content-Range"], "bytes */1000")
+        response = self.dav("GET", "data.txt", HTTP_RANGE = "bytes=0-9",
+                            HTTP_IF_RANGE = "Mon, 01 Jan 2001 00:00:00 GMT")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Accept-Ranges"], "bytes")
+        self.assertEqual("".join(response), self.data)
+
+
+class ConditionalTest(HandlerTestCase):
+
+    def setUp(self):
+        super(ConditionalTest, self).setUp()
+        self.write("a.txt", "hello")
+        self.etag = self.dav("GET", "a.txt")["ETag"]
+
+    def test_get_not_modified(self):
+        response = self.dav("GET", "a.txt", HTTP_IF_NONE_MATCH = self.etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response["ETag"], self.etag)
+        response = self.dav("GET", "a.txt", HTTP_IF_NONE_MATCH = "\"other\"")
+        self.assertEqual(response.status_code, 200)
+        last_modified = self.dav("GET", "a.txt")["Last-Modified"]
+        response = self.dav("GET", "a.txt", HTTP_IF_MODIFIED_SINCE = last_modified)
+        self.assertEqual(response.status_code, 304)
+
+    def test_propfind_etag(self):
+        response = self.dav("PROPFIND", "a.txt", PROPFIND_BODY.replace(
+                "<resourcetype/>", "<getetag/>"), HTTP_DEPTH = "0")
+        xml = "".join(response)
+        self.assertTrue("<getetag>%s</getetag>"%self.etag in xml, xml)
+
+    def test_put_if_match(self):
+        response = self.dav("PUT", "a.txt", "lost", HTTP_IF_MATCH = "\"stale\"")
+        self.assertEqual(response.status_code, 412)
+        self.assertEqual(self.read("a.txt"), "hello")
+        response = self.dav("PUT", "a.txt", "new", HTTP_IF_MATCH = self.etag)
+        self.assertEqual(response.status_code, 201)
+        self.assertNotEqual(response["ETag"], self.etag)
+        response = self.dav("PUT", "a.txt", "x", HTTP_IF_NONE_MATCH = "*")
+        self.assertEqual(response.status_code, 412)
+        response = self.dav("PUT", "b.txt", "x", HTTP_IF_MATCH = "*")
+        self.assertEqual(response.status_code, 412)
+
+    def test_delete_if_match(self):
+        response = self.dav("DELETE", "a.txt", HTTP_IF_MATCH = "\"stale\"")
+        self.assertEqual(response.status_code, 412)
+        response = self.dav("DELETE", "a.txt", HTTP_IF_MATCH = self.etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(os.path.exists(os.path.join(self.root, "a.txt")))
+
+
+class HeadTest(HandlerTestCase):
+
+    def test_file(self):
+        self.write("a.txt", "hello")
+        get = self.dav("GET", "a.txt")
+        opened = []
+        import __builtin__
+        saved = __builtin__.file
+        __builtin__.file = lambda *args: opened.append(args) or saved(*args)
+        try:
+            response = self.dav("HEAD", "a.txt")
+        finally:
+            __builtin__.file = saved
+        self.assertEqual(opened, [])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, "")
+        for header in ("Content-Length", "Content-Type", "ETag", "Last-Modified"):
+            self.assertEqual(response[header], get[header])
+
+    def test_directory(self):
+        os.mkdir(os.path.join(self.root, "sub"))
+        response = self.dav("HEAD", "sub")
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.has_header("ETag"))
+        self.assertEqual(self.dav("HEAD", "missing").status_code, 404)
+
+    def test_single_stat(self):
+        self.write("a.txt", "hello")
+        os.symlink(os.path.join(self.root, "a.txt"), os.path.join(self.root, "link"))
+        path = os.path.join(self.root, "a.txt")
+        calls = []
+        def counting(funct):
+            def wrapper(*args, **kwargs):
+                if args[0] == path:
+                    calls.append(funct.__name__)
+                return funct(*args, **kwargs)
+            return wrapper
+        saved = os.stat, os.lstat
+        # a warm ACL cache, which would revalidate with stats of its own
+        with self.settings(WEBDAV_ACL_CACHE_TTL = 60):
+            self.dav("HEAD", "a.txt")
+            os.stat, os.lstat = counting(os.stat), counting(os.lstat)
+            try:
+                response = self.dav("HEAD", "a.txt")
+            finally:
+                os.stat, os.lstat = saved
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(calls, ["lstat"])
+        self.assertEqual(self.dav("HEAD", "link").status_code, 404)
+
+
+class PutTest(HandlerTestCase):
+    quota = 1
+
+    def test_atomic_replace(self):
+        self.write("a.txt", "old")
+        os.chmod(os.path.join(self.root, "a.txt"), 0640)
+        with self.settings(WEBDAV_UPLOAD_BUFFER_SIZE = 7, WEBDAV_UPLOAD_FSYNC = True):
+            response = self.dav("PUT", "a.txt", "new contents")
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(self.read("a.txt"), "new contents")
+        self.assertEqual(os.stat(os.path.join(self.root, "a.txt")).st_mode & 0777, 0640)
+        self.assertEqual(os.listdir(self.root), ["a.txt"])
+
+    def test_early_quota_rejection(self):
+        self.write("a.txt", "old")
+        data = "x" * WebdavPath.QUOTA_SIZE_MULT
+        response = self.dav("PUT", "a.txt", data)
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(self.read("a.txt"), "old")
+
+    def test_quota_exceeded_midway(self):
+        self.write("a.txt", "old")
+        lcpath = os.path.join(self.root, "a.txt")
+        self.assertRaises(QuotaExceeded, PutHandler().receive,
+                          StringIO("x" * 1000), lcpath, 100, 0644)
+        self.assertEqual(self.read("a.txt"), "old")
+        self.assertEqual(os.listdir(self.root), ["a.txt"])
+
+
+class ResumableUploadTest(HandlerTestCase):
+    quota = 1
+
+    def put_range(self, data, content_range):
+        return self.dav("PUT", "big.bin", data, HTTP_CONTENT_RANGE = content_range)
+
+    def test_resume(self):
+        data = "".join(chr(ord("a") + i % 26) for i in range(100))
+        response = self.put_range(data[:40], "bytes 0-39/100")
+        self.assertEqual(response.status_code, 204)
+        self.assertEqual(response["Upload-Offset"], "40")
+        self.assertFalse(os.path.exists(os.path.join(self.root, "big.bin")))
+        # the connection dropped, ask where to continue
+        response = self.put_range("", "bytes */100")
+        self.assertEqual(response["Upload-Offset"], "40")
+        response = self.put_range(data[50:], "bytes 50-99/100")
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response["Upload-Offset"], "40")
+        response = self.put_range(data[40:], "bytes 40-99/100")
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(self.read("big.bin"), data)
+        self.assertEqual(UploadSession.objects.count(), 0)
+        self.assertEqual(os.listdir(self.root), ["big.bin"])
+        self.assertEqual(QuotaLedger.objects.get(webdavpath = self.webdavpath).used_size, 100)
+
+    def test_quota_and_bad_ranges(self):
+        total = WebdavPath.QUOTA_SIZE_MULT
+        self.assertEqual(self.put_range("x", "bytes 0-0/%d"%total).status_code, 403)
+        self.assertEqual(self.put_range("x", "bytes 0-5/3").status_code, 400)
+        self.assertEqual(self.put_range("xx", "bytes 0-0/3").status_code, 400)
+
+    def test_open_sessions_count(self):
+        half = WebdavPath.QUOTA_SIZE_MULT / 2
+        response = self.dav("PUT", "a.bin", "x", HTTP_CONTENT_RANGE = "bytes 0-0/%d"%half)
+        self.assertEqual(response.status_code, 204)
+        # a second session of the same size doesn't fit next to the first
+        response = self.dav("PUT", "b.bin", "x", HTTP_CONTENT_RANGE = "bytes 0-0/%d"%half)
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(self.dav("PUT", "c.bin", "x" * 10).status_code, 201)
+        response = self.dav("PUT", "a.bin", "x", HTTP_CONTENT_RANGE = "bytes 1-1/%d"%half)
+        self.assertEqual(response.status_code, 204)
+        session = UploadSession.objects.get()
+        UploadSession.objects.update(updated = session.updated - UploadSession.get_expiry())
+        response = self.dav("PUT", "b.bin", "x", HTTP_CONTENT_RANGE = "bytes 0-0/%d"%half)
+        self.assertEqual(response.status_code, 204)
+
+    def test_expire(self):
+        self.put_range("abc", "bytes 0-2/10")
+        session = UploadSession.objects.get()
+        UploadSession.objects.update(updated = session.updated - UploadSession.get_expiry())
+        call_command("webdav_expire_uploads", verbosity = 0)
+        self.assertEqual(UploadSession.objects.count(), 0)
+        self.assertFalse(os.path.exists(session.staging_path))
+
+
+class TreeTestCase(HandlerTestCase):
+
+    def make_tree(self):
+        os.makedirs(os.path.join(self.root, "src", "sub"))
+        for name in ("src/a", "src/b", "src/sub/c"):
+            self.write(name, name * 1000)
+        os.chmod(os.path.join(self.root, "src", "a"), 0600)
+
+
+class CopyTest(TreeTestCase):
+
+    def test_copy_methods(self):
+        self.write("a", "x" * 100000)
+        for method in fileops.COPY_METHODS:
+            fdin = os.open(os.path.join(self.root, "a"), os.O_RDONLY)
+            fdout = os.open(os.path.join(self.root, method), os.O_WRONLY | os.O_CREAT)
+            try:
+                used = fileops.copy_fd(fdin, fdout, 100000, [method])
+            finally:
+                os.close(fdin)
+                os.close(fdout)
+            self.assertEqual(self.read(method), "x" * 100000)
+            if used != method:
+                # not supported by this kernel or filesystem
+                self.assertEqual(used, "buffered")
+
+    def test_copy_tree(self):
+        self.make_tree()
+        response = self.dav("COPY", "src", HTTP_DESTINATION = "/webdav/dav/dst")
+        self.assertEqual(response.status_code, 201)
+        for name in ("a", "b", "sub/c"):
+            self.assertEqual(self.read("dst/" + name), ("src/" + name) * 1000)
+        self.assertEqual(os.stat(os.path.join(self.root, "dst", "a")).st_mode & 0777, 0600)
+
+    def test_depth_zero(self):
+        self.make_tree()
+        response = self.dav("COPY", "src", HTTP_DESTINATION = "/webdav/dav/dst",
+                            HTTP_DEPTH = "0")
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(os.listdir(os.path.join(self.root, "dst")), [])
+        response = self.dav("COPY", "src", HTTP_DESTINATION = "/webdav/dav/dst",
+                            HTTP_DEPTH = "1")
+        self.assertEqual(response.status_code, 400)
+
+    def test_overwrite(self):
+        self.make_tree()
+        self.mkdir("root", "dst", "old")
+        response = self.dav("COPY", "src", HTTP_DESTINATION = "/webdav/dav/dst",
+                            HTTP_OVERWRITE = "F")
+        self.assertEqual(response.status_code, 412)
+        response = self.dav("COPY", "src", HTTP_DESTINATION = "/webdav/dav/dst")
+        self.assertEqual(response.status_code, 204)
+        self.assertEqual(sorted(os.listdir(os.path.join(self.root, "dst"))),
+                         ["a", "b", "sub"])
+        response = self.dav("COPY", "src", HTTP_DESTINATION = "/webdav/dav/src/sub/x")
+        self.assertEqual(response.status_code, 403)
+
+    def test_errors_are_multistatus(self):
+        self.make_tree()
+        copy_file = fileops.copy_file
+        def failing_copy(src, dst, methods = None, replace = True):
+            if src.endswith("/b"):
+                raise IOError(28, "No space left on device")
+            return copy_file(src, dst, methods, replace)
+        fileops.copy_file = failing_copy
+        try:
+            response = self.dav("COPY", "src", HTTP_DESTINATION = "/webdav/dav/dst")
+        finally:
+            fileops.copy_file = copy_file
+        self.assertEqual(response.status_code, 207)
+        self.assertTrue("<href>/webdav/dav/dst/b</href>" in response.content)
+        self.assertTrue("507 Insufficient Storage" in response.content)
+        self.assertEqual(self.read("dst/sub/c"), "src/sub/c" * 1000)
+
+
+class MoveTest(TreeTestCase):
+    quota = 1
+
+    def usage(self):
+        ledger = QuotaLedger.objects.get(webdavpath = self.webdavpath)
+        return ledger.used_size, ledger.num_files
+
+    def test_rename_collection(self):
+        self.make_tree()
+        inode = os.stat(os.path.join(self.root, "src", "sub", "c")).st_ino
+        self.assertEqual(self.dav("PUT", "x", "y" * 10).status_code, 201)
+        usage = self.usage()
+        response = self.dav("MOVE", "src", HTTP_DESTINATION = "/webdav/dav/dst")
+        self.assertEqual(response.status_code, 201)
+        self.assertFalse(os.path.exists(os.path.join(self.root, "src")))
+        self.assertEqual(os.stat(os.path.join(self.root, "dst", "sub", "c")).st_ino, inode)
+        self.assertEqual(self.usage(), usage)
+
+    def test_overwrite(self):
+        self.make_tree()
+        self.mkdir("root", "dst", "old")
+        self.write("f", "f")
+        response = self.dav("MOVE", "src", HTTP_DESTINATION = "/webdav/dav/dst",
+                            HTTP_OVERWRITE = "F")
+        self.assertEqual(response.status_code, 412)
+        response = self.dav("MOVE", "src", HTTP_DESTINATION = "/webdav/dav/nowhere/sub")
+        self.assertEqual(response.status_code, 409)
+        response = self.dav("MOVE", "src", HTTP_DESTINATION = "/webdav/dav/dst")
+        self.assertEqual(response.status_code, 204)
+        self.assertEqual(sorted(os.listdir(os.path.join(self.root, "dst"))),
+                         ["a", "b", "sub"])
+        response = self.dav("MOVE", "f", HTTP_DESTINATION = "/webdav/dav/dst/a")
+        self.assertEqual(response.status_code, 204)
+        self.assertEqual(self.read("dst/a"), "f")
+        self.assertEqual(QuotaLedger.reconcile(self.webdavpath).used_size, self.usage()[0])
+
+    def cross_device(self, src, dst):
+        raise OSError(18, "Invalid cross-device link")
+
+    def test_cross_device(self):
+        self.make_tree()
+        rename_noreplace = webdav_handlers.rename_noreplace
+        webdav_handlers.rename_noreplace = self.cross_device
+        try:
+            response = self.dav("MOVE", "src", HTTP_DESTINATION = "/webdav/dav/dst")
+        finally:
+            webdav_handlers.rename_noreplace = rename_noreplace
+        self.assertEqual(response.status_code, 201)
+        self.assertFalse(os.path.exists(os.path.join(self.root, "src")))
+        self.assertEqual(self.read("dst/sub/c"), "src/sub/c" * 1000)
+
+
+class DeleteTest(TreeTestCase):
+    quota = 1
+
+    def trash(self):
+        return os.path.join(self.root, ".webdav-trash")
+
+    @override_settings(WEBDAV_TRASH_REAPER = "command")
+    def test_deferred_removal(self):
+        self.make_tree()
+        QuotaLedger.reconcile(self.webdavpath)
+        self.assertEqual(self.dav("DELETE", "src").status_code, 200)
+        self.assertFalse(os.path.exists(os.path.join(self.root, "src")))
+        self.assertEqual(len(os.listdir(self.trash())), 1)
+        # not walked during the request, rescanned on the next check
+        self.assertFalse(QuotaLedger.objects.exists())
+        self.assertEqual(QuotaLedger.get_usage(self.webdavpath), (0, 0))
+        response = self.dav("PROPFIND", "", PROPFIND_BODY)
+        self.assertFalse(".webdav-trash" in response.content)
+        self.assertEqual(self.dav("GET", ".webdav-trash/").status_code, 403)
+        call_command("webdav_empty_trash", verbosity = 0)
+        self.assertEqual(os.listdir(self.trash()), [])
+
+    @override_settings(WEBDAV_TRASH_REAPER = "command")
+    def test_usage_from_index(self):
+        self.make_tree()
+        self.write("keep", "x" * 10)
+        self.webdavpath.indexed = True
+        self.webdavpath.save()
+        metadata.reconcile(self.webdavpath)
+        QuotaLedger.reconcile(self.webdavpath)
+        self.assertEqual(self.dav("DELETE", "src").status_code, 200)
+        ledger = QuotaLedger.objects.get(webdavpath = self.webdavpath)
+        self.assertEqual((ledger.used_size, ledger.num_files), (10, 1))
+
+    def test_hidden_names_rejected(self):
+        self.write("a", "x")
+        name = ".webdav-upload-x"
+        self.assertEqual(self.dav("PUT", name, "x").status_code, 403)
+        self.assertEqual(self.dav("MKCOL", name).status_code, 403)
+        self.assertEqual(self.dav("MKCOL", ".webdav-trash").status_code, 403)
+        for method in ("COPY", "MOVE"):
+            response = self.dav(method, "a", HTTP_DESTINATION = "/webdav/dav/%s"%name)
+            self.assertEqual(response.status_code, 403)
+        self.assertEqual(os.listdir(self.root), ["a"])
+
+    def test_reaper_thread(self):
+        self.make_tree()
+        self.assertEqual(self.dav("DELETE", "src").status_code, 200)
+        for i in range(100):
+            if not os.listdir(self.trash()):
+                break
+            time.sleep(0.05)
+        self.assertEqual(os.listdir(self.trash()), [])
+
+
+LOCKINFO = ("<?xml version=\"1.0\" encoding=\"utf-8\"?><lockinfo xmlns=\"DAV:\">"
+            "<lockscope><%s/></lockscope><locktype><write/></locktype>"
+            "<owner><href>mailto:owner@example.com</href></owner></lockinfo>")
+
+
+class LockTest(HandlerTestCase):
+
+    def setUp(self):
+        super(LockTest, self).setUp()
+        locks.LOCK_BACKENDS[locks.LOCK_BACKEND_LOCAL] = locks.LocalLockBackend()
+        self.write("a", "a")
+
+    def tearDown(self):
+        locks.LOCK_BACKENDS[locks.LOCK_BACKEND_LOCAL] = locks.LocalLockBackend()
+        super(LockTest, self).tearDown()
+
+    def lock(self, path, scope = "exclusive", **extra):
+        return self.dav("LOCK", path, LOCKINFO%scope, **extra)
+
+    def test_exclusive(self):
+        response = self.lock("a", HTTP_TIMEOUT = "Second-100")
+        self.assertEqual(response.status_code, 200)
+        token = response["Lock-Token"]
+        self.assertTrue("<timeout>Second-100</timeout>" in response.content)
+        self.assertTrue("mailto:owner@example.com" in response.content)
+        self.assertEqual(self.dav("PUT", "a", "b").status_code, 423)
+        self.assertEqual(self.dav("DELETE", "a").status_code, 423)
+        self.assertEqual(self.lock("a", "shared").status_code, 423)
+        self.assertEqual(self.dav("PUT", "a", "b", HTTP_IF = "(%s)"%token).status_code, 201)
+        # refresh with an empty body
+        response = self.dav("LOCK", "a", HTTP_IF = "(%s)"%token, HTTP_TIMEOUT = "Second-200")
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue("<timeout>Second-200</timeout>" in response.content)
+        self.assertEqual(self.dav("UNLOCK", "a", HTTP_LOCK_TOKEN = token).status_code, 204)
+        self.assertEqual(self.dav("UNLOCK", "a", HTTP_LOCK_TOKEN = token).status_code, 409)
+        self.assertEqual(self.dav("PUT", "a", "c").status_code, 201)
+
+    def test_depth_and_shared(self):
+        os.mkdir(os.path.join(self.root, "dir"))
+        token = self.lock("dir", "shared")["Lock-Token"]
+        self.assertEqual(self.lock("dir", "shared").status_code, 200)
+        self.assertEqual(self.lock("dir/x", "exclusive").status_code, 423)
+        self.assertEqual(self.dav("PUT", "dir/x", "x").status_code, 423)
+        self.assertEqual(self.dav("PUT", "dir/x", "x", HTTP_IF = "(%s)"%token).status_code, 201)
+        self.assertEqual(self.dav("MOVE", "a", HTTP_DESTINATION = "/webdav/dav/dir/a").status_code, 423)
+        self.assertEqual(self.dav("DELETE", "dir", HTTP_IF = "(%s)"%token).status_code, 200)
+        self.assertEqual(self.lock("dir/x", "exclusive").status_code, 409)
+
+    def test_lock_null_and_expiry(self):
+        response = self.lock("new")
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(self.read("new"), "")
+        for lock in locks.get_lock_backend().get_covering(locks.get_lock_path("/webdav/dav/new")):
+            lock.expires = time.time() - 1
+            locks.get_lock_backend().update(lock)
+        self.assertEqual(self.dav("PUT", "new", "x").status_code, 201)
+
+    def test_if_header(self):
+        token = self.lock("a")["Lock-Token"]
+        etag = self.dav("HEAD", "a")["ETag"]
+        self.assertEqual(self.dav("PUT", "a", "b", HTTP_IF = "(%s [\"other\"])"%token).status_code, 412)
+        self.assertEqual(self.dav("PUT", "a", "b", HTTP_IF = "(%s [%s])"%(token, etag)).status_code, 201)
+        self.assertEqual(self.dav("PUT", "a", "b", HTTP_IF = "(Not %s)"%token).status_code, 412)
+        self.assertEqual(self.dav("PUT", "a", "b", HTTP_IF = "(Not <urn:x>)").status_code, 423)
+        self.assertEqual(self.dav("PUT", "a", "b", HTTP_IF = "(broken").status_code, 400)
+        tagged = "</webdav/dav/a> (%s)"%token
+        self.assertEqual(self.dav("PUT", "a", "b", HTTP_IF = tagged).status_code, 201)
+        self.assertEqual(locks.parse_if_header("<http://h/x%20y> (Not <t1> [\"e\"]) (<t2>)"),
+                         [(u"/x y", [(True, "t1", None), (False, None, "\"e\"")]),
+                          (u"/x y", [(False, "t2", None)])])
+
+    def test_if_header_copy_move(self):
+        self.write("b", "other")
+        token = self.lock("a")["Lock-Token"]
+        etag = self.dav("HEAD", "a")["ETag"]
+        # untagged lists are about the source, not the destination
+        condition = "(%s [%s])"%(token, etag)
+        response = self.dav("COPY", "a", HTTP_DESTINATION = "/webdav/dav/b", HTTP_IF = condition)
+        self.assertEqual(response.status_code, 204)
+        response = self.dav("MOVE", "a", HTTP_DESTINATION = "/webdav/dav/c",
+                            HTTP_IF = "(%s [\"stale\"])"%token)
+        self.assertEqual(response.status_code, 412)
+        response = self.dav("MOVE", "a", HTTP_DESTINATION = "/webdav/dav/c", HTTP_IF = condition)
+        self.assertEqual(response.status_code, 201)
+
+    def test_propfind_lockdiscovery(self):
+        token = self.lock("a")["Lock-Token"]
+        content = self.dav("PROPFIND", "", HTTP_DEPTH = "1").content
+        self.assertTrue(token[1:-1] in content)
+        self.assertTrue("<supportedlock>" in content)
+
+
+@override_settings(WEBDAV_LOCK_BACKEND = "database")
+class DatabaseLockTest(LockTest):
+    pass
+
+
+PROPPATCH_BODY = ("<?xml version=\"1.0\" encoding=\"utf-8\"?>"
+                  "<D:propertyupdate xmlns:D=\"DAV:\" xmlns:Z=\"urn:z\"><D:set><D:prop>"
+                  "<Z:color>red &amp; blue</Z:color>"
+                  "<Z:tags><Z:tag>a</Z:tag><D:href>b</D:href></Z:tags>"
+                  "</D:prop></D:set><D:remove><D:prop><Z:gone/></D:prop></D:remove>"
+                  "</D:propertyupdate>")
+
+
+class PropertyTest(TreeTestCase):
+    # database queries for a batched lookup of five paths
+    lookup_queries = 3
+
+    def proppatch(self, path, body = PROPPATCH_BODY):
+        return self.dav("PROPPATCH", path, body)
+
+    def propfind(self, path, depth = "0", body = ""):
+        return self.dav("PROPFIND", path, body, HTTP_DEPTH = depth).content
+
+    def test_set_and_find(self):
+        self.write("a", "a")
+        response = self.proppatch("a")
+        self.assertEqual(response.status_code, 207)
+        self.assertTrue("HTTP/1.1 200 OK" in response.content)
+        content = self.propfind("a")
+        self.assertTrue("<color xmlns=\"urn:z\">red &amp; blue</color>" in content)
+        self.assertTrue("<tags xmlns=\"urn:z\"><tag>a</tag><href xmlns=\"DAV:\">b</href></tags>"
+                        in content)
+        body = ("<?xml version=\"1.0\"?><propfind xmlns=\"DAV:\"><prop><getetag/>"
+                "<color xmlns=\"urn:z\"/><size xmlns=\"urn:z\"/></prop></propfind>")
+        content = self.propfind("a", body = body)
+        self.assertTrue("red &amp; blue" in content)
+        self.assertTrue("<size xmlns=\"urn:z\"></size></prop><status>HTTP/1.1 404 Not Found"
+                        in content)
+        self.proppatch("a", PROPPATCH_BODY.replace("<Z:gone/>", "<Z:color/>"))
+        self.assertFalse("red &amp;" in self.propfind("a"))
+
+    def test_protected(self):
+        self.write("a", "a")
+        body = PROPPATCH_BODY.replace("<Z:color>", "<D:getetag>x</D:getetag><Z:color>")
+        content = self.proppatch("a", body).content
+        self.assertTrue("403 Forbidden" in content)
+        self.assertTrue("424 Failed Dependency" in content)
+        self.assertEqual(get_property_store().get(os.path.join(self.root, "a")), {})
+
+    @override_settings(WEBDAV_PROPERTY_BATCH_SIZE = 2)
+    def test_batched_lookup(self):
+        for name in "abcde":
+            self.write(name, name)
+            self.proppatch(name)
+        paths = [os.path.join(self.root, name) for name in "abcde"]
+        with self.assertNumQueries(self.lookup_queries):
+            self.assertEqual(len(get_property_store().get_many(paths)), 5)
+        self.assertEqual(self.propfind("", "1").count("red &amp; blue"), 5)
+
+    def test_copy_move_delete(self):
+        self.make_tree()
+        self.proppatch("src/sub/c")
+        self.dav("COPY", "src", HTTP_DESTINATION = "/webdav/dav/copy")
+        self.assertTrue("red &amp;" in self.propfind("copy/sub/c"))
+        self.dav("MOVE", "copy", HTTP_DESTINATION = "/webdav/dav/moved")
+        self.assertTrue("red &amp;" in self.propfind("moved/sub/c"))
+        self.dav("DELETE", "moved")
+        self.assertEqual(get_property_store().get(os.path.join(self.root, "moved", "sub", "c")), {})
+        self.assertEqual(get_property_store().get(os.path.join(self.root, "copy", "sub", "c")), {})
+        self.assertTrue("red &amp;" in self.propfind("src/sub/c"))
+
+    def test_database_tree_operations(self):
+        store = DatabasePropertyStore()
+        for name in ["src", "src/a", "src/sub/b", "srcx"]:
+            store.patch("/m/" + name, [(("urn:z", "p"), name)])
+        with self.assertNumQueries(2):
+            store.copy("/m/src", "/m/copy")
+        with self.assertNumQueries(1):
+            store.move("/m/copy", "/m/moved")
+        paths = set(DeadProperty.objects.values_list("path", flat = True))
+        self.assertEqual(paths, set(["/m/src", "/m/src/a", "/m/src/sub/b", "/m/srcx",
+                                     "/m/moved", "/m/moved/a", "/m/moved/sub/b"]))
+        self.assertEqual(store.get("/m/moved/sub/b"), {("urn:z", "p"): "src/sub/b"})
+
+    def test_put_keeps_properties(self):
+        self.write("a", "a")
+        self.proppatch("a")
+        self.assertEqual(self.dav("PUT", "a", "new").status_code, 201)
+        self.assertTrue("red &amp;" in self.propfind("a"))
+        self.dav("PUT", "a", "1", HTTP_CONTENT_RANGE = "bytes 0-0/2")
+        self.dav("PUT", "a", "2", HTTP_CONTENT_RANGE = "bytes 1-1/2")
+        self.assertEqual(self.read("a"), "12")
+        self.assertTrue("red &amp;" in self.propfind("a"))
+
+
+@unittest.skipUnless(props.xattr, "xattr module not installed")
+class XattrPropertyTest(PropertyTest):
+    lookup_queries = 0
+
+    def setUp(self):
+        super(XattrPropertyTest, self).setUp()
+        self.write("probe", "")
+        try:
+            props.xattr.setxattr(os.path.join(self.root, "probe"), "user.probe", "x")
+        except (IOError, OSError):
+            self.skipTest("no user xattrs on this filesystem")
+        os.remove(os.path.join(self.root, "probe"))
+        self.settings_override = override_settings(WEBDAV_PROPERTY_STORE = "xattr")
+        self.settings_override.enable()
+
+    def tearDown(self):
+        self.settings_override.disable()
+        super(XattrPropertyTest, self).tearDown()
+
+
+class MetadataIndexTest(TreeTestCase):
+
+    def setUp(self):
+        super(MetadataIndexTest, self).setUp()
+        self.webdavpath.indexed = True
+        self.webdavpath.save()
+        self.make_tree()
+        metadata.reconcile(self.webdavpath)
+
+    def get_rows(self):
+        return set(MetadataEntry.objects.values_list("path", "parent", "is_dir",
+                                                     "size", "etag"))
+
+    def propfind(self, path, depth = "1"):
+        response = self.dav("PROPFIND", path, "", HTTP_DEPTH = depth)
+        return sorted("".join(response).split("<response>"))
+
+    def test_reconcile(self):
+        self.assertEqual(MetadataEntry.objects.count(), 6)
+        self.assertEqual(MetadataScan.objects.get().num_entries, 6)
+        self.assertEqual(MetadataEntry.get_usage(self.webdavpath, self.root),
+                         (19000, 3))
+
+    def test_propfind_from_index(self):
+        indexed = self.propfind("src/"), self.propfind("", "infinity")
+        MetadataScan.objects.all().delete()
+        self.assertEqual((self.propfind("src/"), self.propfind("", "infinity")), indexed)
+        metadata.reconcile(self.webdavpath)
+        # changes behind the index's back are not seen, unknown paths are
+        # looked up on disk
+        self.write("src/external", "x")
+        self.assertFalse("external" in "".join(self.propfind("src/")))
+        os.mkdir(os.path.join(self.root, "ext"))
+        self.write("ext/file", "x")
+        self.assertTrue("/webdav/dav/ext/file" in "".join(self.propfind("ext/")))
+
+    def test_etag_from_index(self):
+        path = os.path.join(self.root, "src", "a")
+        # as read back from a database that rounds the float
+        MetadataEntry.objects.filter(path = path).update(mtime = int(os.stat(path).st_mtime))
+        etag = self.dav("HEAD", "src/a")["ETag"]
+        self.assertTrue("<getetag>%s</getetag>"%etag in "".join(self.propfind("src/a", "0")))
+
+    def test_follows_writes(self):
+        self.dav("PUT", "src/new", "x" * 10)
+        self.dav("PUT", "src/a", "y")
+        self.dav("MKCOL", "dir")
+        self.dav("COPY", "src", HTTP_DESTINATION = "/webdav/dav/dir/copy")
+        self.dav("MOVE", "dir/copy/sub", HTTP_DESTINATION = "/webdav/dav/moved")
+        self.dav("DELETE", "src/b")
+        self.dav("DELETE", "dir/copy")
+        rows = self.get_rows()
+        metadata.reconcile(self.webdavpath)
+        self.assertEqual(rows, self.get_rows())
+
+    def test_quota_from_index(self):
+        self.write("external", "x" * 10)
+        self.assertEqual(QuotaLedger.reconcile(self.webdavpath).used_size, 19000)
+        call_command("webdav_reconcile_metadata", verbosity = 0)
+        self.assertEqual(QuotaLedger.reconcile(self.webdavpath).used_size, 19010)
+        self.webdavpath.save()
+        self.assertFalse(MetadataScan.is_warm(self.webdavpath))
+
+
+SYNC_BODY = ("<?xml version=\"1.0\" encoding=\"utf-8\"?><D:sync-collection xmlns:D=\"DAV:\">"
+             "<D:sync-token>%s</D:sync-token><D:sync-level>%s</D:sync-level>"
+             "<D:prop><D:getetag/></D:prop></D:sync-collection>")
+
+
+class SyncCollectionTest(TreeTestCase):
+
+    def setUp(self):
+        super(SyncCollectionTest, self).setUp()
+        self.make_tree()
+
+    def report(self, token = "", level = "1", path = "src/", depth = "0"):
+        response = self.dav("REPORT", path, SYNC_BODY%(token, level), HTTP_DEPTH = depth)
+        content = "".join(response)
+        if response.status_code != 207:
+            return response.status_code, content, None
+        token = content.split("<sync-token>")[1].split("</sync-token>")[0]
+        return response.status_code, content, token
+
+    def hrefs(self, content, status = "200 OK"):
+        hrefs = []
+        for response in content.split("<response>")[1:]:
+            if status in response:
+                hrefs.append(response.split("<href>")[1].split("</href>")[0])
+        return sorted(hrefs)
+
+    def test_initial(self):
+        status, content, token = self.report()
+        self.assertEqual(status, 207)
+        self.assertEqual(self.hrefs(content), ["/webdav/dav/src/a", "/webdav/dav/src/b",
+                                               "/webdav/dav/src/sub"])
+        status, content, token = self.report(level = "infinite")
+        self.assertEqual(len(self.hrefs(content)), 4)
+        self.assertTrue("<getetag>" in content)
+
+    def test_changes(self):
+        status, content, token = self.report()
+        status, content, token = self.report(token)
+        self.assertEqual(self.hrefs(content), [])
+        self.dav("PUT", "src/new", "x")
+        self.dav("PUT", "src/sub/deep", "x")
+        self.dav("DELETE", "src/b")
+        self.dav("PUT", "elsewhere", "x")
+        status, content, next_token = self.report(token)
+        self.assertEqual(self.hrefs(content), ["/webdav/dav/src/new", "/webdav/dav/src/sub"])
+        self.assertEqual(self.hrefs(content, "404 Not Found"), ["/webdav/dav/src/b"])
+        status, content, ignored = self.report(token, "infinite")
+        self.assertEqual(self.hrefs(content), ["/webdav/dav/src/new", "/webdav/dav/src/sub",
+                                               "/webdav/dav/src/sub/deep"])
+        self.dav("COPY", "src/sub", HTTP_DESTINATION = "/webdav/dav/src/copy")
+        status, content, ignored = self.report(next_token, "infinite")
+        self.assertEqual(self.hrefs(content), ["/webdav/dav/src/copy",
+                                               "/webdav/dav/src/copy/c",
+                                               "/webdav/dav/src/copy/deep"])
+
+    def test_invalid_tokens(self):
+        status, content, token = self.report()
+        self.assertEqual(self.report("urn:bogus")[0], 403)
+        future = sync.format_token(sync.get_current() + 1)
+        self.assertTrue("valid-sync-token" in self.report(future)[1])
+        # the collection itself was replaced, members can't be told apart
+        self.dav("MOVE", "src", HTTP_DESTINATION = "/webdav/dav/old")
+        self.dav("MKCOL", "src")
+        self.assertEqual(self.report(token)[0], 403)
+        self.assertTrue("supported-report" in self.report(path = "old/a")[1])
+
+    def test_depth_and_limit(self):
+        self.assertEqual(self.report(depth = "1")[0], 400)
+        with self.settings(WEBDAV_PROPFIND_MAX_ENTRIES = 2):
+            status, content, token = self.report(level = "infinite")
+            self.assertEqual(len(self.hrefs(content)), 2)
+            self.assertTrue("number-of-matches-within-limits" in content)
+            self.assertEqual(len(self.hrefs(self.report()[1])), 3)
+        with self.settings(WEBDAV_PROPFIND_MAX_ENTRIES = 0):
+            self.assertTrue("sync-traversal-supported"
+                            in self.report(level = "infinite")[1])
+
+    def test_paged_token(self):
+        with self.settings(WEBDAV_PROPFIND_MAX_ENTRIES = 2):
+            status, content, token = self.report(level = "infinite")
+            self.assertTrue("number-of-matches-within-limits" in content)
+            first = self.hrefs(content)
+            status, content, token = self.report(token, "infinite")
+            self.assertEqual(status, 207)
+            self.assertFalse("number-of-matches-within-limits" in content)
+            self.assertEqual(sorted(first + self.hrefs(content)),
+                             ["/webdav/dav/src/a", "/webdav/dav/src/b",
+                              "/webdav/dav/src/sub", "/webdav/dav/src/sub/c"])
+            self.assertEqual(self.hrefs(self.report(token, "infinite")[1]), [])
+            self.dav("PUT", "src/new", "x")
+            self.dav("PUT", "src/sub/d", "x")
+            self.dav("DELETE", "src/a")
+            status, content, paged = self.report(token, "infinite")
+            self.assertTrue("number-of-matches-within-limits" in content)
+            sent = self.hrefs(content) + self.hrefs(content, "404 Not Found")
+            status, content, token = self.report(paged, "infinite")
+            self.assertFalse("number-of-matches-within-limits" in content)
+            sent += self.hrefs(content) + self.hrefs(content, "404 Not Found")
+            self.assertEqual(sorted(sent), ["/webdav/dav/src/a", "/webdav/dav/src/new",
+                                            "/webdav/dav/src/sub", "/webdav/dav/src/sub/d"])
+            self.assertEqual(self.hrefs(self.report(token, "infinite")[1]), [])
+
+    def test_removed_follow_acl(self):
+        User.objects.create_user("other", "", "secret")
+        self.write("src/" + DirectoryACL.ACL_FILENAME, "read=other\n")
+        self.write("src/sub/" + DirectoryACL.ACL_FILENAME, "read=nobody\n")
+        status, content, token = self.report(level = "infinite")
+        self.dav("PUT", "src/sub/d", "x")
+        self.dav("DELETE", "src/sub/c")
+        self.dav("DELETE", "src/b")
+        self.auth = "Basic %s"%"other:secret".encode("base64").strip()
+        status, content, ignored = self.report(token, "infinite")
+        self.assertEqual(status, 207)
+        self.assertEqual(self.hrefs(content, "404 Not Found"), ["/webdav/dav/src/b"])
+        self.assertFalse("src/sub/" in content)
+
+    def test_compact(self):
+        status, content, token = self.report()
+        for i in range(3):
+            self.dav("PUT", "src/a", "x%d"%i)
+        self.dav("DELETE", "src/b")
+        self.assertEqual(sync.compact(), 2)
+        status, content, ignored = self.report(token)
+        self.assertEqual(self.hrefs(content), ["/webdav/dav/src/a"])
+        self.assertEqual(self.hrefs(content, "404 Not Found"), ["/webdav/dav/src/b"])
+        self.dav("PUT", "src/c", "x")
+        call_command("webdav_compact_journal", verbosity = 0)
+        self.assertEqual(sync.compact(max_age = -1), 2)
+        self.assertEqual(JournalEntry.objects.count(), 1)
+        self.assertEqual(self.report(token)[0], 403)
+        status, content, token = self.report()
+        self.assertEqual(status, 207)
+        self.assertEqual(self.hrefs(self.report(token)[1]), [])
+
+
+class WatcherTest(HandlerTestCase):
+    quota = 1
+
+    def collect(self, backend, expected, timeout = 5):
+        changes = {}
+        deadline = time.time() + timeout
+        while time.time() < deadline and not set(expected) <= set(changes.items()):
+            for path, recursive in backend.read(0.1):
+                changes[path] = changes.get(path) or recursive
+        return changes
+
+    def path(self, *names):
+        return os.path.join(self.root, *names)
+
+    def test_inotify(self):
+        try:
+            backend = watcher.InotifyBackend([self.root])
+        except OSError:
+            return self.skipTest("inotify not available")
+        try:
+            self.write("a", "x")
+            os.mkdir(self.path("d"))
+            self.write(".webdav-upload-x", "x")
+            changes = self.collect(backend, [(self.path("a"), False), (self.path("d"), True)])
+            self.assertEqual(set(changes), set([self.path("a"), self.path("d")]))
+            self.write("d/b", "x")
+            self.assertTrue(self.path("d", "b") in self.collect(backend, [(self.path("d", "b"), False)]))
+            os.rename(self.path("d"), self.path("e"))
+            changes = self.collect(backend, [(self.path("d"), True), (self.path("e"), True)])
+            self.assertEqual(changes.get(self.path("e")), True)
+            self.write("e/c", "x")
+            self.assertTrue(self.path("e", "c") in self.collect(backend, [(self.path("e", "c"), False)]))
+        finally:
+            backend.close()
+
+    @override_settings(WEBDAV_WATCHER_INTERVAL = 0)
+    def test_polling(self):
+        self.write("a", "x")
+        backend = watcher.PollingBackend([self.root])
+        self.assertEqual(backend.read(0), [])
+        os.mkdir(self.path("d"))
+        self.write("d/b", "x")
+        os.remove(self.path("a"))
+        changes = dict(backend.read(0))
+        self.assertEqual(set(changes), set([self.root, self.path("a"), self.path("d"),
+                                            self.path("d", "b")]))
+
+    def test_apply_changes(self):
+        self.webdavpath.indexed = True
+        self.webdavpath.save()
+        self.dav("PUT", "a", "x" * 10)
+        metadata.reconcile(self.webdavpath)
+        self.assertEqual(QuotaLedger.get_usage(self.webdavpath), (10, 1))
+        acl_cache.resolve(self.path("a"))
+        self.assertTrue(self.root in acl_cache.entries)
+        self.write("a", "x" * 100)
+        self.write("b", "x")
+        self.write(DirectoryACL.ACL_FILENAME, "")
+        entries = JournalEntry.objects.count()
+        changes = {self.path("a"): False, self.path("b"): False,
+                   self.path(DirectoryACL.ACL_FILENAME): False}
+        watcher.apply_changes([self.webdavpath], changes)
+        self.assertFalse(self.root in acl_cache.entries)
+        self.assertEqual(QuotaLedger.get_usage(self.webdavpath), (101, 3))
+        self.assertEqual(MetadataEntry.objects.get(path = self.path("a")).size, 100)
+        self.assertEqual(JournalEntry.objects.count(), entries + 3)
+        # the other processes only invalidate their caches
+        acl_cache.resolve(self.path("a"))
+        watcher.apply_changes([self.webdavpath], changes)
+        self.assertFalse(self.root in acl_cache.entries)
+        self.assertEqual(QuotaLedger.get_usage(self.webdavpath), (101, 3))
+        self.assertEqual(JournalEntry.objects.count(), entries + 3)
+        # writes of the method handlers are left alone
+        MetadataScan.objects.all().delete()
+        with self.settings(WEBDAV_WATCHER = "poll"):
+            self.dav("PUT", "c", "x")
+            self.dav("DELETE", "b")
+        usage = QuotaLedger.get_usage(self.webdavpath)
+        entries = JournalEntry.objects.count()
+        watcher.apply_changes([self.webdavpath], {self.root: False, self.path("b"): False,
+                                                  self.path("c"): False})
+        self.assertTrue(QuotaLedger.objects.exists())
+        self.assertEqual(QuotaLedger.get_usage(self.webdavpath), usage)
+        self.assertEqual(JournalEntry.objects.count(), entries)
+        # other changes of cold mounts are rescanned by the next quota check
+        os.remove(self.path("c"))
+        watcher.apply_changes([self.webdavpath], {self.path("c"): False})
+        self.assertFalse(QuotaLedger.objects.exists())
+        self.assertEqual(QuotaLedger.get_usage(self.webdavpath), (100, 2))
+        self.assertEqual(JournalEntry.objects.count(), entries + 1)
+
+
+class ListingCacheTest(HandlerTestCase):
+
+    def setUp(self):
+        super(ListingCacheTest, self).setUp()
+        listing_cache.invalidate()
+        for name in "abc":
+            self.write(name, name)
+
+    def tearDown(self):
+        listing_cache.invalidate()
+        super(ListingCacheTest, self).tearDown()
+
+    def propfind(self, path = ""):
+        return "".join(self.dav("PROPFIND", path, PROPFIND_BODY, HTTP_DEPTH = "1"))
+
+    def test_hits(self):
+        stats = listing_cache.stats()
+        xml = self.propfind()
+        self.assertEqual(self.propfind(), xml)
+        self.assertEqual(listing_cache.stats()["hits"], stats["hits"] + 1)
+        self.assertEqual(listing_cache.stats()["misses"], stats["misses"] + 1)
+        self.assertTrue(listing_cache.stats()["hit_rate"] > 0)
+
+    def test_invalidated_by_writes(self):
+        self.propfind()
+        self.dav("PUT", "a", "changed")
+        self.assertTrue("<getcontentlength>7</getcontentlength>" in self.propfind())
+        self.dav("DELETE", "b")
+        self.assertFalse("/webdav/dav/b<" in self.propfind())
+        # another process adding a member changes the directory's stamp
+        listing_cache.invalidate()
+        self.propfind()
+        self.write("d", "d")
+        os.utime(self.root, (0, 12345))
+        self.assertTrue("/webdav/dav/d<" in self.propfind())
+
+    @override_settings(WEBDAV_LISTING_CACHE_SIZE = 5)
+    def test_bounded(self):
+        cache = ListingCache()
+        os.mkdir(os.path.join(self.root, "sub"))
+        self.write("sub/x", "x")
+        self.write("sub/y", "y")
+        self.assertEqual(len(cache.list(self.root)), 4)
+        cache.list(os.path.join(self.root, "sub"))
+        self.assertEqual(cache.stats()["evictions"], 1)
+        self.assertEqual(cache.stats()["entries"], 2)
+        cache.list(os.path.join(self.root, "sub"))
+        self.assertEqual(cache.stats()["hits"], 1)
+        with self.settings(WEBDAV_LISTING_CACHE_SIZE = 0):
+            cache.list(self.root)
+        self.assertEqual(cache.stats()["misses"], 2)
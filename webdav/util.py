@@ -6,15 +6,34 @@ General helper functions and classes.
 Part of the django-webdav project.
 """
 import os
+import stat
+import time
+import hmac
+import hashlib
 import logging
 import datetime
-from xml.dom import minidom as dom
-from django.http import HttpResponse, HttpResponseBadRequest, HttpResponseNotFound, HttpResponseNotAllowed
+import threading
+from collections import OrderedDict
+from xml.parsers import expat
+from StringIO import StringIO
+from xml.sax.saxutils import escape, quoteattr
+from django.http import HttpResponse, HttpResponseBadRequest, HttpResponseNotFound, HttpResponseNotAllowed, HttpResponseNotModified
+from django.utils.http import http_date, parse_http_date_safe
 from django.conf import settings
 from django.contrib.auth import authenticate, login
+from django.contrib.auth.models import User
+from django.db.models.signals import post_save, post_delete
 
 logger = logging.getLogger("webdav")
 
+UPLOAD_TEMP_PREFIX = ".webdav-upload-"
+TRASH_DIRNAME = ".webdav-trash"
+
+# mode for new files, as open() would create them
+_umask = os.umask(0)
+os.umask(_umask)
+FILE_MODE = 0666 & ~_umask
+
 
 class HttpResponseCreated(HttpResponse):
 
@@ -30,6 +49,12 @@ class HttpResponseMultistatus(HttpResponse):
             self[k] = v
 
 
+class HttpResponsePreconditionFailed(HttpResponse):
+
+    def __init__(self, content='412 Precondition Failed', mimetype = None, status = 412, content_type = "text/plain", **kwargs):
+        HttpResponse.__init__(self, content, mimetype, status, content_type)
+
+
 class HttpResponseUnauthorized(HttpResponse):
 
     def __init__(self, content='401 Unauthorized', mimetype = None, status = 401, content_type = "text/plain", **kwargs):
@@ -45,6 +70,147 @@ def is_dir(path):
     return os.path.isdir(path) and not os.path.islink(path)
 
 
+def is_hidden(name):
+    """
+    True for unfinished uploads and the trash, which clients never see.
+    """
+    return name.startswith(UPLOAD_TEMP_PREFIX) or name == TRASH_DIRNAME
+
+
+class DirEntry(object):
+    """
+    Minimal stand-in for os.DirEntry on Pythons without scandir. The lstat
+    result is fetched once and cached.
+    """
+
+    def __init__(self, dirpath, name):
+        self.name = name
+        self.path = os.path.join(dirpath, name)
+        self._lstat = None
+
+    def __repr__(self):
+        return "<DirEntry %s>"%self.name
+
+    def stat(self, follow_symlinks = True):
+        if follow_symlinks:
+            return os.stat(self.path)
+        if self._lstat is None:
+            self._lstat = os.lstat(self.path)
+        return self._lstat
+
+    def is_symlink(self):
+        try:
+            return stat.S_ISLNK(self.stat(follow_symlinks = False).st_mode)
+        except OSError:
+            return False
+
+    def is_dir(self, follow_symlinks = True):
+        try:
+            return stat.S_ISDIR(self.stat(follow_symlinks).st_mode)
+        except OSError:
+            return False
+
+    def is_file(self, follow_symlinks = True):
+        try:
+            return stat.S_ISREG(self.stat(follow_symlinks).st_mode)
+        except OSError:
+            return False
+
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        def scandir(path):
+            return iter([DirEntry(path, name) for name in os.listdir(path)])
+
+
+def get_etag(st):
+    """
+    Strong entity tag derived from inode, size and modification time.
+    """
+    return "\"%x-%x-%x\""%(st.st_ino, st.st_size, int(st.st_mtime * 1000000000))
+
+
+def etag_matches(header, etag, weak = False):
+    for tag in header.split(","):
+        tag = tag.strip()
+        if tag == "*":
+            return True
+        if weak and tag.startswith("W/"):
+            tag = tag[2:]
+        if tag == etag:
+            return True
+    return False
+
+
+def set_validators(response, st):
+    response["ETag"] = get_etag(st)
+    response["Last-Modified"] = http_date(st.st_mtime)
+    return response
+
+
+def check_conditions(request, st):
+    """
+    Evaluates If-Match, If-Unmodified-Since, If-None-Match and
+    If-Modified-Since against st, the stat result of the target or None
+    if it doesn't exist. Returns a 304 or 412 response if the request must
+    not proceed, otherwise None.
+    """
+    etag = st and get_etag(st)
+    if_match = request.META.get("HTTP_IF_MATCH")
+    if if_match:
+        if not st or not etag_matches(if_match, etag):
+            return HttpResponsePreconditionFailed()
+    else:
+        since = parse_http_date_safe(request.META.get("HTTP_IF_UNMODIFIED_SINCE", ""))
+        if st and since is not None and int(st.st_mtime) > since:
+            return HttpResponsePreconditionFailed()
+    safe = request.method in ("GET", "HEAD")
+    if_none_match = request.META.get("HTTP_IF_NONE_MATCH")
+    if if_none_match:
+        if st and etag_matches(if_none_match, etag, weak = True):
+            if safe:
+                return set_validators(HttpResponseNotModified(), st)
+            return HttpResponsePreconditionFailed()
+    elif safe and st:
+        since = parse_http_date_safe(request.META.get("HTTP_IF_MODIFIED_SINCE", ""))
+        if since is not None and int(st.st_mtime) <= since:
+            return set_validators(HttpResponseNotModified(), st)
+    return None
+
+
+def has_body(request):
+    try:
+        return int(request.META.get("CONTENT_LENGTH") or 0) > 0
+    except ValueError:
+        return False
+
+
+def parse_content_range(header):
+    """
+    Parses "bytes FIRST-LAST/TOTAL" or "bytes */TOTAL" into a tuple
+    (first, last, total), first and last being None for the latter.
+    Returns None if the header is malformed.
+    """
+    try:
+        units, spec = header.strip().split(None, 1)
+        spec, total = spec.split("/", 1)
+        total = int(total)
+        if units.lower() != "bytes" or total < 0:
+            return None
+        if spec.strip() == "*":
+            return None, None, total
+        first, last = [int(s) for s in spec.split("-", 1)]
+    except ValueError:
+        return None
+    if first < 0 or last < first or last >= total:
+        return None
+    return first, last, total
+
+
 def get_base_uri(request, path):
     s1 = request.build_absolute_uri()[:-len(path)]
     s2 = request.build_absolute_uri()[-len(path):]
@@ -56,7 +222,14 @@ def format_timestamp(ts):
     return dt.strftime('%a, %d %b %Y %H:%M:%S %Z')
 
 
+class RawXML(unicode):
+    """
+    Markup that Elem.write_xml writes as is instead of escaping it.
+    """
+
+
 class Elem(object):
+    namespace = None
 
     def __init__(self, name, children = [], **kwargs):
         self.name = name
@@ -66,18 +239,39 @@ class Elem(object):
     def __repr__(self):
         return "<Elem %s>"%self.name
 
-    def get_xml(self):
-        s = u"<%s"%self.name
+    def get_start_tag(self):
+        s = [u"<", self.name]
         for k, v in self.attributes.items():
-            s += u" %s=\"%s\""%(k, v)
-        s += u">"
-        for child in self.children:
-            if hasattr(child, "get_xml"):
-                s += child.get_xml()
+            s.append(u" %s=%s"%(k, quoteattr(unicode(v))))
+        s.append(u">")
+        return u"".join(s)
+
+    def write_xml(self, write):
+        """
+        Serializes the element by calling write with unicode fragments,
+        e.g. list.append or the write method of a file-like object.
+        """
+        write(self.get_start_tag())
+        stack = [(self, iter(self.children))]
+        while stack:
+            elem, children = stack[-1]
+            for child in children:
+                if isinstance(child, Elem):
+                    write(child.get_start_tag())
+                    stack.append((child, iter(child.children)))
+                    break
+                elif isinstance(child, RawXML):
+                    write(child)
+                else:
+                    write(escape(unicode(child)))
             else:
-                s += unicode(child)
-        s += u"</%s>"%self.name
-        return unicode(s)
+                write(u"</%s>"%elem.name)
+                stack.pop()
+
+    def get_xml(self):
+        s = []
+        self.write_xml(s.append)
+        return u"".join(s)
 
     def add_child(self, child):
         self.children.append(child)
@@ -93,28 +287,102 @@ class Elem(object):
         return r
 
     @staticmethod
-    def _from_node(node):
-        if node.nodeType == node.ELEMENT_NODE:
-            elem = Elem(node.tagName)
-            for cnode in node.childNodes:
-                if cnode.nodeType == node.ATTRIBUTE_NODE:
-                    elem.attributes[cnode.name] = cnode.value
-                elif cnode.nodeType == node.ELEMENT_NODE:
-                    newchild = Elem._from_node(cnode)
-                    if newchild:
-                        elem.children.append(newchild)
-                elif cnode.nodeType == node.TEXT_NODE or cnode.nodeType == CDATA_SECTION_NODE:
-                    if str(cnode.data).strip():
-                        elem.children.append(str(cnode.data).strip())
-            return elem
-        return None
+    def from_xml(xml):
+        return ElemParser().parse_string(xml)
 
     @staticmethod
-    def from_xml(xml):
-        doc = dom.parseString(xml)
-        if not doc:
+    def from_stream(stream):
+        return ElemParser().parse_stream(stream)
+
+
+class XMLParseError(ValueError):
+    pass
+
+
+class ElemParser(object):
+    """
+    Builds an Elem tree straight from expat events. Element names are
+    stored without namespace, the namespace URI goes into Elem.namespace.
+
+    Documents larger than WEBDAV_MAX_XML_SIZE bytes, nested deeper than
+    WEBDAV_MAX_XML_DEPTH or declaring entities are rejected.
+    """
+    CHUNK_SIZE = 16 * 1024
+
+    def __init__(self):
+        self.max_size = getattr(settings, "WEBDAV_MAX_XML_SIZE", 1024 * 1024)
+        self.max_depth = getattr(settings, "WEBDAV_MAX_XML_DEPTH", 64)
+        self.size = 0
+        self.root = None
+        self.stack = []
+        self.text = []
+        self.parser = expat.ParserCreate(namespace_separator = " ")
+        self.parser.StartElementHandler = self.start_element
+        self.parser.EndElementHandler = self.end_element
+        self.parser.CharacterDataHandler = self.text.append
+        self.parser.EntityDeclHandler = self.entity_decl
+
+    def split_name(self, name):
+        if " " in name:
+            namespace, name = name.split(" ", 1)
+            return namespace, name
+        return None, name
+
+    def flush_text(self):
+        if self.text:
+            text = u"".join(self.text).strip()
+            del self.text[:]
+            if text and self.stack:
+                self.stack[-1].children.append(text)
+
+    def start_element(self, name, attrs):
+        if len(self.stack) >= self.max_depth:
+            raise XMLParseError("maximum depth %d exceeded"%self.max_depth)
+        self.flush_text()
+        namespace, name = self.split_name(name)
+        elem = Elem(name)
+        elem.namespace = namespace
+        for k, v in attrs.items():
+            elem.attributes[self.split_name(k)[1]] = v
+        if self.stack:
+            self.stack[-1].children.append(elem)
+        else:
+            self.root = elem
+        self.stack.append(elem)
+
+    def end_element(self, name):
+        self.flush_text()
+        self.stack.pop()
+
+    def entity_decl(self, *args):
+        raise XMLParseError("entity declarations are not allowed")
+
+    def feed(self, data, final = False):
+        self.size += len(data)
+        if self.size > self.max_size:
+            raise XMLParseError("maximum size %d exceeded"%self.max_size)
+        self.parser.Parse(data, final)
+
+    def parse_string(self, xml):
+        return self.parse_stream(StringIO(xml))
+
+    def parse_stream(self, stream):
+        """
+        Returns the root Elem, or None if the document is empty, malformed
+        or exceeds the limits.
+        """
+        try:
+            data = stream.read(self.CHUNK_SIZE)
+            if not data.strip():
+                return None
+            while data:
+                self.feed(data)
+                data = stream.read(self.CHUNK_SIZE)
+            self.feed("", True)
+        except (expat.ExpatError, XMLParseError), e:
+            logger.warning("could not parse XML; %s"%e)
             return None
-        return Elem._from_node(doc.documentElement)
+        return self.root
 
 
 class MethodHandler(object):
@@ -141,6 +409,205 @@ class MethodHandlers(dict):
         return HttpResponseNotAllowed(self.keys())
 
 
+def parse_acl_data(data):
+    access_lists = {}
+    for line in data.split("\n"):
+        params = line.split("=", 1)
+        if len(params) > 1:
+            listname = params[0].strip()
+            values = [s.strip() for s in params[1].split(" ")]
+            if listname and values:
+                access_lists[listname] = values
+    return access_lists
+
+
+def get_user_group_names(user):
+    """
+    Returns the set of group names for user. The result is memoized on the
+    user object, which the auth middleware creates anew for every request.
+    """
+    names = getattr(user, "_webdav_group_names", None)
+    if names is None:
+        if user.is_authenticated():
+            names = frozenset(user.groups.values_list("name", flat = True))
+        else:
+            names = frozenset()
+        user._webdav_group_names = names
+    return names
+
+
+class ACLRuleSet(object):
+    """
+    An ACL list compiled into sets of user and group names.
+    """
+
+    def __init__(self, entries = ()):
+        self.wildcard = False
+        self.usernames = set()
+        self.groupnames = set()
+        for entry in entries:
+            if entry == "*":
+                self.wildcard = True
+            elif entry.find(":") >= 0:
+                type_, value = [s.strip() for s in entry.split(":",1)]
+                if type_.lower() == "group":
+                    self.groupnames.add(value)
+                elif type_.lower() == "user":
+                    self.usernames.add(value)
+                else:
+                    logger.warning("invalid ACL token type '%s'"%type_)
+            else:
+                self.usernames.add(entry)
+                self.groupnames.add(entry)
+        self.usernames.discard("")
+        self.groupnames.discard("")
+
+    def match(self, user):
+        if self.wildcard:
+            return True
+        if user.username in self.usernames:
+            return True
+        if self.groupnames:
+            return not self.groupnames.isdisjoint(get_user_group_names(user))
+        return False
+
+
+def compile_access_lists(access_lists):
+    return dict((listname, ACLRuleSet(values))
+                for listname, values in access_lists.items())
+
+
+class ACLCacheEntry(object):
+
+    def __init__(self, stamp, filename, access_lists, checked):
+        self.stamp = stamp
+        self.filename = filename
+        self.access_lists = access_lists
+        self.rules = compile_access_lists(access_lists or {})
+        self.checked = checked
+
+
+class ACLCache(object):
+    """
+    Parsed ACL files keyed by directory, including negative entries for
+    directories without an ACL file.
+
+    An entry is trusted without touching the disk for WEBDAV_ACL_CACHE_TTL
+    seconds (default 2). Revalidation costs one lstat of the directory and
+    one of its ACL file, the file is only re-read when its device, inode,
+    mtime or size changed. ACL files written through the method handlers or
+    seen by the watcher take effect at once; edits made behind the server's
+    back may take up to the TTL, set it to 0 to revalidate on every request.
+    At most WEBDAV_ACL_CACHE_SIZE directories are kept, least recently used
+    entries are evicted first.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get_ttl(self):
+        return getattr(settings, "WEBDAV_ACL_CACHE_TTL", 2)
+
+    def get_max_entries(self):
+        return getattr(settings, "WEBDAV_ACL_CACHE_SIZE", 1024)
+
+    def get_stamp(self, local_path):
+        try:
+            st = os.lstat(local_path)
+            if not stat.S_ISDIR(st.st_mode):
+                return None
+            fn = os.path.normpath("%s/%s"%(local_path, DirectoryACL.ACL_FILENAME))
+            st = os.lstat(fn)
+            if not stat.S_ISREG(st.st_mode):
+                return None
+        except OSError:
+            return None
+        return (st.st_dev, st.st_ino, st.st_mtime, st.st_size)
+
+    def get_entry(self, local_path):
+        now = time.time()
+        self.lock.acquire()
+        try:
+            entry = self.entries.pop(local_path, None)
+            if entry:
+                self.entries[local_path] = entry
+                if now - entry.checked < self.get_ttl():
+                    self.hits += 1
+                    return entry
+        finally:
+            self.lock.release()
+        stamp = self.get_stamp(local_path)
+        if entry and entry.stamp == stamp:
+            entry.checked = now
+            self.hits += 1
+            return entry
+        self.misses += 1
+        fn, access_lists = None, {}
+        if stamp:
+            fn = os.path.normpath("%s/%s"%(local_path, DirectoryACL.ACL_FILENAME))
+            try:
+                f = file(fn, "r")
+                data = f.read()
+                f.close()
+            except IOError, ioe:
+                logger.warning("could not read ACL file '%s'; %s"%(fn, ioe))
+                # keep it uncached, the next request tries again
+                return ACLCacheEntry(stamp, fn, None, now)
+            access_lists = parse_acl_data(data)
+            logger.debug("using ACL file '%s'"%fn)
+        entry = ACLCacheEntry(stamp, fn, access_lists, now)
+        self.lock.acquire()
+        try:
+            self.entries.pop(local_path, None)
+            self.entries[local_path] = entry
+            while len(self.entries) > self.get_max_entries():
+                self.entries.popitem(last = False)
+        finally:
+            self.lock.release()
+        return entry
+
+    def resolve(self, path):
+        """
+        Walks from path up towards the root and returns the cache entry of
+        the closest ACL file, or None if there is none.
+        """
+        local_path = os.path.abspath(os.path.dirname("%s/"%path))
+        while local_path.find("/") >= 0:
+            entry = self.get_entry(local_path)
+            if entry.filename:
+                return entry
+            local_path = "/".join(local_path.split("/")[:-1])
+        return None
+
+    def invalidate(self, path = None):
+        """
+        Drops the entries for path and everything below it, or the whole
+        cache if path is None.
+        """
+        self.lock.acquire()
+        try:
+            if path is None:
+                self.entries.clear()
+                return
+            path = os.path.abspath(path)
+            prefix = path.rstrip("/") + "/"
+            for key in self.entries.keys():
+                if key == path or key.startswith(prefix):
+                    del self.entries[key]
+        finally:
+            self.lock.release()
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses,
+                "entries": len(self.entries)}
+
+
+acl_cache = ACLCache()
+
+
 class DirectoryACL(object):
     ACL_FILENAME = ".webdav-acl"
     ACL_READ = "read"
@@ -153,96 +620,180 @@ class DirectoryACL(object):
         self.webdavpath = webdavpath
         self.path = path
         self.access_lists = {}
+        self.rules = {}
         self.read_acl_file()
 
     def read_acl_file(self):
         self.access_lists = {}
-        fn = self.get_acl_filename(self.path)
-        if fn:
-            try:
-                f = file(fn, "r")
-                data = f.read()
-                f.close()
-            except IOError, ioe:
-                logger.warning("could not read ACL file '%s'; %s"%(fn, ioe))
-                return False
-            for line in data.split("\n"):
-                params = line.split("=", 1)
-                if len(params) > 1:
-                    listname = params[0].strip()
-                    values = [s.strip() for s in params[1].split(" ")]
-                    if listname and values:
-                        self.access_lists[listname] = values
+        self.rules = {}
+        if not self.webdavpath:
+            return False
+        entry = acl_cache.resolve(self.path)
+        if entry and entry.access_lists is not None:
+            self.access_lists = entry.access_lists
+            self.rules = entry.rules
             return True
         return False
 
     def get_acl_filename(self, path):
         if not self.webdavpath:
-            return None        
-        local_path = os.path.abspath(os.path.dirname("%s/"%path))
-        while local_path.find("/") >= 0:
-            if is_dir(local_path):
-                fn = os.path.normpath("%s/%s"%(local_path, self.ACL_FILENAME))
-                if is_file(fn):
-                    logger.debug("using ACL file '%s'"%fn)
-                    return fn
-                else:
-                    logger.debug("no ACL file '%s', ignoring"%fn)
-            local_path = "/".join(local_path.split("/")[:-1])
-        return None
+            return None
+        entry = acl_cache.resolve(path)
+        return entry and entry.filename or None
 
     def match_user(self, user, lst):
-        for entry in lst:
-            if entry == "*":
-                return True
-            username, groupname = None, None
-            if entry.find(":") >= 0:
-                type_, value = [s.strip() for s in entry.split(":",1)]
-                if type_.lower() == "group":
-                    groupname = value
-                elif type_.lower() == "user":
-                    username = value
-                else:
-                    logger.warning("invalid ACL token type '%s'"%type_)
-            else:
-                username, groupname = entry, entry
-            if username and username == user.username:
-                return True
-            if groupname:
-                groups = user.groups.all()
-                if groups and groupname in [g.name for g in groups]:
-                    return True
-        return False
+        if not isinstance(lst, ACLRuleSet):
+            lst = ACLRuleSet(lst)
+        return lst.match(user)
+
+    def check_perm(self, user, listname):
+        # compare keys, fetching the owner would cost a query per check
+        if (self.webdavpath and user.id is not None
+            and user.id == self.webdavpath.owner_id):
+            return True
+        rules = self.rules.get(listname)
+        return rules is not None and rules.match(user)
 
     def perm_read(self, user):
-        if self.webdavpath and user == self.webdavpath.owner:
-            return True
-        return self.match_user(user,
-                               self.access_lists.get(self.ACL_READ, []))
+        return self.check_perm(user, self.ACL_READ)
 
     def perm_write(self, user):
-        if self.webdavpath and user == self.webdavpath.owner:
-            return True
-        return self.match_user(user,
-                               self.access_lists.get(self.ACL_WRITE, []))
+        return self.check_perm(user, self.ACL_WRITE)
 
     def perm_delete(self, user):
-        if self.webdavpath and user == self.webdavpath.owner:
-            return True
-        return self.match_user(user,
-                               self.access_lists.get(self.ACL_DELETE, []))
+        return self.check_perm(user, self.ACL_DELETE)
 
     def perm_new_file(self, user):
-        if self.webdavpath and user == self.webdavpath.owner:
-            return True
-        return self.match_user(user,
-                               self.access_lists.get(self.ACL_NEW_FILE, []))
+        return self.check_perm(user, self.ACL_NEW_FILE)
 
     def perm_acl(self, user):
-        if self.webdavpath and user == self.webdavpath.owner:
-            return True
-        return self.match_user(user,
-                               self.access_lists.get(self.ACL_ACL, []))
+        return self.check_perm(user, self.ACL_ACL)
+
+
+class ListingCache(object):
+    """
+    Members of directories listed by PROPFIND Depth:1, with their lstat
+    results. A listing is used as long as the device, inode and
+    modification time in nanoseconds of its directory are unchanged, and
+    dropped by invalidate_caches, since the modification time may not
+    move between two quick changes.
+
+    At most WEBDAV_LISTING_CACHE_SIZE members (default 100000, 0 disables
+    the cache) are kept in all listings together, least recently used
+    listings are evicted first.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.listings = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.hit_time = 0.0
+        self.miss_time = 0.0
+
+    def get_max_entries(self):
+        return getattr(settings, "WEBDAV_LISTING_CACHE_SIZE", 100000)
+
+    def get_stamp(self, st):
+        return (st.st_dev, st.st_ino, int(st.st_mtime * 1000000000))
+
+    def list(self, path, scan = scandir):
+        """
+        Returns the members of the directory path as DirEntry objects with
+        their lstat results, listing it with scan on a miss. Raises
+        OSError like scandir. The list is shared, callers must not change
+        it.
+        """
+        max_entries = self.get_max_entries()
+        if max_entries <= 0:
+            return scan(path)
+        start = time.time()
+        # stamp before listing, a change in between makes the next request miss
+        stamp = self.get_stamp(os.lstat(path))
+        self.lock.acquire()
+        try:
+            listing = self.listings.pop(path, None)
+            if listing and listing[0] == stamp:
+                self.listings[path] = listing
+            elif listing:
+                self.size -= len(listing[1])
+                listing = None
+        finally:
+            self.lock.release()
+        if listing:
+            self.hits += 1
+            self.hit_time += time.time() - start
+            return listing[1]
+        members = []
+        for entry in scan(path):
+            try:
+                st = entry.stat(follow_symlinks = False)
+            except OSError:
+                continue
+            member = DirEntry(path, entry.name)
+            member._lstat = st
+            members.append(member)
+        if len(members) <= max_entries:
+            self.lock.acquire()
+            try:
+                old = self.listings.pop(path, None)
+                if old:
+                    self.size -= len(old[1])
+                self.listings[path] = (stamp, members)
+                self.size += len(members)
+                while self.size > max_entries:
+                    key, evicted = self.listings.popitem(last = False)
+                    self.size -= len(evicted[1])
+                    self.evictions += 1
+            finally:
+                self.lock.release()
+        self.misses += 1
+        self.miss_time += time.time() - start
+        return members
+
+    def invalidate(self, path = None):
+        """
+        Drops the listings of path, its parent and everything below it, or
+        the whole cache if path is None.
+        """
+        self.lock.acquire()
+        try:
+            if path is None:
+                self.listings.clear()
+                self.size = 0
+                return
+            path = os.path.abspath(path)
+            prefix = path.rstrip("/") + "/"
+            for key in self.listings.keys():
+                if key == path or key.startswith(prefix) or key == os.path.dirname(path):
+                    self.size -= len(self.listings.pop(key)[1])
+        finally:
+            self.lock.release()
+
+    def stats(self):
+        requests = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses,
+                "evictions": self.evictions, "listings": len(self.listings),
+                "entries": self.size,
+                "hit_rate": requests and float(self.hits) / requests or 0.0,
+                "hit_latency": self.hits and self.hit_time / self.hits or 0.0,
+                "miss_latency": self.misses and self.miss_time / self.misses or 0.0}
+
+
+listing_cache = ListingCache()
+
+
+def invalidate_caches(path):
+    """
+    Called by the method handlers after they changed path on disk.
+    """
+    if os.path.basename(path) == DirectoryACL.ACL_FILENAME:
+        acl_cache.invalidate(os.path.dirname(path))
+    else:
+        acl_cache.invalidate(path)
+    listing_cache.invalidate(path)
 
 
 def get_used_quota(path):
@@ -253,6 +804,8 @@ def get_used_quota(path):
             return 0, 0
         elif is_dir(path):
             for filename in os.listdir(path):
+                if is_hidden(filename):
+                    continue
                 fn = os.path.normpath("%s/%s"%(path, filename))
                 addsize, addnum = get_used_quota(fn)
                 totalsize += addsize
@@ -265,6 +818,107 @@ def get_used_quota(path):
     return totalsize, totalnum
 
 
+class BasicAuthCache(object):
+    """
+    Short lived cache of successful Basic authorizations, so that clients
+    sending credentials with every request don't pay for a password hash
+    each time. Opt-in through WEBDAV_BASIC_AUTH_CACHE_TTL (seconds).
+
+    Headers are keyed by an HMAC with a per-process random salt and never
+    stored in clear. A hit is only honored if the user is still active and
+    its password hash is unchanged.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.salt = os.urandom(16)
+
+    def get_ttl(self):
+        return getattr(settings, "WEBDAV_BASIC_AUTH_CACHE_TTL", 0)
+
+    def get_max_entries(self):
+        return getattr(settings, "WEBDAV_BASIC_AUTH_CACHE_SIZE", 1024)
+
+    def get_key(self, authorization):
+        return hmac.new(self.salt, authorization, hashlib.sha256).digest()
+
+    def get(self, authorization):
+        if self.get_ttl() <= 0:
+            return None
+        key = self.get_key(authorization)
+        self.lock.acquire()
+        try:
+            entry = self.entries.get(key)
+            if entry and entry[3] < time.time():
+                del self.entries[key]
+                entry = None
+        finally:
+            self.lock.release()
+        if not entry:
+            return None
+        user_id, password, backend, expires = entry
+        try:
+            user = User.objects.get(pk = user_id)
+        except User.DoesNotExist:
+            user = None
+        if not user or not user.is_active or user.password != password:
+            self.evict_user(user_id)
+            return None
+        user.backend = backend
+        return user
+
+    def set(self, authorization, user):
+        ttl = self.get_ttl()
+        if ttl <= 0:
+            return
+        entry = (user.pk, user.password, user.backend, time.time() + ttl)
+        self.lock.acquire()
+        try:
+            self.entries[self.get_key(authorization)] = entry
+            while len(self.entries) > self.get_max_entries():
+                self.entries.popitem(last = False)
+        finally:
+            self.lock.release()
+
+    def evict_user(self, user_id, password = None):
+        """
+        Drops the entries of user_id, or only those cached with a password
+        hash other than password if it is given.
+        """
+        self.lock.acquire()
+        try:
+            for key, entry in self.entries.items():
+                if entry[0] == user_id and entry[1] != password:
+                    del self.entries[key]
+        finally:
+            self.lock.release()
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.entries.clear()
+        finally:
+            self.lock.release()
+
+
+basic_auth_cache = BasicAuthCache()
+
+
+def evict_basic_auth_user(sender, instance, **kwargs):
+    # login() saves the user as well, only react to relevant changes
+    if instance.is_active:
+        basic_auth_cache.evict_user(instance.pk, instance.password)
+    else:
+        basic_auth_cache.evict_user(instance.pk)
+
+def evict_deleted_basic_auth_user(sender, instance, **kwargs):
+    basic_auth_cache.evict_user(instance.pk)
+
+post_save.connect(evict_basic_auth_user, sender = User)
+post_delete.connect(evict_deleted_basic_auth_user, sender = User)
+
+
 def check_http_authorization(acl, request, webdavpath, acl_name):
     # First up, is someone trying to use HTTP authorization?
     if request.META.has_key("HTTP_AUTHORIZATION"):
@@ -273,18 +927,27 @@ def check_http_authorization(acl, request, webdavpath, acl_name):
         spl = authentication.split(" ", 1)
         if len(spl) == 2:
             if "basic" == spl[0].lower():
-                token = spl[1].strip().decode('base64')
-                spl2 = token.split(":", 1)
-                if len(spl2) == 2:
-                    username, password = spl2
-                    user = authenticate(username=username, password=password)
-                    if user is not None and user.is_active:
-                        login(request, user)
-                        logger.info("login via basic auth '%s'"%username)
-                        return None
+                user = basic_auth_cache.get(authentication)
+                if user is None:
+                    token = spl[1].strip().decode('base64')
+                    spl2 = token.split(":", 1)
+                    if len(spl2) == 2:
+                        username, password = spl2
+                        user = authenticate(username=username, password=password)
+                        if user is not None and user.is_active:
+                            basic_auth_cache.set(authentication, user)
+                        else:
+                            user = None
+                            logger.warning("failed login via basic auth '%s'"
+                                           %username)
+                if user is not None:
+                    if getattr(settings, "WEBDAV_BASIC_AUTH_STATELESS", False):
+                        # no session for clients that authenticate every request
+                        request.user = user
                     else:
-                        logger.warning("failed login via basic auth '%s'"
-                                       %username)
+                        login(request, user)
+                    logger.info("login via basic auth '%s'"%user.username)
+                    return None
     # Regardless if HTTP authorization was successful or not, let's check permissions
     funct = getattr(acl, "perm_%s"%acl_name)
     result = callable(funct) and funct(request.user) or False
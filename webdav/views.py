@@ -6,6 +6,8 @@ from webdav_handlers import *
 webdav_handlers = util.MethodHandlers()
 webdav_handlers.add_handler("OPTIONS", OptionsHandler())
 webdav_handlers.add_handler("PROPFIND", PropfindHandler())
+webdav_handlers.add_handler("PROPPATCH", ProppatchHandler())
+webdav_handlers.add_handler("REPORT", ReportHandler())
 webdav_handlers.add_handler("GET", GetHandler())
 webdav_handlers.add_handler("HEAD", HeadHandler())
 webdav_handlers.add_handler("PUT", PutHandler())
@@ -13,6 +15,8 @@ webdav_handlers.add_handler("DELETE", DeleteHandler())
 webdav_handlers.add_handler("MKCOL", MakedirHandler())
 webdav_handlers.add_handler("COPY", CopyHandler())
 webdav_handlers.add_handler("MOVE", MoveHandler())
+webdav_handlers.add_handler("LOCK", LockHandler())
+webdav_handlers.add_handler("UNLOCK", UnlockHandler())
 
 @csrf_exempt
 def default(request, **kwargs):
@@ -0,0 +1,432 @@
+"""
+Copyright 2012 Peter Gebauer
+Licensed under GNU GPLv3
+
+Watches the local paths of WebdavPaths for changes made by other
+processes and updates what the method handlers would have updated.
+Part of the django-webdav project.
+"""
+import os
+import sys
+import time
+import stat
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+import logging
+import hashlib
+import threading
+from django.conf import settings
+from django.core.cache import cache
+from webdav.util import scandir, is_hidden, invalidate_caches
+from webdav.models import QuotaLedger, MetadataEntry, MetadataScan, mounts_loaded
+from webdav import metadata, sync
+
+logger = logging.getLogger("webdav")
+
+# from linux/inotify.h
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0x00080000
+
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO
+              | IN_CREATE | IN_DELETE | IN_ONLYDIR | IN_DONT_FOLLOW)
+
+WRITTEN_KEY = "webdav:watcher:written:%s"
+CLAIM_KEY = "webdav:watcher:claim:%s"
+
+# struct inotify_event without its name
+EVENT_FORMAT = "iIII"
+EVENT_SIZE = struct.calcsize(EVENT_FORMAT)
+
+_inotify_init1 = None
+_inotify_add_watch = None
+_inotify_rm_watch = None
+if sys.platform.startswith("linux"):
+    try:
+        _libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno = True)
+    except OSError:
+        _libc = None
+    if _libc is not None:
+        _inotify_init1 = getattr(_libc, "inotify_init1", None)
+        _inotify_add_watch = getattr(_libc, "inotify_add_watch", None)
+        _inotify_rm_watch = getattr(_libc, "inotify_rm_watch", None)
+        if _inotify_add_watch is not None:
+            _inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+            _inotify_add_watch.restype = ctypes.c_int
+
+
+def encode_path(path):
+    if isinstance(path, unicode):
+        return path.encode(sys.getfilesystemencoding())
+    return path
+
+
+class InotifyBackend(object):
+    """
+    Reports changes below roots with inotify(7), which needs one watch per
+    directory. Raises OSError if inotify is not available.
+    """
+
+    def __init__(self, roots):
+        if _inotify_init1 is None or _inotify_add_watch is None:
+            raise OSError(errno.ENOSYS, "inotify not available")
+        self.fd = _inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        self.roots = roots
+        self.watches = {}
+        for root in roots:
+            self.add_tree(root)
+
+    def add_tree(self, path):
+        stack = [path]
+        while stack:
+            dirpath = stack.pop()
+            wd = _inotify_add_watch(self.fd, encode_path(dirpath), WATCH_MASK)
+            if wd < 0:
+                # usually fs.inotify.max_user_watches
+                logger.warning("could not watch '%s'; %s"%(
+                        dirpath, os.strerror(ctypes.get_errno())))
+                continue
+            self.watches[wd] = dirpath
+            try:
+                entries = list(scandir(dirpath))
+            except OSError:
+                continue
+            for entry in entries:
+                if not is_hidden(entry.name) and entry.is_dir(follow_symlinks = False):
+                    stack.append(entry.path)
+
+    def remove_tree(self, path):
+        prefix = path + "/"
+        for wd, dirpath in self.watches.items():
+            if dirpath == path or dirpath.startswith(prefix):
+                _inotify_rm_watch(self.fd, wd)
+                del self.watches[wd]
+
+    def read(self, timeout):
+        """
+        Waits up to timeout seconds and returns a list of (path, recursive)
+        for what changed, recursive when a whole tree was added or removed.
+        """
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return []
+        try:
+            buf = os.read(self.fd, 64 * 1024)
+        except OSError, ose:
+            if ose.errno == errno.EAGAIN:
+                return []
+            raise
+        changes = []
+        offset = 0
+        while offset + EVENT_SIZE <= len(buf):
+            wd, mask, cookie, length = struct.unpack_from(EVENT_FORMAT, buf, offset)
+            name = buf[offset + EVENT_SIZE:offset + EVENT_SIZE + length].rstrip("\0")
+            offset += EVENT_SIZE + length
+            if mask & IN_Q_OVERFLOW:
+                logger.warning("inotify queue overflowed, rescanning everything")
+                changes.extend((root, True) for root in self.roots)
+                continue
+            if mask & IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+            dirpath = self.watches.get(wd)
+            if dirpath is None:
+                continue
+            if not name:
+                # the watched directory itself
+                changes.append((dirpath, False))
+                continue
+            try:
+                name = name.decode(sys.getfilesystemencoding())
+            except UnicodeDecodeError:
+                continue
+            if is_hidden(name):
+                continue
+            path = os.path.join(dirpath, name)
+            recursive = False
+            if mask & IN_ISDIR:
+                if mask & IN_MOVED_FROM:
+                    self.remove_tree(path)
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    self.add_tree(path)
+                recursive = bool(mask & (IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO))
+            changes.append((path, recursive))
+        return changes
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollingBackend(object):
+    """
+    Finds changes below roots by comparing a walk of the trees every
+    WEBDAV_WATCHER_INTERVAL seconds (default 10), for systems without
+    inotify. Keeps a stat summary of every file in memory.
+    """
+
+    def __init__(self, roots):
+        self.roots = roots
+        self.snapshot = self.scan()
+        self.next_scan = time.time() + self.get_interval()
+
+    def get_interval(self):
+        return getattr(settings, "WEBDAV_WATCHER_INTERVAL", 10)
+
+    def scan(self):
+        snapshot = {}
+        stack = []
+        for root in self.roots:
+            try:
+                st = os.lstat(root)
+            except OSError:
+                continue
+            snapshot[root] = (st.st_mode, st.st_size, st.st_mtime, st.st_ino)
+            stack.append(root)
+        while stack:
+            dirpath = stack.pop()
+            try:
+                entries = list(scandir(dirpath))
+            except OSError:
+                continue
+            for entry in entries:
+                if is_hidden(entry.name):
+                    continue
+                try:
+                    st = entry.stat(follow_symlinks = False)
+                except OSError:
+                    continue
+                snapshot[entry.path] = (st.st_mode, st.st_size, st.st_mtime, st.st_ino)
+                if stat.S_ISDIR(st.st_mode):
+                    stack.append(entry.path)
+        return snapshot
+
+    def read(self, timeout):
+        wait = self.next_scan - time.time()
+        if wait > timeout:
+            time.sleep(timeout)
+            return []
+        if wait > 0:
+            time.sleep(wait)
+        self.next_scan = time.time() + self.get_interval()
+        snapshot = self.scan()
+        changes = []
+        for path, summary in snapshot.iteritems():
+            if self.snapshot.get(path) != summary:
+                changes.append((path, False))
+        for path in self.snapshot:
+            if path not in snapshot:
+                changes.append((path, False))
+        self.snapshot = snapshot
+        return changes
+
+    def close(self):
+        pass
+
+
+def open_backend(roots):
+    if getattr(settings, "WEBDAV_WATCHER", None) == "inotify":
+        try:
+            return InotifyBackend(roots)
+        except OSError, ose:
+            logger.warning("inotify not available, polling instead; %s"%ose)
+    return PollingBackend(roots)
+
+
+def get_written_key(path):
+    return WRITTEN_KEY%hashlib.md5(encode_path(path)).hexdigest()
+
+
+def mark_written(webdavpath, path, recursive = False):
+    """
+    Called by the method handlers once they updated the index, quota
+    ledger and journal for a change of path, recursive for a whole tree,
+    so that the watchers leave it alone. The directory holding path, and
+    the mount for trashed trees, changed along with it.
+    """
+    if not watcher.is_enabled():
+        return
+    now = time.time()
+    marks = {get_written_key(path): (now, recursive, os.path.lexists(path))}
+    marks.setdefault(get_written_key(os.path.dirname(path)), (now, False, True))
+    if recursive and not os.path.lexists(path):
+        marks.setdefault(get_written_key(os.path.abspath(webdavpath.local_path)),
+                         (now, False, True))
+    cache.set_many(marks, getattr(settings, "WEBDAV_WATCHER_MARK_TIMEOUT", 60))
+
+
+def is_written(root, path):
+    """
+    True if path below root is as mark_written left it, i.e. it was not
+    changed since, or is still gone.
+    """
+    keys = {}
+    ancestor = path
+    while True:
+        keys[get_written_key(ancestor)] = ancestor
+        if ancestor == root or not ancestor.startswith(root + "/"):
+            break
+        ancestor = os.path.dirname(ancestor)
+    marks = cache.get_many(keys.keys())
+    if not marks:
+        return False
+    try:
+        ctime = os.lstat(path).st_ctime
+    except OSError:
+        ctime = None
+    for key, (when, recursive, existed) in marks.iteritems():
+        if not recursive and keys[key] != path:
+            continue
+        if ctime is None and (not existed or keys[key] != path):
+            return True
+        if ctime is not None and existed and ctime <= when:
+            return True
+    return False
+
+
+def claim_change(webdavpath, path):
+    """
+    True for the one process that gets to apply the change of path as it
+    is on disk now, named by its inode, size and times or, once it is gone,
+    by the change time of its directory.
+    """
+    try:
+        st = os.lstat(path)
+        state = (st.st_ino, st.st_size, st.st_mtime, st.st_ctime)
+    except OSError:
+        try:
+            state = ("gone", os.lstat(os.path.dirname(path)).st_ctime)
+        except OSError:
+            state = ("gone",)
+    key = CLAIM_KEY%hashlib.md5(repr((webdavpath.pk, encode_path(path), state))).hexdigest()
+    return cache.add(key, True, getattr(settings, "WEBDAV_WATCHER_CLAIM_TIMEOUT", 600))
+
+
+def apply_changes(webdav_paths, changes):
+    """
+    Invalidates the caches for changes, a dict {local path: recursive},
+    and updates the metadata index, quota ledger and change journal for
+    those not made by the method handlers, in the process that claims them
+    first. With a warm index the ledger is corrected by the difference in
+    the index, otherwise it is dropped so that the next quota check
+    rescans the mount, once.
+    """
+    warm = {}
+    cold = set()
+    for path, recursive in sorted(changes.items()):
+        invalidate_caches(path)
+        for wdp in webdav_paths:
+            root = os.path.abspath(wdp.local_path)
+            if path != root and not path.startswith(root + "/"):
+                continue
+            if is_written(root, path) or not claim_change(wdp, path):
+                continue
+            if wdp.pk not in warm:
+                warm[wdp.pk] = MetadataScan.is_warm(wdp)
+            if warm[wdp.pk]:
+                size, num_files = MetadataEntry.get_usage(wdp, path)
+                metadata.update(wdp, path, recursive)
+                new_size, new_files = MetadataEntry.get_usage(wdp, path)
+                QuotaLedger.add_usage(wdp, new_size - size, new_files - num_files)
+            else:
+                cold.add(wdp.pk)
+            sync.record(wdp, path, recursive)
+    if cold:
+        QuotaLedger.objects.filter(webdavpath__in = cold).delete()
+
+
+class MountWatcher(object):
+    """
+    Watches the WebdavPaths in a background thread once they are loaded,
+    if WEBDAV_WATCHER is "inotify" (falling back to polling where inotify
+    is missing) or "poll". WEBDAV_WATCHER_MOUNTS limits it to some
+    url_paths. Changes are applied in batches after WEBDAV_WATCHER_DELAY
+    seconds (default 0.5) without further changes.
+
+    Every process watches for itself, so that its caches are invalidated.
+    The shared updates are made once, by the process claiming a change
+    first, and not at all for the writes of the method handlers. Both go
+    through the Django cache, which has to be shared by the processes.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.webdav_paths = []
+        self.generation = 0
+        self.thread = None
+
+    def is_enabled(self):
+        return getattr(settings, "WEBDAV_WATCHER", None) in ("inotify", "poll")
+
+    def start(self, webdav_paths):
+        if not self.is_enabled():
+            return
+        url_paths = getattr(settings, "WEBDAV_WATCHER_MOUNTS", None)
+        self.lock.acquire()
+        try:
+            self.webdav_paths = [wdp for wdp in webdav_paths
+                                 if url_paths is None or wdp.url_path in url_paths]
+            self.generation += 1
+            if not self.thread or not self.thread.is_alive():
+                self.thread = threading.Thread(target = self.run,
+                                               name = "webdav-watcher")
+                self.thread.daemon = True
+                self.thread.start()
+        finally:
+            self.lock.release()
+
+    def run(self):
+        delay = getattr(settings, "WEBDAV_WATCHER_DELAY", 0.5)
+        backend = None
+        generation = None
+        pending = {}
+        since = None
+        while True:
+            if generation != self.generation:
+                self.lock.acquire()
+                try:
+                    generation = self.generation
+                    webdav_paths = self.webdav_paths
+                finally:
+                    self.lock.release()
+                if backend:
+                    backend.close()
+                roots = sorted(set(os.path.abspath(wdp.local_path) for wdp in webdav_paths))
+                backend = open_backend(roots)
+                logger.debug("watching %d mount paths"%len(roots))
+            changes = backend.read(pending and delay or 1.0)
+            for path, recursive in changes:
+                pending[path] = pending.get(path) or recursive
+            if pending and since is None:
+                since = time.time()
+            if pending and (not changes or time.time() - since > 20 * delay):
+                try:
+                    apply_changes(webdav_paths, pending)
+                except Exception, e:
+                    logger.warning("could not apply %d changes; %s"%(len(pending), e))
+                pending = {}
+                since = None
+
+
+watcher = MountWatcher()
+
+
+def watch_mounts(sender, webdav_paths, **kwargs):
+    watcher.start(webdav_paths)
+
+mounts_loaded.connect(watch_mounts)
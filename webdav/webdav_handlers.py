@@ -9,15 +9,121 @@ import logging
 import urllib
 import urlparse
 import os
+import stat
+import itertools
+import errno
 import shutil
+import tempfile
 from webdav.util import *
-from webdav.models import WebdavPath
+from webdav.models import WebdavPath, QuotaLedger, UploadSession
+from webdav.delivery import get_delivery, get_content_type
+from webdav.fileops import copy_file, copy_tree, rename_noreplace, remove_tree
+from webdav.locks import check_locks, create_lock, refresh_lock, remove_lock, remove_locks
+from webdav.locks import get_lock_backend, get_lock_path, get_lock_tree, get_timeout
+from webdav.locks import parse_if_header, get_submitted_tokens, check_if_header, LockConflict
+from webdav.locks import HttpResponseLocked, SCOPE_SHARED, SCOPE_EXCLUSIVE
+from webdav.props import get_property_store, get_value_xml
+from webdav import metadata, sync, watcher
 from django.http import HttpResponse, HttpResponseBadRequest, HttpResponseNotFound, HttpResponseForbidden
 from django.core.urlresolvers import resolve, reverse
 from django.http import Http404
+from django.conf import settings
 
 logger = logging.getLogger("webdav")
 
+
+class QuotaExceeded(Exception):
+    pass
+
+
+def has_quota(found_path):
+    return found_path.quota > 0 or found_path.max_num_files > 0
+
+
+def check_quota(found_path, lcpath, add_size, add_files):
+    """
+    Returns a 403 response if adding add_size bytes and add_files files
+    to found_path would exceed its limits, otherwise None. Resumable
+    uploads to other paths count with their full size.
+    """
+    max_quota = found_path.quota * WebdavPath.QUOTA_SIZE_MULT
+    max_num_files = found_path.max_num_files
+    if max_quota <= 0 and max_num_files <= 0:
+        return None
+    used_quota, num_files = QuotaLedger.get_usage(found_path)
+    if max_quota > 0:
+        used_quota += UploadSession.get_reserved(found_path, lcpath)
+    if max_quota > 0 and used_quota + add_size >= max_quota:
+        logger.info("quota exceeded for '%s' ('%s') %d/%d"%(
+            found_path.url_path, lcpath, used_quota, max_quota))
+        return HttpResponseForbidden("403 Quota")
+    if max_num_files > 0 and num_files + add_files >= max_num_files:
+        logger.info("num files exceeded for '%s' ('%s') %d/%d"%(
+            found_path.url_path, lcpath, num_files, max_num_files))
+        return HttpResponseForbidden("403 Num files")
+    return None
+
+
+def add_usage(found_path, size, num_files):
+    if has_quota(found_path):
+        QuotaLedger.add_usage(found_path, size, num_files)
+
+
+def get_resource_usage(found_path, path):
+    if is_dir(path):
+        return metadata.get_usage(found_path, path) or get_used_quota(path)
+    elif is_file(path):
+        return os.path.getsize(path), 1
+    return 0, 0
+
+
+def get_file_size(path):
+    if is_file(path):
+        return os.path.getsize(path)
+    return None
+
+
+def resource_changed(found_path, path, recursive = False):
+    """
+    Called after path was changed on disk, recursive if a whole tree was
+    added, replaced or removed.
+    """
+    invalidate_caches(path)
+    metadata.update(found_path, path, recursive)
+    sync.record(found_path, path, recursive)
+    watcher.mark_written(found_path, path, recursive)
+
+
+def remove_resource(found_path, path):
+    if is_dir(path):
+        remove_tree(found_path.local_path, path)
+    else:
+        os.remove(path)
+
+
+def get_error_status(ioe):
+    if ioe.errno in (errno.ENOSPC, errno.EDQUOT):
+        return "507 Insufficient Storage"
+    elif ioe.errno in (errno.EACCES, errno.EPERM):
+        return "403 Forbidden"
+    return "500 Internal Server Error"
+
+
+def get_multistatus_errors(base_href, base_lcpath, errors):
+    """
+    Returns a 207 listing the status of each (local path, error) in errors,
+    local paths below base_lcpath being reported below base_href.
+    """
+    multistatus = Elem("multistatus", xmlns = "DAV:")
+    for path, ioe in errors:
+        href = base_href.rstrip("/") + urllib.quote(
+            path[len(base_lcpath):].encode("utf-8"))
+        response = multistatus.add_child(Elem("response"))
+        response.add_child(Elem("href")).add_child(href or "/")
+        response.add_child(Elem("status")).add_child("HTTP/1.1 %s"%get_error_status(ioe))
+    return HttpResponseMultistatus(multistatus.get_xml())
+
+
 class OptionsHandler(MethodHandler):
 
     def handle(self, request):
@@ -33,6 +139,8 @@ class PropfindHandler(MethodHandler):
     Implements: PROPFIND method.
     Status: completed.
     """
+    LIVE_PROPS = ["creationdate", "getlastmodified", "getcontentlength",
+                  "getetag", "resourcetype", "supportedlock", "lockdiscovery"]
 
     def handle(self, request):
         found_path = WebdavPath.get_match_path_to_dir(request.localpath)
@@ -40,74 +148,258 @@ class PropfindHandler(MethodHandler):
             return HttpResponseNotFound()
         lcpath = found_path.get_local_path(request.localpath)
         if not lcpath:
-            logger.warning("invalid file path '%s'"%path)
+            logger.warning("invalid file path '%s'"%request.localpath)
             return HttpResponseForbidden("403 Internal")
         acl = DirectoryACL(found_path, lcpath)
         response = check_http_authorization(acl, request, found_path, "read")
         if response:
             return response
-        elem = Elem.from_xml(request.body)
-        if not elem:
-            return HttpResponseBadRequest()
-        find_props = []
+        if not has_body(request):
+            # an empty body asks for all properties
+            find_props, dead_props = self.LIVE_PROPS, True
+        else:
+            elem = Elem.from_stream(request)
+            if not elem:
+                return HttpResponseBadRequest()
+            find_props, dead_props = self.parse_props(elem)
+        if not is_file(lcpath) and not is_dir(lcpath):
+            return HttpResponseNotFound()
+        if lcpath.endswith(acl.ACL_FILENAME) and not acl.perm_acl(request.user):
+            return HttpResponseNotFound()
+        depth = request.META.get("HTTP_DEPTH", "1").strip().lower()
+        if depth not in ("0", "1", "infinity"):
+            return HttpResponseBadRequest("400 Bad Depth")
+        max_entries = getattr(settings, "WEBDAV_PROPFIND_MAX_ENTRIES", 10000)
+        if depth == "infinity" and max_entries <= 0:
+            error = Elem("error", [Elem("propfind-finite-depth")], xmlns = "DAV:")
+            return HttpResponseForbidden(error.get_xml(), content_type = "text/xml")
+        if depth == "infinity":
+            limit = max_entries
+        else:
+            limit = None
+        view = metadata.get_view(found_path)
+        members = []
+        if depth != "0" and is_dir(lcpath):
+            try:
+                if depth == "1":
+                    members = listing_cache.list(lcpath, view.scandir)
+                else:
+                    members = view.scandir(lcpath)
+            except (IOError, OSError), ioe:
+                logger.warning("could not list directory '%s'; %s"%(lcpath, ioe))
+                return HttpResponseForbidden("403 Internal")
+        logger.info("propfind '%s' depth %s"%(lcpath, depth))
+        entries = self.iter_entries(request, found_path, acl, lcpath, members,
+                                    depth == "infinity", view)
+        lock_tree = None
+        if "lockdiscovery" in find_props:
+            # one lookup for the whole listing
+            lock_tree = get_lock_tree(get_lock_path(request.path))
+        multistatus = self.iter_multistatus(request, entries, find_props, limit,
+                                            lock_tree, dead_props)
+        return HttpResponseMultistatus(multistatus, DAV = "1, 2, ordered-collections")
+
+    def parse_props(self, elem):
+        """
+        Returns (live property names, dead properties) asked for by the
+        allprop or prop children of elem, dead properties being True for
+        all of them or a list of (namespace, name).
+        """
+        if elem.find_children("allprop"):
+            return self.LIVE_PROPS, True
+        find_props, dead_props = [], []
         for child in elem.find_children("prop"):
             for child2 in child.children:
-                if hasattr(child2, "name"):
+                if not hasattr(child2, "name"):
+                    continue
+                if (child2.name in self.LIVE_PROPS
+                    and child2.namespace in ("DAV:", None)):
                     find_props.append(child2.name)
-        # Return response
-        multistatus = Elem("multistatus", xmlns="DAV:")
-        if not is_dir(lcpath):
-            return HttpResponseBadRequest("400 Bad Request")
-        try:
-            iterfiles = [lcpath] + os.listdir(lcpath)
-        except IOError, ioe:
-            logger.warning("could not list directory '%s'; %s"%(lcpath, ioe))
-            return HttpResponseForbidden("403 Internal")
-        for filename in iterfiles:
-            if filename == lcpath:
-                urn = urllib.quote(request.path.encode("utf-8"))
-                fn = lcpath
-            else:
-                urn = urllib.quote(os.path.normpath("%s/%s"%(request.path, filename)).encode("utf-8"))
-                fn = os.path.normpath("%s/%s/"%(lcpath, filename))
-            if (filename == acl.ACL_FILENAME 
-                and not acl.perm_acl(request.user)):
+                else:
+                    dead_props.append((child2.namespace or "", child2.name))
+        return find_props, dead_props
+
+    def iter_entries(self, request, found_path, acl, lcpath, members, recursive,
+                     view = metadata.disk_view, href = None, ordered = False,
+                     after = None):
+        """
+        Yields (href, local path, lstat result) for lcpath, found at href or
+        the request path, and its members. With recursive set subcollections
+        are walked depth-first, skipping those the user may not read. Every
+        entry is stat'ed exactly once, through view for indexed mounts.
+
+        With ordered set members are walked by name. With after, a tuple of
+        names below lcpath, only the entries walked after it are yielded.
+        """
+        href = href or request.path
+        if after is None:
+            try:
+                yield href, lcpath, view.lstat(lcpath)
+            except OSError, ose:
+                logger.warning("could not stat file '%s'; %s"%(lcpath, ose))
+        members = self.list_members(view, lcpath, members, ordered)
+        stack = members is not None and [(lcpath, href, acl, (), members)] or []
+        while stack:
+            dirpath, dirhref, diracl, dirkey, members = stack[-1]
+            entry = next(members, None)
+            if entry is None:
+                stack.pop()
                 continue
-            if not is_file(fn) and not is_dir(fn):
+            if is_hidden(entry.name):
+                continue
+            if (entry.name == diracl.ACL_FILENAME
+                and not diracl.perm_acl(request.user)):
+                continue
+            key = dirkey + (entry.name,)
+            if after is not None and key < after and after[:len(key)] != key:
                 continue
-            response = multistatus.add_child(Elem("response"))
-            response.add_child(Elem("href")).add_child(urn)
-            propstat = response.add_child(Elem("propstat"))
-            prop = propstat.add_child(Elem("prop"))
             try:
-                st = os.stat(fn)
-            except IOError, ioe:
-                st = None
-                logger.warning("could not stat file '%s'"%fn)
-            if st:
-                if "creationdate" in find_props:
-                    cdate = format_timestamp(st.st_ctime)
-                    prop.add_child(Elem("creationdate")).add_child(cdate)
-                if "getlastmodified" in find_props:
-                    mdate = format_timestamp(st.st_mtime)
-                    prop.add_child(Elem("getlastmodified")).add_child(mdate)
-                if "getcontentlength" in find_props:
-                    prop.add_child(Elem("getcontentlength")).add_child("%d"%os.path.getsize(fn))
-                if is_dir(fn):
-                    prop.add_child(Elem("resourcetype")).add_child(Elem("collection"))          
-                else:
-                    prop.add_child(Elem("resourcetype"))
-                propstat.add_child(Elem("status")).add_child("HTTP/1.1 200 OK")
-            else:
-                propstat.add_child(Elem("status")).add_child("HTTP/1.1 403 Internal")
+                st = entry.stat(follow_symlinks = False)
+            except OSError, ose:
+                logger.warning("could not stat file '%s'; %s"%(entry.path, ose))
+                continue
+            entryhref = os.path.normpath("%s/%s"%(dirhref, entry.name))
+            if after is None or key > after:
+                yield entryhref, entry.path, st
+            if recursive and stat.S_ISDIR(st.st_mode):
+                subacl = DirectoryACL(found_path, entry.path)
+                if subacl.perm_read(request.user):
+                    members = self.list_members(view, entry.path, None, ordered)
+                    if members is not None:
+                        stack.append((entry.path, entryhref, subacl, key, members))
 
-        logger.debug("returned collection '%s' from '%s'"%(
-            found_path.url_path, found_path.local_path))
-        xml = u"<?xml version=\"1.0\" encoding=\"utf-8\"?>" + multistatus.get_xml()
-        xmldata = xml.encode("utf-8")
-        logger.info("propfind '%s'"%lcpath)
-        file("xml.log", "w").write(xmldata)
-        return HttpResponseMultistatus(xmldata, DAV = "1, 2, ordered-collections")
+    def list_members(self, view, dirpath, members, ordered):
+        """
+        Returns an iterator over members, or over the listing of dirpath if
+        members is None, sorted by name with ordered set. None if dirpath
+        could not be listed.
+        """
+        if members is None:
+            try:
+                members = view.scandir(dirpath)
+            except (IOError, OSError), ioe:
+                logger.warning("could not list directory '%s'; %s"%(dirpath, ioe))
+                return None
+        if ordered:
+            members = sorted(members, key = lambda entry: entry.name)
+        return iter(members)
+
+    def iter_batches(self, entries, dead_props):
+        """
+        Yields (href, lstat result, dead properties) for entries, fetching
+        the dead properties of WEBDAV_PROPERTY_BATCH_SIZE entries at once.
+        """
+        if not dead_props:
+            for href, path, st in entries:
+                yield href, st, None
+            return
+        store = get_property_store()
+        batch_size = getattr(settings, "WEBDAV_PROPERTY_BATCH_SIZE", 500)
+        batch = []
+        for entry in itertools.chain(entries, [None]):
+            if entry is not None:
+                batch.append(entry)
+                if len(batch) < batch_size:
+                    continue
+            props = store.get_many([path for href, path, st in batch])
+            for href, path, st in batch:
+                yield href, st, props.get(path, {})
+            batch = []
+
+    def iter_multistatus(self, request, entries, find_props, limit = None,
+                         lock_tree = None, dead_props = None, trailer = None):
+        """
+        Yields the multistatus document one <response> at a time, so memory
+        use does not grow with the size of the directory. Once more than
+        limit entries were sent the document is cut off with a 507. The
+        elements returned by trailer, called with the href of the last
+        entry sent if the document was cut off and None otherwise, are
+        added at the end.
+        """
+        yield "<?xml version=\"1.0\" encoding=\"utf-8\"?><multistatus xmlns=\"DAV:\">"
+        count = 0
+        last = None
+        cut = False
+        for href, st, props in self.iter_batches(entries, dead_props):
+            if limit is not None and count >= limit:
+                logger.info("propfind '%s' cut off after %d entries"%(request.path, count))
+                response = Elem("response")
+                response.add_child(Elem("href")).add_child(
+                    urllib.quote(request.path.encode("utf-8")))
+                response.add_child(Elem("status")).add_child(
+                    "HTTP/1.1 507 Insufficient Storage")
+                response.add_child(Elem("error")).add_child(
+                    Elem("number-of-matches-within-limits"))
+                yield response.get_xml().encode("utf-8")
+                cut = True
+                break
+            response = self.get_response(href, st, find_props, lock_tree,
+                                         dead_props, props)
+            if response:
+                count += 1
+                last = href
+                yield response.get_xml().encode("utf-8")
+        if trailer:
+            for elem in trailer(cut and last or None):
+                yield elem.get_xml().encode("utf-8")
+        yield "</multistatus>"
+
+    def get_response(self, href, st, find_props, lock_tree = None,
+                     dead_props = None, props = None):
+        """
+        Builds the <response> for one entry from its lstat result and its
+        dead properties props. Symbolic links and special files are left out.
+        """
+        isdir = stat.S_ISDIR(st.st_mode)
+        if not isdir and not stat.S_ISREG(st.st_mode):
+            return None
+        response = Elem("response")
+        response.add_child(Elem("href")).add_child(urllib.quote(href.encode("utf-8")))
+        propstat = response.add_child(Elem("propstat"))
+        prop = propstat.add_child(Elem("prop"))
+        if "creationdate" in find_props:
+            cdate = format_timestamp(st.st_ctime)
+            prop.add_child(Elem("creationdate")).add_child(cdate)
+        if "getlastmodified" in find_props:
+            mdate = format_timestamp(st.st_mtime)
+            prop.add_child(Elem("getlastmodified")).add_child(mdate)
+        if "getcontentlength" in find_props:
+            prop.add_child(Elem("getcontentlength")).add_child("%d"%st.st_size)
+        if "getetag" in find_props:
+            # the index keeps the tag of the real stat result
+            etag = getattr(st, "etag", None) or get_etag(st)
+            prop.add_child(Elem("getetag")).add_child(etag)
+        if isdir:
+            prop.add_child(Elem("resourcetype")).add_child(Elem("collection"))
+        else:
+            prop.add_child(Elem("resourcetype"))
+        if "supportedlock" in find_props:
+            supportedlock = prop.add_child(Elem("supportedlock"))
+            for scope in (SCOPE_EXCLUSIVE, SCOPE_SHARED):
+                supportedlock.add_child(Elem("lockentry", [
+                            Elem("lockscope", [Elem(scope)]),
+                            Elem("locktype", [Elem("write")])]))
+        if lock_tree is not None:
+            lockdiscovery = prop.add_child(Elem("lockdiscovery"))
+            if lock_tree:
+                for lock in lock_tree.get_covering(get_lock_path(href)):
+                    lockdiscovery.add_child(lock.get_activelock())
+        missing = []
+        if dead_props is True:
+            dead_props = props
+        for key in dead_props or ():
+            if props and key in props:
+                prop.add_child(Elem(key[1], [RawXML(props[key])], xmlns = key[0]))
+            else:
+                missing.append(key)
+        propstat.add_child(Elem("status")).add_child("HTTP/1.1 200 OK")
+        if missing:
+            propstat = response.add_child(Elem("propstat"))
+            prop = propstat.add_child(Elem("prop"))
+            for namespace, name in missing:
+                prop.add_child(Elem(name, xmlns = namespace))
+            propstat.add_child(Elem("status")).add_child("HTTP/1.1 404 Not Found")
+        return response
 
 
 class GetHandler(MethodHandler):
@@ -116,67 +408,64 @@ class GetHandler(MethodHandler):
     Status: completed.
     """
 
+    def is_target(self, st):
+        return stat.S_ISREG(st.st_mode)
+
     def handle(self, request):
         found_path = WebdavPath.get_match_path_to_dir(request.localpath)
         if not found_path:
             return HttpResponseNotFound()
         lcpath = found_path.get_local_path(request.localpath)
         if not lcpath:
-            logger.warning("invalid file path '%s'"%path)
+            logger.warning("invalid file path '%s'"%request.localpath)
             return HttpResponseForbidden("403 Internal")
         acl = DirectoryACL(found_path, lcpath)
         response = check_http_authorization(acl, request, found_path, "read")
         if response:
             return response
-        if (not is_file(lcpath) 
+        try:
+            # lstat, so symbolic links are not a target
+            st = os.lstat(lcpath)
+        except OSError:
+            return HttpResponseNotFound()
+        if (not self.is_target(st)
             or (lcpath.endswith(acl.ACL_FILENAME) and not acl.perm_acl(request.user))):
             return HttpResponseNotFound()        
         try:
-            fsock = file(lcpath, "r")
-        except IOError, ioe:
+            response = check_conditions(request, st)
+            if response:
+                return response
+            response = self.get_response(request, found_path, lcpath, st)
+        except (IOError, OSError), ioe:
             logger.warning("could read file '%s' ('%s'); %s"%(
                     found_path.url_path, lcpath, ioe))
             return HttpResponseForbidden("403 Internal")
-        filename = os.path.basename(lcpath)
-        filesize = os.path.getsize(lcpath)
-        response = HttpResponse(fsock)
-        response['Content-Disposition'] = 'attachment; filename=' + filename.encode("utf-8")
-        logger.info("read file '%s' ('%s')"%(found_path.url_path, lcpath))
+        set_validators(response, st)
+        if not stat.S_ISDIR(st.st_mode):
+            filename = os.path.basename(lcpath)
+            response['Content-Disposition'] = 'attachment; filename=' + filename.encode("utf-8")
+        logger.info("%s file '%s' ('%s')"%(request.method.lower(), found_path.url_path, lcpath))
         return response
 
+    def get_response(self, request, found_path, lcpath, st):
+        return get_delivery(found_path).response(request, lcpath, st)
+
 
-class HeadHandler(MethodHandler):
+class HeadHandler(GetHandler):
     """
     Implements: HEAD method.
-    Status: not complete. I'm not sure what da heck this is supposed to do.
+    Status: completed. Answers from a single stat, the file is never opened.
     """
 
-    def handle(self, request):
-        found_path = WebdavPath.get_match_path_to_dir(request.localpath)
-        if not found_path:
-            logger.warning("invalid file path '%s'"%path)
-            return HttpResponseNotFound()
-        lcpath = found_path.get_local_path(request.localpath)
-        if not lcpath:
-            return HttpResponseForbidden("403 Internal")
-        acl = DirectoryACL(found_path, lcpath)
-        response = check_http_authorization(acl, request, found_path, "read")
-        if response:
-            return response
-        if (not is_file(lcpath) 
-            or (lcpath.endswith(acl.ACL_FILENAME) and not acl.perm_acl(request.user))):
-            return HttpResponseNotFound()        
-        try:
-            fsock = file(lcpath, "r")
-        except IOError, ioe:
-            logger.warning("could read file '%s' ('%s'); %s"%(
-                    found_path.url_path, lcpath, ioe))
-            return HttpResponseForbidden("403 Internal")
-        filename = os.path.basename(lcpath)
-        filesize = os.path.getsize(lcpath)
-        response = HttpResponse(fsock)
-        response['Content-Disposition'] = 'attachment; filename=' + filename
-        logger.info("read file '%s' ('%s')"%(found_path.url_path, lcpath))
+    def is_target(self, st):
+        return stat.S_ISREG(st.st_mode) or stat.S_ISDIR(st.st_mode)
+
+    def get_response(self, request, found_path, lcpath, st):
+        if stat.S_ISDIR(st.st_mode):
+            return HttpResponse("", content_type = "httpd/unix-directory")
+        response = HttpResponse("", content_type = get_content_type(lcpath))
+        response["Content-Length"] = str(st.st_size)
+        response["Accept-Ranges"] = "bytes"
         return response
     
 
@@ -192,7 +481,7 @@ class PutHandler(MethodHandler):
             return HttpResponseNotFound()
         lcpath = found_path.get_local_path(request.localpath)        
         if not lcpath:
-            logger.warning("invalid file path '%s'"%path)
+            logger.warning("invalid file path '%s'"%request.localpath)
             return HttpResponseForbidden("403 Internal")
         acl = DirectoryACL(found_path, lcpath)
         if is_file(lcpath):
@@ -212,40 +501,146 @@ class PutHandler(MethodHandler):
             content_length = int(request.META.get("CONTENT_LENGTH"))
         except (ValueError, TypeError):
             content_length = 0
+        st = is_file(lcpath) and os.stat(lcpath) or None
+        response = check_conditions(request, st)
+        if response:
+            return response
+        response = check_locks(request, request.path, lcpath, parent = st is None)
+        if response:
+            return response
+        old_size = get_file_size(lcpath)
+        add_files = old_size is None and 1 or 0
+        old_size = old_size or 0
+        mode = st and stat.S_IMODE(st.st_mode) or FILE_MODE
+        content_range = request.META.get("HTTP_CONTENT_RANGE")
+        if content_range:
+            return self.handle_range(request, found_path, lcpath, content_range,
+                                     content_length, old_size, add_files, mode)
+        response = check_quota(found_path, lcpath, content_length - old_size, add_files)
+        if response:
+            return response
         max_quota = found_path.quota * WebdavPath.QUOTA_SIZE_MULT
-        max_num_files = found_path.max_num_files
-        if max_quota > 0 or max_num_files > 0:
-            used_quota, num_files = get_used_quota(found_path.local_path)
-            if max_quota > 0 and used_quota + content_length >= max_quota:
-                logger.info("quota exceeded for '%s' ('%s') %d/%d"%(
-                    found_path.url_path, lcpath, used_quota, max_quota))
-                return HttpResponseForbidden("403 Quota")
-            if max_num_files > 0 and num_files + 1 >= max_num_files:
-                logger.info("num files exceeded for '%s' ('%s') %d/%d"%(
-                    found_path.url_path, lcpath, num_files, max_num_files))
-                return HttpResponseForbidden("403 Num files")
+        if max_quota > 0:
+            used_quota, num_files = QuotaLedger.get_usage(found_path)
+            used_quota += UploadSession.get_reserved(found_path, lcpath)
+            limit = max_quota - used_quota + old_size
         else:
-            used_quota = 0
-            num_files = 0
+            limit = None
         try:
-            fileout = file(lcpath, "w")
-        except IOError, ioe:
+            written = self.receive(request, lcpath, limit, mode)
+        except QuotaExceeded:
+            logger.info("quota exceeded for '%s' ('%s') %d"%(
+                found_path.url_path, lcpath, max_quota))
+            return HttpResponseForbidden("403 Quota")
+        except (IOError, OSError), ioe:
             logger.warning("could write file '%s'; %s"%(lcpath, ioe))
             return HttpResponseForbidden("403 Internal")
-        buf = request.read(1024)
-        while len(buf) > 0:
-            if max_quota > 0:
-                used_quota += len(buf)
-                if used_quota >= max_quota:
-                    fileout.close()
-                    logger.info("quota exceeded for '%s' ('%s') %d/%d"%(
-                        found_path.url_path, lcpath, used_quota, max_quota))
-                    return HttpResponseForbidden("403 Quota")
-            fileout.write(buf)
-            buf = request.read(1024)
-        fileout.close()
+        return self.written(found_path, lcpath, written - old_size, add_files)
+
+    def written(self, found_path, lcpath, add_size, add_files):
+        add_usage(found_path, add_size, add_files)
+        resource_changed(found_path, lcpath)
         logger.info("wrote file '%s'"%lcpath)
-        return HttpResponseCreated()
+        response = HttpResponseCreated()
+        response["ETag"] = get_etag(os.stat(lcpath))
+        return response
+
+    def upload_status(self, offset, status = 204):
+        response = HttpResponse("", status = status)
+        response["Upload-Offset"] = str(offset)
+        return response
+
+    def handle_range(self, request, found_path, lcpath, content_range,
+                     content_length, old_size, add_files, mode):
+        """
+        Resumable upload. "Content-Range: bytes FIRST-LAST/TOTAL" appends to
+        a staging file, which must already hold FIRST bytes, and
+        "Content-Range: bytes */TOTAL" without a body asks how much arrived.
+        Both answer 204 with an Upload-Offset header, or 409 if FIRST does
+        not match it. The upload is committed once all TOTAL bytes are in.
+        """
+        parsed = parse_content_range(content_range)
+        if not parsed:
+            return HttpResponseBadRequest("400 Bad Content-Range")
+        first, last, total = parsed
+        response = check_quota(found_path, lcpath, total - old_size, add_files)
+        if response:
+            return response
+        try:
+            session = UploadSession.get_session(found_path, lcpath, total)
+        except (IOError, OSError), ioe:
+            logger.warning("could not stage upload of '%s'; %s"%(lcpath, ioe))
+            return HttpResponseForbidden("403 Internal")
+        offset = session.get_offset()
+        if first is None:
+            return self.upload_status(offset)
+        if first != offset:
+            return self.upload_status(offset, 409)
+        if content_length != last - first + 1:
+            return HttpResponseBadRequest("400 Bad Content-Length")
+        bufsize = getattr(settings, "WEBDAV_UPLOAD_BUFFER_SIZE", 256 * 1024)
+        try:
+            fileout = file(session.staging_path, "ab")
+            try:
+                remaining = content_length
+                while remaining > 0:
+                    buf = request.read(min(bufsize, remaining))
+                    if not buf:
+                        break
+                    fileout.write(buf)
+                    remaining -= len(buf)
+            finally:
+                fileout.close()
+            offset = session.get_offset()
+            if offset < total:
+                session.save()
+                return self.upload_status(offset)
+            os.chmod(session.staging_path, mode)
+            get_property_store().preserve(lcpath, session.staging_path)
+            os.rename(session.staging_path, lcpath)
+        except (IOError, OSError), ioe:
+            logger.warning("could write file '%s'; %s"%(lcpath, ioe))
+            return HttpResponseForbidden("403 Internal")
+        session.delete()
+        return self.written(found_path, lcpath, total - old_size, add_files)
+
+    def receive(self, request, lcpath, limit, mode):
+        """
+        Streams the request body into a temporary file next to lcpath and
+        renames it over lcpath once complete, so readers never see a partial
+        file. Dead properties of lcpath are carried over to the new file.
+        Raises QuotaExceeded, leaving lcpath untouched, as soon as limit
+        bytes are reached. Returns the number of bytes written.
+        """
+        bufsize = getattr(settings, "WEBDAV_UPLOAD_BUFFER_SIZE", 256 * 1024)
+        fd, tmppath = tempfile.mkstemp(prefix = UPLOAD_TEMP_PREFIX,
+                                       dir = os.path.dirname(lcpath))
+        try:
+            fileout = os.fdopen(fd, "wb")
+            try:
+                written = 0
+                buf = request.read(bufsize)
+                while buf:
+                    written += len(buf)
+                    if limit is not None and written >= limit:
+                        raise QuotaExceeded()
+                    fileout.write(buf)
+                    buf = request.read(bufsize)
+                fileout.flush()
+                if getattr(settings, "WEBDAV_UPLOAD_FSYNC", False):
+                    os.fsync(fileout.fileno())
+            finally:
+                fileout.close()
+            os.chmod(tmppath, mode)
+            get_property_store().preserve(lcpath, tmppath)
+            os.rename(tmppath, lcpath)
+        except:
+            try:
+                os.remove(tmppath)
+            except OSError:
+                pass
+            raise
+        return written
 
 
 class DeleteHandler(MethodHandler):
@@ -257,7 +652,7 @@ class DeleteHandler(MethodHandler):
     def handle(self, request):
         found_path = WebdavPath.get_match_path_to_dir(request.localpath)
         if not found_path:
-            logger.warning("invalid file path '%s'"%path)
+            logger.warning("invalid file path '%s'"%request.localpath)
             return HttpResponseNotFound()
         lcpath = found_path.get_local_path(request.localpath)
         if not lcpath:
@@ -270,20 +665,40 @@ class DeleteHandler(MethodHandler):
             return HttpResponseForbidden("403 Permission")
         if not is_file(lcpath) and not is_dir(lcpath):
             return HttpResponseNotFound()
+        response = check_conditions(request, os.stat(lcpath))
+        if response:
+            return response
+        response = check_locks(request, request.path, lcpath, recursive = True,
+                               parent = True)
+        if response:
+            return response
         if is_dir(lcpath):
+            # walking the tree here would undo the trash, without an index
+            # the next quota check rescans instead
+            usage = has_quota(found_path) and metadata.get_usage(found_path, lcpath)
             try:
-                shutil.rmtree(lcpath)
+                remove_tree(found_path.local_path, lcpath)
+                if usage:
+                    add_usage(found_path, -usage[0], -usage[1])
+                elif has_quota(found_path):
+                    QuotaLedger.objects.filter(webdavpath = found_path.pk).delete()
+                resource_changed(found_path, lcpath, True)
                 logger.info("removed directory '%s'"%lcpath)
-            except IOError, ioe:
+            except (IOError, OSError), ioe:
                 logger.warning("could not remove directory '%s'; %s"%(lcpath, ioe))
                 return HttpResponseNotAllowed("405 Not Allowed")            
         elif is_file(lcpath):
+            size = os.path.getsize(lcpath)
             try:
-                os.remove(lcpath)            
+                os.remove(lcpath)
+                add_usage(found_path, -size, -1)
+                resource_changed(found_path, lcpath)
                 logger.info("removed file '%s'"%lcpath)
             except IOError, ioe:
                 logger.warning("could not remove file '%s'; %s"%(lcpath, ioe))
                 return HttpResponseNotAllowed("405 Not Allowed")
+        remove_locks(request.path)
+        get_property_store().delete(lcpath)
         response = HttpResponse()
         return response
     
@@ -300,7 +715,7 @@ class MakedirHandler(MethodHandler):
             return HttpResponseNotFound()
         lcpath = found_path.get_local_path(request.localpath)
         if not lcpath:
-            logger.warning("invalid file path '%s'"%path)
+            logger.warning("invalid file path '%s'"%request.localpath)
             return HttpResponseForbidden("403 Internal")
         acl = DirectoryACL(found_path, lcpath)
         response = check_http_authorization(acl, request, found_path, "new_file")
@@ -310,8 +725,12 @@ class MakedirHandler(MethodHandler):
             return HttpResponseForbidden("403 Permission")
         if is_dir(lcpath) or is_file(lcpath):
             return HttpResponseNotAllowed("405 Not Allowed")
+        response = check_locks(request, request.path, lcpath, parent = True)
+        if response:
+            return response
         try:
             os.mkdir(lcpath)
+            resource_changed(found_path, lcpath)
         except IOError, ioe:
             logger.warning("could create directory '%s'; %s"%(lcpath, ioe))
             return HttpResponseNotAllowed("405 Not Allowed")
@@ -331,7 +750,7 @@ class CopyHandler(MethodHandler):
             return HttpResponseNotFound()
         lcpath = found_path.get_local_path(request.localpath)        
         if not lcpath:
-            logger.warning("invalid file path '%s'"%path)
+            logger.warning("invalid file path '%s'"%request.localpath)
             return HttpResponseForbidden("403 Internal")
 
         target_uri = request.META.get("HTTP_DESTINATION", "")
@@ -348,6 +767,9 @@ class CopyHandler(MethodHandler):
             logger.warning("no paths defined for '%s'"%target_localpath)
             return HttpResponseBadRequest()
         target_lcpath = target_found_path.get_local_path(target_localpath)
+        if not target_lcpath:
+            logger.warning("invalid file path '%s'"%target_localpath)
+            return HttpResponseForbidden("403 Internal")
 
         acl = DirectoryACL(found_path, lcpath)
         response = check_http_authorization(acl, request, found_path, "read")
@@ -364,39 +786,80 @@ class CopyHandler(MethodHandler):
         if target_lcpath.endswith(target_acl.ACL_FILENAME) and not target_acl.perm_acl(request.user):
             return HttpResponseForbidden("403 Permission")
 
-        if os.path.islink(lcpath) or is_dir(lcpath):
-            logger.warning("trying to overwrite symbolic link or dir '%s'"%lcpath)
+        if os.path.islink(lcpath):
+            logger.warning("trying to copy symbolic link '%s'"%lcpath)
+        if not is_file(lcpath) and not is_dir(lcpath):
+            return HttpResponseNotFound()
+        response = check_conditions(request, os.stat(lcpath))
+        if response:
+            return response
+        depth = request.META.get("HTTP_DEPTH", "infinity").strip().lower()
+        if depth not in ("0", "infinity"):
+            return HttpResponseBadRequest("400 Bad Depth")
+        overwrite = request.META.get("HTTP_OVERWRITE", "T").strip().upper()
+        if overwrite not in ("T", "F"):
+            return HttpResponseBadRequest("400 Bad Overwrite")
+        if target_lcpath == lcpath or target_lcpath.startswith(lcpath + "/"):
+            return HttpResponseForbidden("403 Destination inside source")
+        if not is_dir(os.path.dirname(target_lcpath)):
+            return HttpResponse("409 Conflict", status = 409)
+        exists = os.path.lexists(target_lcpath)
+        if exists and overwrite == "F":
+            return HttpResponsePreconditionFailed()
+        # the If header is about the source, the destination is only
+        # checked for locks
+        response, submitted = check_if_header(request, lcpath)
+        if response:
+            return response
+        response = check_locks(request, target_parsed.path, target_lcpath,
+                               recursive = True, parent = True, submitted = submitted)
+        if response:
+            return response
 
-        try:
-            content_length = int(request.META.get("CONTENT_LENGTH"))
-        except (ValueError, TypeError):
-            content_length = 0
-        max_quota = found_path.quota * WebdavPath.QUOTA_SIZE_MULT
-        max_num_files = found_path.max_num_files
-        if max_quota > 0 or max_num_files > 0:
-            used_quota, num_files = get_used_quota(found_path.local_path)
-            if is_file(target_lcpath):
-                if max_quota > 0:
-                    used_quota -= os.path.getsize(target_lcpath)
-                if max_num_files > 0:
-                    num_files -= 1
-            if max_quota > 0 and used_quota + content_length >= max_quota:
-                logger.info("quota exceeded for '%s' ('%s') %d/%d"%(
-                    found_path.url_path, lcpath, used_quota, max_quota))
-                return HttpResponseForbidden("403 Quota")
-            if max_num_files > 0 and num_files + 1 >= max_num_files:
-                logger.info("num files exceeded for '%s' ('%s') %d/%d"%(
-                    found_path.url_path, lcpath, num_files, max_num_files))
-                return HttpResponseForbidden("403 Num files")
+        if has_quota(found_path) or has_quota(target_found_path):
+            if is_dir(lcpath) and depth == "0":
+                size, num_files = 0, 0
+            else:
+                size, num_files = get_resource_usage(found_path, lcpath)
+            old_size, old_files = get_resource_usage(target_found_path, target_lcpath)
         else:
-            used_quota = 0
-            num_files = 0
+            size, num_files, old_size, old_files = 0, 0, 0, 0
+        response = check_quota(target_found_path, target_lcpath,
+                               size - old_size, num_files - old_files)
+        if response:
+            return response
+        errors = []
         try:
-            shutil.copy(lcpath, target_lcpath)
-        except IOError, ioe:
+            if exists and (is_dir(lcpath) or is_dir(target_lcpath)):
+                remove_resource(target_found_path, target_lcpath)
+            if is_dir(lcpath):
+                skip = []
+                if not target_acl.perm_acl(request.user):
+                    skip.append(target_acl.ACL_FILENAME)
+                errors = copy_tree(lcpath, target_lcpath, depth == "infinity", skip)
+            else:
+                copy_file(lcpath, target_lcpath)
+        except (IOError, OSError), ioe:
             logger.warning("failed to copy '%s' to '%s'; %s"%(lcpath, target_lcpath, ioe))
-            return HttpResponseNotAllowed("405 Not Allowed")
-        logger.info("copied file '%s' to '%s'"%(lcpath, target_lcpath))
+            resource_changed(target_found_path, target_lcpath, True)
+            QuotaLedger.objects.filter(webdavpath = target_found_path.pk).delete()
+            status = get_error_status(ioe)
+            return HttpResponse(status, status = int(status[:3]))
+        resource_changed(target_found_path, target_lcpath, True)
+        if errors:
+            # only part of the tree arrived, let the next check rescan
+            QuotaLedger.objects.filter(webdavpath = target_found_path.pk).delete()
+            logger.warning("copied '%s' to '%s' with %d errors"%(
+                lcpath, target_lcpath, len(errors)))
+            return get_multistatus_errors(target_parsed.path, target_lcpath, errors)
+        add_usage(target_found_path, size - old_size, num_files - old_files)
+        store = get_property_store()
+        if exists:
+            store.delete(target_lcpath)
+        store.copy(lcpath, target_lcpath, depth == "infinity")
+        logger.info("copied '%s' to '%s'"%(lcpath, target_lcpath))
+        if exists:
+            return HttpResponse('', None, 204)
         return HttpResponse('', None, 201)
 
 
@@ -412,7 +875,7 @@ class MoveHandler(MethodHandler):
             return HttpResponseNotFound()
         lcpath = found_path.get_local_path(request.localpath)        
         if not lcpath:
-            logger.warning("invalid file path '%s'"%path)
+            logger.warning("invalid file path '%s'"%request.localpath)
             return HttpResponseForbidden("403 Internal")
 
         target_uri = request.META.get("HTTP_DESTINATION", "")
@@ -429,6 +892,9 @@ class MoveHandler(MethodHandler):
             logger.warning("no paths defined for '%s'"%target_localpath)
             return HttpResponseBadRequest()
         target_lcpath = target_found_path.get_local_path(target_localpath)
+        if not target_lcpath:
+            logger.warning("invalid file path '%s'"%target_localpath)
+            return HttpResponseForbidden("403 Internal")
 
         acl = DirectoryACL(found_path, lcpath)
         response = check_http_authorization(acl, request, found_path, "read")
@@ -445,37 +911,460 @@ class MoveHandler(MethodHandler):
         if target_lcpath.endswith(target_acl.ACL_FILENAME) and not target_acl.perm_acl(request.user):
             return HttpResponseForbidden("403 Permission")
 
-        if os.path.islink(lcpath) or is_dir(lcpath):
-            logger.warning("trying to overwrite symbolic link or dir '%s'"%lcpath)
+        if os.path.islink(lcpath):
+            logger.warning("trying to move symbolic link '%s'"%lcpath)
+        if not is_file(lcpath) and not is_dir(lcpath):
+            return HttpResponseNotFound()
+        response = check_conditions(request, os.stat(lcpath))
+        if response:
+            return response
+        if request.META.get("HTTP_DEPTH", "infinity").strip().lower() != "infinity":
+            return HttpResponseBadRequest("400 Bad Depth")
+        response, submitted = check_if_header(request, lcpath)
+        if response:
+            return response
+        response = check_locks(request, request.path, lcpath, recursive = True,
+                               parent = True, submitted = submitted)
+        if response:
+            return response
+        overwrite = request.META.get("HTTP_OVERWRITE", "T").strip().upper()
+        if overwrite not in ("T", "F"):
+            return HttpResponseBadRequest("400 Bad Overwrite")
+        if target_lcpath == lcpath or target_lcpath.startswith(lcpath + "/"):
+            return HttpResponseForbidden("403 Destination inside source")
+        if not is_dir(os.path.dirname(target_lcpath)):
+            return HttpResponse("409 Conflict", status = 409)
+        exists = os.path.lexists(target_lcpath)
+        if exists and overwrite == "F":
+            return HttpResponsePreconditionFailed()
+        response = check_locks(request, target_parsed.path, target_lcpath,
+                               recursive = True, parent = True, submitted = submitted)
+        if response:
+            return response
 
-        try:
-            content_length = int(request.META.get("CONTENT_LENGTH"))
-        except (ValueError, TypeError):
-            content_length = 0
-        max_quota = found_path.quota * WebdavPath.QUOTA_SIZE_MULT
-        max_num_files = found_path.max_num_files
-        if max_quota > 0 or max_num_files > 0:
-            used_quota, num_files = get_used_quota(found_path.local_path)
-            if is_file(target_lcpath):
-                if max_quota > 0:
-                    used_quota -= os.path.getsize(target_lcpath)
-                if max_num_files > 0:
-                    num_files -= 1
-            if max_quota > 0 and used_quota + content_length >= max_quota:
-                logger.info("quota exceeded for '%s' ('%s') %d/%d"%(
-                    found_path.url_path, lcpath, used_quota, max_quota))
-                return HttpResponseForbidden("403 Quota")
-            if max_num_files > 0 and num_files + 1 >= max_num_files:
-                logger.info("num files exceeded for '%s' ('%s') %d/%d"%(
-                    found_path.url_path, lcpath, num_files, max_num_files))
-                return HttpResponseForbidden("403 Num files")
+        # within one WebdavPath a move never adds to the usage, only a
+        # replaced destination has to be subtracted
+        same_mount = found_path.pk == target_found_path.pk
+        if same_mount:
+            size, num_files = 0, 0
+        elif has_quota(found_path) or has_quota(target_found_path):
+            size, num_files = get_resource_usage(found_path, lcpath)
         else:
-            used_quota = 0
-            num_files = 0
+            size, num_files = 0, 0
+        if exists and has_quota(target_found_path):
+            old_size, old_files = get_resource_usage(target_found_path, target_lcpath)
+        else:
+            old_size, old_files = 0, 0
+        if not same_mount:
+            response = check_quota(target_found_path, target_lcpath,
+                                   size - old_size, num_files - old_files)
+            if response:
+                return response
+        errors = []
         try:
-            shutil.move(lcpath, target_lcpath)
-        except IOError, ioe:
-            logger.warning("failed to copy '%s' to '%s'; %s"%(lcpath, target_lcpath, ioe))
-            return HttpResponseNotAllowed("405 Not Allowed")
-        logger.info("moved file '%s' to '%s'"%(lcpath, target_lcpath))
+            replace = exists
+            renamed = True
+            if exists and (is_dir(lcpath) or is_dir(target_lcpath)):
+                remove_resource(target_found_path, target_lcpath)
+                replace = False
+            try:
+                if replace:
+                    os.rename(lcpath, target_lcpath)
+                else:
+                    rename_noreplace(lcpath, target_lcpath)
+            except OSError, ose:
+                if ose.errno == errno.EEXIST:
+                    return HttpResponsePreconditionFailed()
+                if ose.errno != errno.EXDEV:
+                    raise
+                # another filesystem, copy and remove the source
+                renamed = False
+                if is_dir(lcpath):
+                    errors = copy_tree(lcpath, target_lcpath)
+                else:
+                    copy_file(lcpath, target_lcpath)
+                if not errors:
+                    remove_resource(found_path, lcpath)
+        except (IOError, OSError), ioe:
+            logger.warning("failed to move '%s' to '%s'; %s"%(lcpath, target_lcpath, ioe))
+            resource_changed(found_path, lcpath, True)
+            resource_changed(target_found_path, target_lcpath, True)
+            QuotaLedger.objects.filter(webdavpath__in = [found_path.pk,
+                                                         target_found_path.pk]).delete()
+            status = get_error_status(ioe)
+            return HttpResponse(status, status = int(status[:3]))
+        resource_changed(found_path, lcpath, True)
+        resource_changed(target_found_path, target_lcpath, True)
+        if errors:
+            # the source is kept whole, only the copy is incomplete
+            QuotaLedger.objects.filter(webdavpath = target_found_path.pk).delete()
+            logger.warning("moved '%s' to '%s' with %d errors"%(
+                lcpath, target_lcpath, len(errors)))
+            return get_multistatus_errors(target_parsed.path, target_lcpath, errors)
+        if same_mount:
+            add_usage(found_path, -old_size, -old_files)
+        else:
+            add_usage(found_path, -size, -num_files)
+            add_usage(target_found_path, size - old_size, num_files - old_files)
+        remove_locks(request.path)
+        store = get_property_store()
+        if exists:
+            store.delete(target_lcpath)
+        store.move(lcpath, target_lcpath, renamed)
+        logger.info("moved '%s' to '%s'"%(lcpath, target_lcpath))
+        if exists:
+            return HttpResponse('', None, 204)
         return HttpResponse('', None, 201)
+
+
+class ReportHandler(PropfindHandler):
+    """
+    Implements: REPORT method, the sync-collection report of RFC 6578.
+    Status: completed. Clients present the sync-token of their last report
+    and get the members changed since, removed ones with a 404. An empty
+    token lists all members. Infinite-level reports are cut off after
+    WEBDAV_PROPFIND_MAX_ENTRIES members like PROPFIND Depth: infinity and
+    then hand out a paged token the rest is fetched with (RFC 6578 3.6).
+    Members are listed in order of their names for that.
+    """
+
+    def handle(self, request):
+        found_path = WebdavPath.get_match_path_to_dir(request.localpath)
+        if not found_path:
+            return HttpResponseNotFound()
+        lcpath = found_path.get_local_path(request.localpath)
+        if not lcpath:
+            logger.warning("invalid file path '%s'"%request.localpath)
+            return HttpResponseForbidden("403 Internal")
+        acl = DirectoryACL(found_path, lcpath)
+        response = check_http_authorization(acl, request, found_path, "read")
+        if response:
+            return response
+        if not is_file(lcpath) and not is_dir(lcpath):
+            return HttpResponseNotFound()
+        if request.META.get("HTTP_DEPTH", "0").strip() != "0":
+            return HttpResponseBadRequest("400 Bad Depth")
+        elem = Elem.from_stream(request)
+        if not elem:
+            return HttpResponseBadRequest()
+        if elem.name != "sync-collection" or not is_dir(lcpath):
+            return self.get_error("supported-report")
+        token = self.get_text(elem, "sync-token")
+        level = self.get_text(elem, "sync-level").lower() or sync.LEVEL_ONE
+        if level not in (sync.LEVEL_ONE, sync.LEVEL_INFINITE):
+            return HttpResponseBadRequest("400 Bad sync-level")
+        limit = None
+        if level == sync.LEVEL_INFINITE:
+            limit = getattr(settings, "WEBDAV_PROPFIND_MAX_ENTRIES", 10000)
+            if limit <= 0:
+                return self.get_error("sync-traversal-supported")
+        find_props, dead_props = self.parse_props(elem)
+        current = sync.get_current()
+        since, until, after = None, current, ()
+        if token:
+            parsed = sync.parse_token(token, found_path, current)
+            if parsed is None:
+                logger.info("sync-token '%s' of '%s' expired"%(token, lcpath))
+                return self.get_error("valid-sync-token")
+            since, until, after = parsed
+        view = metadata.get_view(found_path)
+        removed = []
+        if since is None:
+            try:
+                members = view.scandir(lcpath)
+            except (IOError, OSError), ioe:
+                logger.warning("could not list directory '%s'; %s"%(lcpath, ioe))
+                return HttpResponseForbidden("403 Internal")
+            entries = self.iter_entries(request, found_path, acl, lcpath, members,
+                                        level == sync.LEVEL_INFINITE, view,
+                                        ordered = True, after = after)
+        else:
+            changes = sync.get_changes(found_path, lcpath, since, until, level)
+            if changes is None:
+                logger.info("sync-token '%s' of '%s' expired"%(token, lcpath))
+                return self.get_error("valid-sync-token")
+            found = []
+            for path, recursive in changes.items():
+                key = self.get_key(lcpath, path)
+                href = request.path.rstrip("/") + path[len(lcpath):]
+                if os.path.lexists(path):
+                    found.append((key, path, href, recursive))
+                elif key > after and self.is_visible(request, found_path, path):
+                    removed.append((key, href))
+            found.sort()
+            removed.sort()
+            entries = self.iter_changes(request, found_path, found, view, after)
+        logger.info("sync-collection '%s' since '%s'"%(lcpath, token))
+        lock_tree = None
+        if "lockdiscovery" in find_props:
+            lock_tree = get_lock_tree(get_lock_path(request.path))
+
+        def trailer(last):
+            cursor = None
+            if last is not None:
+                cursor = self.get_key(os.path.normpath(request.path), os.path.normpath(last))
+            elems = [Elem("response", [Elem("href", [urllib.quote(href.encode("utf-8"))]),
+                                       Elem("status", ["HTTP/1.1 404 Not Found"])])
+                     for key, href in removed if cursor is None or key <= cursor]
+            elems.append(Elem("sync-token", [sync.format_token(until, since, cursor)]))
+            return elems
+
+        multistatus = self.iter_multistatus(request, entries, find_props, limit,
+                                            lock_tree, dead_props, trailer)
+        return HttpResponseMultistatus(multistatus)
+
+    def get_text(self, elem, name):
+        children = elem.find_children(name)
+        if not children:
+            return ""
+        return "".join(c for c in children[0].children if not isinstance(c, Elem)).strip()
+
+    def get_error(self, precondition):
+        error = Elem("error", [Elem(precondition)], xmlns = "DAV:")
+        return HttpResponseForbidden(error.get_xml(), content_type = "text/xml")
+
+    def is_visible(self, request, found_path, path):
+        """
+        True if the user may see path listed in its directory.
+        """
+        diracl = DirectoryACL(found_path, os.path.dirname(path))
+        name = os.path.basename(path)
+        return not (is_hidden(name) or not diracl.perm_read(request.user)
+                    or (name == diracl.ACL_FILENAME and not diracl.perm_acl(request.user)))
+
+    def get_key(self, lcpath, path):
+        """
+        The tuple of names of path below lcpath, the order in which reports
+        list members.
+        """
+        return tuple(path[len(lcpath.rstrip("/")) + 1:].split("/"))
+
+    def iter_changes(self, request, found_path, found, view, after = ()):
+        """
+        Yields the entries of the changed paths in found, a sorted list of
+        (key, local path, href, recursive), and of the trees below the
+        recursive ones, leaving out those up to the key after.
+        """
+        seen = set()
+        for key, path, href, recursive in found:
+            subafter = None
+            if key <= after:
+                if not (recursive and after[:len(key)] == key):
+                    continue
+                subafter = after[len(key):]
+            if not self.is_visible(request, found_path, path):
+                continue
+            if recursive and is_dir(path):
+                subacl = DirectoryACL(found_path, path)
+                entries = self.iter_entries(request, found_path, subacl, path, None,
+                                            True, view, href, True, subafter)
+            else:
+                diracl = DirectoryACL(found_path, os.path.dirname(path))
+                entries = self.iter_entries(request, found_path, diracl, path, [],
+                                            False, view, href)
+            for entry in entries:
+                if entry[0] not in seen:
+                    seen.add(entry[0])
+                    yield entry
+
+
+class ProppatchHandler(MethodHandler):
+    """
+    Implements: PROPPATCH method, for dead properties.
+    Status: completed.
+    """
+    PROTECTED_PROPS = PropfindHandler.LIVE_PROPS + ["getcontenttype"]
+
+    def handle(self, request):
+        found_path = WebdavPath.get_match_path_to_dir(request.localpath)
+        if not found_path:
+            return HttpResponseNotFound()
+        lcpath = found_path.get_local_path(request.localpath)
+        if not lcpath:
+            logger.warning("invalid file path '%s'"%request.localpath)
+            return HttpResponseForbidden("403 Internal")
+        acl = DirectoryACL(found_path, lcpath)
+        response = check_http_authorization(acl, request, found_path, "write")
+        if response:
+            return response
+        if lcpath.endswith(acl.ACL_FILENAME) and not acl.perm_acl(request.user):
+            return HttpResponseForbidden("403 Permission")
+        if not is_file(lcpath) and not is_dir(lcpath):
+            return HttpResponseNotFound()
+        response = check_conditions(request, os.stat(lcpath))
+        if response:
+            return response
+        response = check_locks(request, request.path, lcpath)
+        if response:
+            return response
+        elem = Elem.from_stream(request)
+        if not elem or elem.name != "propertyupdate":
+            return HttpResponseBadRequest()
+        # (namespace, name), value pairs in document order, None removes
+        updates = []
+        for action in elem.children:
+            if not isinstance(action, Elem) or action.name not in ("set", "remove"):
+                continue
+            for prop in action.children:
+                if not isinstance(prop, Elem) or prop.name != "prop":
+                    continue
+                for child in prop.children:
+                    if isinstance(child, Elem):
+                        value = action.name == "set" and get_value_xml(child) or None
+                        updates.append(((child.namespace or "", child.name), value))
+        keys = []
+        for key, value in updates:
+            if key not in keys:
+                keys.append(key)
+        protected = [key for key in keys
+                     if key[0] == "DAV:" and key[1] in self.PROTECTED_PROPS]
+        if protected:
+            statuses = [(protected, "403 Forbidden"),
+                        ([key for key in keys if key not in protected],
+                         "424 Failed Dependency")]
+        else:
+            try:
+                get_property_store().patch(lcpath, updates)
+            except (IOError, OSError), ioe:
+                logger.warning("could not set properties of '%s'; %s"%(lcpath, ioe))
+                statuses = [(keys, get_error_status(ioe))]
+            else:
+                sync.record(found_path, lcpath)
+                watcher.mark_written(found_path, lcpath)
+                logger.info("patched %d properties of '%s'"%(len(updates), lcpath))
+                statuses = [(keys, "200 OK")]
+        multistatus = Elem("multistatus", xmlns = "DAV:")
+        response = multistatus.add_child(Elem("response"))
+        response.add_child(Elem("href", [urllib.quote(request.path.encode("utf-8"))]))
+        for keys, status in statuses:
+            if not keys:
+                continue
+            propstat = response.add_child(Elem("propstat"))
+            prop = propstat.add_child(Elem("prop"))
+            for namespace, name in keys:
+                prop.add_child(Elem(name, xmlns = namespace))
+            propstat.add_child(Elem("status", ["HTTP/1.1 %s"%status]))
+        return HttpResponseMultistatus(multistatus.get_xml().encode("utf-8"))
+
+
+class LockHandler(MethodHandler):
+    """
+    Implements: LOCK method, write locks only.
+    Status: completed.
+    """
+
+    def handle(self, request):
+        found_path = WebdavPath.get_match_path_to_dir(request.localpath)
+        if not found_path:
+            return HttpResponseNotFound()
+        lcpath = found_path.get_local_path(request.localpath)
+        if not lcpath:
+            logger.warning("invalid file path '%s'"%request.localpath)
+            return HttpResponseForbidden("403 Internal")
+        acl = DirectoryACL(found_path, lcpath)
+        exists = is_file(lcpath) or is_dir(lcpath)
+        perm = exists and "write" or "new_file"
+        response = check_http_authorization(acl, request, found_path, perm)
+        if response:
+            return response
+        if lcpath.endswith(acl.ACL_FILENAME) and not acl.perm_acl(request.user):
+            return HttpResponseForbidden("403 Permission")
+        timeout = get_timeout(request.META.get("HTTP_TIMEOUT"))
+        if not has_body(request):
+            return self.refresh(request, lcpath, timeout)
+        elem = Elem.from_stream(request)
+        if not elem or elem.name != "lockinfo":
+            return HttpResponseBadRequest()
+        if elem.find_children("shared"):
+            scope = SCOPE_SHARED
+        elif elem.find_children("exclusive"):
+            scope = SCOPE_EXCLUSIVE
+        else:
+            return HttpResponseBadRequest("400 Bad lockscope")
+        owner = elem.find_children("owner")
+        owner = owner and owner[0].get_xml() or ""
+        depth = request.META.get("HTTP_DEPTH", "infinity").strip().lower()
+        if depth not in ("0", "infinity"):
+            return HttpResponseBadRequest("400 Bad Depth")
+        path = get_lock_path(request.path)
+        if not exists:
+            if not is_dir(os.path.dirname(lcpath)):
+                return HttpResponse("409 Conflict", status = 409)
+            response = check_locks(request, request.path, lcpath, parent = True)
+            if response:
+                return response
+            response = check_quota(found_path, lcpath, 0, 1)
+            if response:
+                return response
+        try:
+            lock = create_lock(path, scope, depth, owner,
+                               getattr(request.user, "id", None), timeout)
+        except LockConflict, lc:
+            return HttpResponseLocked(lc.lock)
+        status = 200
+        if not exists:
+            # a locked empty resource
+            try:
+                file(lcpath, "a").close()
+            except IOError, ioe:
+                remove_lock(lock.token)
+                logger.warning("could not create file '%s'; %s"%(lcpath, ioe))
+                return HttpResponseForbidden("403 Internal")
+            add_usage(found_path, 0, 1)
+            resource_changed(found_path, lcpath)
+            status = 201
+        return self.get_response(lock, status)
+
+    def refresh(self, request, lcpath, timeout):
+        lists = parse_if_header(request.META.get("HTTP_IF", ""))
+        if not lists:
+            return HttpResponseBadRequest("400 Missing If")
+        path = get_lock_path(request.path)
+        user_id = getattr(request.user, "id", None)
+        for token in get_submitted_tokens(lists):
+            lock = get_lock_backend().get(token)
+            if lock and lock.user_id == user_id and lock in get_lock_backend().get_covering(path):
+                return self.get_response(refresh_lock(lock, timeout), 200)
+        return HttpResponsePreconditionFailed()
+
+    def get_response(self, lock, status):
+        prop = Elem("prop", xmlns = "DAV:")
+        prop.add_child(Elem("lockdiscovery", [lock.get_activelock()]))
+        response = HttpResponse(prop.get_xml().encode("utf-8"), status = status,
+                                content_type = "text/xml; charset=utf-8")
+        response["Lock-Token"] = "<%s>"%lock.token
+        return response
+
+
+class UnlockHandler(MethodHandler):
+    """
+    Implements: UNLOCK method.
+    Status: completed.
+    """
+
+    def handle(self, request):
+        found_path = WebdavPath.get_match_path_to_dir(request.localpath)
+        if not found_path:
+            return HttpResponseNotFound()
+        lcpath = found_path.get_local_path(request.localpath)
+        if not lcpath:
+            logger.warning("invalid file path '%s'"%request.localpath)
+            return HttpResponseForbidden("403 Internal")
+        acl = DirectoryACL(found_path, lcpath)
+        response = check_http_authorization(acl, request, found_path, "read")
+        if response:
+            return response
+        token = request.META.get("HTTP_LOCK_TOKEN", "").strip()
+        if not token.startswith("<") or not token.endswith(">"):
+            return HttpResponseBadRequest("400 Bad Lock-Token")
+        lock = get_lock_backend().get(token[1:-1])
+        path = get_lock_path(request.path)
+        if not lock or lock not in get_lock_backend().get_covering(path):
+            error = Elem("error", [Elem("lock-token-matches-request-uri")], xmlns = "DAV:")
+            return HttpResponse(error.get_xml(), status = 409, content_type = "text/xml")
+        user_id = getattr(request.user, "id", None)
+        if lock.user_id != user_id and user_id != found_path.owner_id:
+            return HttpResponseForbidden("403 Not lock owner")
+        remove_lock(lock.token)
+        logger.info("unlocked '%s'"%lock.path)
+        return HttpResponse('', None, 204)
@@ -0,0 +1,33 @@
+"""
+Copyright 2012 Peter Gebauer
+Licensed under GNU GPLv3
+
+WSGI middleware for the "file-wrapper" delivery, wrap the application
+with it in the project's wsgi.py:
+
+    application = FileWrapperMiddleware(get_wsgi_application())
+
+Part of the django-webdav project.
+"""
+from django.conf import settings
+
+
+class FileWrapperMiddleware(object):
+    """
+    Returns the file attached to a response as file_to_stream through
+    wsgi.file_wrapper, so that servers supporting it can send the file
+    without reading it into Python. Other responses pass unchanged.
+    """
+
+    def __init__(self, application):
+        self.application = application
+
+    def __call__(self, environ, start_response):
+        response = self.application(environ, start_response)
+        fsock = getattr(response, "file_to_stream", None)
+        file_wrapper = environ.get("wsgi.file_wrapper")
+        if fsock is None or file_wrapper is None:
+            return response
+        # the response's iterator was never started, the wrapper closes fsock
+        return file_wrapper(fsock, getattr(settings, "WEBDAV_DELIVERY_BUFFER_SIZE",
+                                           64 * 1024))